@@ -1,8 +1,9 @@
 from fastapi import FastAPI, APIRouter, HTTPException, Response, Cookie, Request, Form, File, UploadFile
 from fastapi.responses import JSONResponse, HTMLResponse
+from fastapi.encoders import jsonable_encoder
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
 import os
 import logging
 from pathlib import Path
@@ -12,8 +13,26 @@ import uuid
 from datetime import datetime, timezone, timedelta
 import requests
 from bson import ObjectId
+from bson.errors import InvalidId
 import secrets
 import hashlib
+import asyncio
+import base64
+import binascii
+import csv
+import gzip
+import io
+import json
+import re
+import time
+import numpy as np
+from cachetools import LRUCache
+from fastapi.concurrency import run_in_threadpool
+from gridfs.errors import FileExists, NoFile
+from PIL import Image, UnidentifiedImageError
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+import msgpack
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -89,11 +108,11 @@ class Post(BaseModel):
     user_id: str
     user_name: str
     user_picture: Optional[str] = None
+    star_rating: int = 0  # Author's rating; user_picture and star_rating follow the author
     content: str
     image: Optional[str] = None  # Kept for backward compatibility
     images: Optional[List[str]] = []
-    vote_ups: int = 0
-    voted_by: List[str] = []
+    vote_ups: int = 0  # Count of this post's documents in db.post_votes
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class Comment(BaseModel):
@@ -194,6 +213,7 @@ class GuideOnboardingRequest(BaseModel):
 
 # New models for ingredient management
 class SourceIngredientPurchase(BaseModel):
+    purchase_id: str = Field(default_factory=lambda: uuid.uuid4().hex)
     purchase_quantity: float  # e.g., 8 (pcs)
     purchase_price: float  # e.g., 100 (Rs)
     unit_price: float  # Auto-calculated: purchase_price / purchase_quantity
@@ -201,27 +221,28 @@ class SourceIngredientPurchase(BaseModel):
 
 class SourceIngredient(BaseModel):
     name: str
-    image: Optional[str] = None  # Base64 encoded image
+    image: Optional[str] = None  # Blob URL
     unit: str  # pcs, kg, liters, etc.
-    purchases: List[SourceIngredientPurchase] = []  # Purchase history
-    
-    @property
-    def latest_unit_price(self):
-        if not self.purchases:
-            return 0
-        return self.purchases[-1].unit_price
-    
-    @property
-    def lowest_unit_price(self):
-        if not self.purchases:
-            return 0
-        return min(p.unit_price for p in self.purchases)
-    
-    @property
-    def highest_unit_price(self):
-        if not self.purchases:
-            return 0
-        return max(p.unit_price for p in self.purchases)
+    # Running aggregates over the purchase history kept in db.purchase_buckets;
+    # the price fields are absent until the first purchase
+    purchase_count: int = 0
+    latest_unit_price: Optional[float] = None
+    lowest_unit_price: Optional[float] = None
+    highest_unit_price: Optional[float] = None
+    latest_purchase: Optional[SourceIngredientPurchase] = None
+    # Cost valuation used for pricing: "latest", "weighted_average" or "fifo"
+    valuation_mode: str = "latest"
+    consumed_quantity: float = 0.0  # Quantity used up so far, oldest purchases first
+    valuation_unit_price: Optional[float] = None  # Cached unit cost under valuation_mode
+
+class PurchaseBucket(BaseModel):
+    """One month of a source ingredient's purchases, oldest first"""
+    source_id: str
+    month: str  # YYYY-MM of purchase_date (UTC)
+    purchases: List[SourceIngredientPurchase] = []
+    count: int = 0
+    min_unit_price: float
+    max_unit_price: float
 
 class NutritionEntry(BaseModel):
     name: str  # e.g., Protein, Carbs, Vitamin A
@@ -415,110 +436,2679 @@ class Config(BaseModel):
     config: dict
 
 # Price calculation helpers
+def _object_ids(ids) -> list:
+    """Convert id strings to ObjectIds, dropping anything that is not a valid id"""
+    object_ids = []
+    for item_id in ids:
+        if item_id and ObjectId.is_valid(item_id):
+            object_ids.append(ObjectId(item_id))
+    return object_ids
+
+async def _fetch_by_ids(collection, ids, projection: dict = None) -> dict:
+    """Fetch documents by id with a single $in query, keyed by string id"""
+    object_ids = _object_ids(set(ids))
+    if not object_ids:
+        return {}
+    docs = await collection.find({"_id": {"$in": object_ids}}, projection).to_list(None)
+    return {str(doc["_id"]): doc for doc in docs}
+
+def _index_by_id(docs: list) -> dict:
+    """Key already loaded documents by string id"""
+    return {str(doc["_id"]): doc for doc in docs if doc.get("_id") is not None}
+
+class PriceResolver:
+    """Prices processed ingredients, recipes and meals from preloaded catalog documents.
+
+    Every recipe, processed ingredient and source ingredient referenced by the
+    items being priced is loaded once with an $in query, so a whole list
+    endpoint is priced in memory instead of one find_one per reference.
+    """
+
+    def __init__(self, sources: dict = None, ingredients: dict = None, recipes: dict = None):
+        self.sources = sources or {}
+        self.ingredients = ingredients or {}
+        self.recipes = recipes or {}
+        self._ingredient_prices = {}
+        self._recipe_prices = {}
+
+    @classmethod
+    async def load(cls, ingredients: list = None, recipes: list = None, meals: list = None) -> "PriceResolver":
+        """Load everything needed to price the given ingredient, recipe and meal documents"""
+        ingredients = list(ingredients or [])
+        recipes = list(recipes or [])
+
+        # Meals reference recipes (stored in db.meals)
+        recipe_map = _index_by_id(recipes)
+        recipe_ids = [
+            recipe_ref.get("recipe_id")
+            for meal in meals or []
+            for recipe_ref in meal.get("recipes", [])
+            if str(recipe_ref.get("recipe_id")) not in recipe_map
+        ]
+        fetched = await _fetch_by_ids(db.meals, recipe_ids, {"images": 0})
+        recipe_map.update(fetched)
+        recipes.extend(fetched.values())
+
+        # Recipes reference processed ingredients
+        ingredient_map = _index_by_id(ingredients)
+        ingredient_ids = [
+            ingredient_ref.get("ingredient_id")
+            for recipe in recipes
+            for ingredient_ref in recipe.get("ingredients", [])
+            if str(ingredient_ref.get("ingredient_id")) not in ingredient_map
+        ]
+        fetched = await _fetch_by_ids(db.ingredients, ingredient_ids, {"images": 0})
+        ingredient_map.update(fetched)
+        ingredients.extend(fetched.values())
+
+        # Processed ingredients reference source ingredients
+        source_ids = [
+            source_ref.get("source_ingredient_id")
+            for ingredient in ingredients
+            for source_ref in ingredient.get("source_ingredients", [])
+        ]
+        source_map = await _fetch_by_ids(db.source_ingredients, source_ids, {"image": 0})
+
+        return cls(sources=source_map, ingredients=ingredient_map, recipes=recipe_map)
+
+    def ingredient_price(self, ingredient_data: dict) -> Optional[float]:
+        """Price of one unit of a processed ingredient from source ingredients + margins.
+
+        Returns None when the ingredient references a malformed source id.
+        """
+        total_price = 0.0
+
+        for source_ref in ingredient_data.get("source_ingredients", []):
+            source_id = source_ref.get("source_ingredient_id")
+            source_quantity = source_ref.get("source_quantity", 0)
+
+            if source_id is not None and not ObjectId.is_valid(source_id):
+                return None
+
+            source = self.sources.get(str(source_id))
+            unit_price = source_unit_price(source) if source else None
+            if unit_price is not None:
+                # Use the source's unit cost under its valuation mode
+                total_price += unit_price * source_quantity
+
+        # Add margins
+        product_margin = ingredient_data.get("product_margin", 0)
+        operations_margin = ingredient_data.get("operations_margin", 0)
+        branding_margin = ingredient_data.get("branding_margin", 0)
+        rest_margins = ingredient_data.get("rest_margins", 0)
+        miscellaneous_margins = ingredient_data.get("miscellaneous_margins", 0)
+
+        total_price += product_margin + operations_margin + branding_margin + rest_margins + miscellaneous_margins
+
+        return total_price
+
+    def ingredient_price_by_id(self, ingredient_id: str) -> Optional[float]:
+        """Price of a loaded processed ingredient, None if it does not exist"""
+        ingredient_id = str(ingredient_id)
+        if ingredient_id not in self._ingredient_prices:
+            ingredient = self.ingredients.get(ingredient_id)
+            self._ingredient_prices[ingredient_id] = self.ingredient_price(ingredient) if ingredient else None
+        return self._ingredient_prices[ingredient_id]
+
+    def recipe_price(self, recipe_data: dict) -> float:
+        """Total price for a recipe from its processed ingredients"""
+        total_price = 0.0
+
+        for ingredient in recipe_data.get("ingredients", []):
+            ing_price = self.ingredient_price_by_id(ingredient.get("ingredient_id"))
+            if ing_price is not None:
+                total_price += ing_price * ingredient.get("quantity", 0)
+
+        return total_price
+
+    def recipe_price_by_id(self, recipe_id: str) -> Optional[float]:
+        """Price of a loaded recipe, None if it does not exist"""
+        recipe_id = str(recipe_id)
+        if recipe_id not in self._recipe_prices:
+            recipe = self.recipes.get(recipe_id)
+            self._recipe_prices[recipe_id] = self.recipe_price(recipe) if recipe else None
+        return self._recipe_prices[recipe_id]
+
+    def meal_price(self, meal_data: dict) -> float:
+        """Total price for a meal from its recipes"""
+        total_price = 0.0
+
+        for recipe_ref in meal_data.get("recipes", []):
+            recipe_price = self.recipe_price_by_id(recipe_ref.get("recipe_id"))
+            if recipe_price is not None:
+                total_price += recipe_price * recipe_ref.get("quantity", 1.0)
+
+        return total_price
+
 async def calculate_processed_ingredient_price(ingredient_data: dict) -> float:
     """Calculate price for processed ingredient from source ingredients + margins"""
-    total_price = 0.0
-    
-    for source_ref in ingredient_data.get("source_ingredients", []):
-        source_id = source_ref.get("source_ingredient_id")
-        source_quantity = source_ref.get("source_quantity", 0)
-        
-        # Get source ingredient
-        source = await db.source_ingredients.find_one({"_id": ObjectId(source_id)})
-        if source and source.get("purchases"):
-            # Use latest unit price
-            latest_purchase = source["purchases"][-1]
-            unit_price = latest_purchase.get("unit_price", 0)
-            total_price += unit_price * source_quantity
+    resolver = await PriceResolver.load(ingredients=[ingredient_data])
+    price = resolver.ingredient_price(ingredient_data)
+    if price is None:
+        raise ValueError("Invalid source ingredient id")
+    return price
+
+async def calculate_recipe_price(recipe_data: dict) -> float:
+    """Calculate total price for recipe from processed ingredients"""
+    resolver = await PriceResolver.load(recipes=[recipe_data])
+    return resolver.recipe_price(recipe_data)
+
+async def calculate_meal_price(meal_data: dict) -> float:
+    """Calculate total price for meal from recipes"""
+    resolver = await PriceResolver.load(meals=[meal_data])
+    return resolver.meal_price(meal_data)
+
+# Nutrition calculation helpers
+def _combine_nutrients(values, positions, units, names: list, ref_lists: list):
+    """Aggregate child nutrient rows into parent profiles with one matrix product.
+
+    ref_lists[i] holds (child_row, quantity) pairs for parent i. positions gives the
+    order each nutrient appears in a child's profile (inf when absent) so parents
+    list nutrients in first-seen order, taking the unit of that first occurrence.
+    Returns the parents' (values, positions, units, profiles) so they can be
+    combined again one level up.
+    """
+    n_parents, n_children, n_nutrients = len(ref_lists), values.shape[0], values.shape[1]
+    weights = np.zeros((n_parents, n_children))
+    for parent, refs in enumerate(ref_lists):
+        for row, quantity in refs:
+            weights[parent, row] += quantity
+    totals = weights @ values
+    
+    parent_positions = np.full((n_parents, n_nutrients), np.inf)
+    parent_units = np.empty((n_parents, n_nutrients), dtype=object)
+    profiles = []
+    for parent, refs in enumerate(ref_lists):
+        if not refs:
+            profiles.append([])
+            continue
+        rows = np.array([row for row, _ in refs], dtype=int)
+        block = positions[rows]
+        finite = block[np.isfinite(block)]
+        stride = finite.max() + 1 if finite.size else 1
+        # Rank every nutrient by (first child it appears in, position in that child)
+        first = (block + np.arange(len(rows))[:, None] * stride).min(axis=0)
+        present = np.flatnonzero(np.isfinite(first))
+        ordered = present[np.argsort(first[present], kind="stable")]
+        first_rows = rows[(first[ordered] // stride).astype(int)]
+        parent_positions[parent, ordered] = np.arange(len(ordered))
+        parent_units[parent, ordered] = units[first_rows, ordered]
+        profiles.append([
+            {"name": names[col], "value": float(totals[parent, col]), "unit": parent_units[parent, col]}
+            for col in ordered
+        ])
+    return totals, parent_positions, parent_units, profiles
+
+class NutritionMatrix:
+    """Dense processed ingredient x nutrient matrix built from Ingredient.nutrition_profile.
+
+    Recipes are quantity vectors over the ingredient rows and meals are quantity
+    vectors over recipes, so nutrition for any number of recipes, meals or
+    customized cart items is computed with matrix products instead of one
+    lookup per ingredient. Rows are updated in place when ingredients change.
+    """
+
+    def __init__(self):
+        self.rows = {}  # ingredient id -> row
+        self.columns = {}  # nutrient name -> column
+        self.nutrients = []  # column -> nutrient name
+        self.values = np.zeros((0, 0))
+        self.positions = np.full((0, 0), np.inf)
+        self.units = np.empty((0, 0), dtype=object)
+        self._free_rows = []
+        self.version = None  # catalog replica version the rows were loaded from
+
+    def _resize(self, n_rows: int, n_columns: int):
+        """Grow the backing arrays (geometrically) to hold n_rows x n_columns"""
+        old_rows, old_columns = self.values.shape
+        if n_rows <= old_rows and n_columns <= old_columns:
+            return
+        new_rows = old_rows if n_rows <= old_rows else max(n_rows, 2 * old_rows)
+        new_columns = old_columns if n_columns <= old_columns else max(n_columns, 2 * old_columns)
+        values = np.zeros((new_rows, new_columns))
+        positions = np.full((new_rows, new_columns), np.inf)
+        units = np.empty((new_rows, new_columns), dtype=object)
+        values[:old_rows, :old_columns] = self.values
+        positions[:old_rows, :old_columns] = self.positions
+        units[:old_rows, :old_columns] = self.units
+        self.values, self.positions, self.units = values, positions, units
+
+    def load(self, ingredients: list):
+        """Rebuild the matrix from scratch"""
+        self.__init__()
+        self.upsert_ingredients(ingredients)
+
+    def upsert_ingredients(self, ingredients):
+        """Insert or refresh the rows for the given ingredient documents"""
+        for ingredient in ingredients:
+            profile = ingredient.get("nutrition_profile") or []
+            for entry in profile:
+                if entry.get("name") not in self.columns:
+                    self.columns[entry.get("name")] = len(self.nutrients)
+                    self.nutrients.append(entry.get("name"))
+            
+            ingredient_id = str(ingredient["_id"])
+            row = self.rows.get(ingredient_id)
+            if row is None:
+                row = self._free_rows.pop() if self._free_rows else len(self.rows)
+                self.rows[ingredient_id] = row
+            self._resize(row + 1, len(self.nutrients))
+            
+            self.values[row] = 0.0
+            self.positions[row] = np.inf
+            self.units[row] = None
+            for position, entry in enumerate(profile):
+                column = self.columns[entry.get("name")]
+                self.values[row, column] += entry.get("value", 0)
+                if np.isinf(self.positions[row, column]):
+                    self.positions[row, column] = position
+                    self.units[row, column] = entry.get("unit", "g")
+
+    def remove_ingredients(self, ingredient_ids):
+        """Drop rows for deleted ingredients"""
+        for ingredient_id in ingredient_ids:
+            row = self.rows.pop(str(ingredient_id), None)
+            if row is not None:
+                self.values[row] = 0.0
+                self.positions[row] = np.inf
+                self.units[row] = None
+                self._free_rows.append(row)
+
+    def missing(self, ingredient_ids) -> list:
+        """Ingredient ids that have no row yet"""
+        return [ingredient_id for ingredient_id in ingredient_ids if str(ingredient_id) not in self.rows]
+
+    def _ingredient_refs(self, items: list) -> list:
+        refs = []
+        for item in items:
+            row = self.rows.get(str(item.get("ingredient_id")))
+            if row is not None:
+                refs.append((row, item.get("quantity", 1.0)))
+        return refs
+
+    def recipe_profiles(self, ingredient_lists: list) -> list:
+        """Nutrition profiles for many lists of {ingredient_id, quantity} references at once"""
+        return self._recipe_level(ingredient_lists)[3]
+
+    def _recipe_level(self, ingredient_lists: list):
+        return _combine_nutrients(
+            self.values, self.positions, self.units, self.nutrients,
+            [self._ingredient_refs(items) for items in ingredient_lists]
+        )
+
+    def meal_profiles(self, recipe_lists: list, recipes_by_id: dict) -> list:
+        """Nutrition profiles for many lists of {recipe_id, quantity} references at once"""
+        recipe_ids = list(recipes_by_id)
+        recipe_rows = {recipe_id: row for row, recipe_id in enumerate(recipe_ids)}
+        values, positions, units, _ = self._recipe_level(
+            [recipes_by_id[recipe_id].get("ingredients", []) for recipe_id in recipe_ids]
+        )
+        ref_lists = []
+        for items in recipe_lists:
+            refs = []
+            for item in items:
+                row = recipe_rows.get(str(item.get("recipe_id")))
+                if row is not None:
+                    refs.append((row, item.get("quantity", 1.0)))
+            ref_lists.append(refs)
+        return _combine_nutrients(values, positions, units, self.nutrients, ref_lists)[3]
+
+nutrition_matrix = NutritionMatrix()
+
+async def _load_nutrition_rows(ingredient_ids):
+    """Add matrix rows for any referenced ingredients this process has not seen yet"""
+    # Other processes change ingredients too: reload the rows from the replica
+    # whenever it has moved to a new catalog version
+    if catalog_replica.loaded and nutrition_matrix.version != catalog_replica.version:
+        version = catalog_replica.version
+        nutrition_matrix.load(catalog_replica.docs["ingredients"].values())
+        nutrition_matrix.version = version
+    missing = nutrition_matrix.missing(ingredient_ids)
+    if missing:
+        fetched = await _fetch_by_ids(db.ingredients, missing, {"nutrition_profile": 1})
+        nutrition_matrix.upsert_ingredients(fetched.values())
+
+async def calculate_nutrition_profiles(ingredient_lists: list) -> list:
+    """Calculate nutrition for a batch of ingredient reference lists (e.g. customized cart items)"""
+    await _load_nutrition_rows({
+        str(item.get("ingredient_id")) for items in ingredient_lists for item in items
+    })
+    return nutrition_matrix.recipe_profiles(ingredient_lists)
+
+async def calculate_nutrition_profile(ingredients: list, collection_name: str = "ingredients") -> list:
+    """Calculate aggregated nutrition profile from ingredients/recipes"""
+    if collection_name == "ingredients":
+        return (await calculate_nutrition_profiles([ingredients]))[0]
     
-    # Add margins
-    product_margin = ingredient_data.get("product_margin", 0)
-    operations_margin = ingredient_data.get("operations_margin", 0)
-    branding_margin = ingredient_data.get("branding_margin", 0)
-    rest_margins = ingredient_data.get("rest_margins", 0)
-    miscellaneous_margins = ingredient_data.get("miscellaneous_margins", 0)
+    recipes_by_id = await _fetch_by_ids(db.meals, [item.get("recipe_id") for item in ingredients], {"ingredients": 1})
+    await _load_nutrition_rows({
+        str(item.get("ingredient_id")) for recipe in recipes_by_id.values() for item in recipe.get("ingredients", [])
+    })
+    return nutrition_matrix.meal_profiles([ingredients], recipes_by_id)[0]
+
+
+# Allergens
+# Every processed ingredient stores an allergen_mask derived from its tags, one
+# bit per entry of ALLERGENS (append only: stored masks depend on the order).
+# Recipes OR the masks of their ingredients and meals those of their recipes,
+# maintained with calculated_price on catalog writes, so filtering a list by a
+# user's allergies is one bitwise AND per item.
+ALLERGENS = (
+    "gluten", "dairy", "egg", "peanut", "tree_nut", "soy",
+    "fish", "shellfish", "sesame", "mustard", "celery", "sulphite"
+)
+# Tag and profile wording -> allergen
+ALLERGEN_ALIASES = {
+    "gluten": "gluten", "wheat": "gluten", "barley": "gluten", "rye": "gluten",
+    "celiac": "gluten", "celiac disease": "gluten", "coeliac": "gluten", "coeliac disease": "gluten",
+    "dairy": "dairy", "milk": "dairy", "lactose": "dairy", "lactose intolerance": "dairy",
+    "cheese": "dairy", "paneer": "dairy", "butter": "dairy", "ghee": "dairy", "cream": "dairy",
+    "curd": "dairy", "yogurt": "dairy", "yoghurt": "dairy",
+    "egg": "egg", "eggs": "egg",
+    "peanut": "peanut", "peanuts": "peanut", "groundnut": "peanut", "groundnuts": "peanut",
+    "tree nut": "tree_nut", "tree nuts": "tree_nut", "nut": "tree_nut", "nuts": "tree_nut",
+    "almond": "tree_nut", "almonds": "tree_nut", "cashew": "tree_nut", "cashews": "tree_nut",
+    "walnut": "tree_nut", "walnuts": "tree_nut", "pistachio": "tree_nut", "hazelnut": "tree_nut",
+    "soy": "soy", "soya": "soy", "tofu": "soy",
+    "fish": "fish",
+    "shellfish": "shellfish", "crustacean": "shellfish", "shrimp": "shellfish", "prawn": "shellfish",
+    "prawns": "shellfish", "crab": "shellfish", "lobster": "shellfish",
+    "sesame": "sesame", "mustard": "mustard", "celery": "celery",
+    "sulphite": "sulphite", "sulphites": "sulphite", "sulfite": "sulphite", "sulfites": "sulphite"
+}
+
+def allergen_of(term) -> Optional[str]:
+    """Allergen named by a tag or profile entry ("Contains: Milk" -> dairy), None otherwise"""
+    words = re.sub(r"[^a-z]+", " ", str(term).lower()).split()
+    if "free" in words:
+        # "dairy-free", "gluten free" declare the absence of an allergen
+        return None
+    if words and words[0] in ("contains", "allergen", "allergy"):
+        words = words[1:]
+    if words and words[-1] in ("allergy", "allergies", "allergic"):
+        words = words[:-1]
+    phrase = " ".join(words)
+    key = phrase.replace(" ", "_")
+    return key if key in ALLERGENS else ALLERGEN_ALIASES.get(phrase)
+
+def allergen_mask(terms) -> int:
+    """Bitmask of the allergens named by tags or profile entries; unknown terms are ignored"""
+    mask = 0
+    for term in terms or []:
+        allergen = allergen_of(term)
+        if allergen:
+            mask |= 1 << ALLERGENS.index(allergen)
+    return mask
+
+def allergen_names(mask: int) -> list:
+    return [allergen for bit, allergen in enumerate(ALLERGENS) if mask & (1 << bit)]
+
+def combined_allergen_mask(refs: list, ref_field: str, docs: dict) -> int:
+    """OR of the stored allergen_mask of every document referenced by refs"""
+    mask = 0
+    for ref in refs or []:
+        doc = docs.get(str(ref.get(ref_field)))
+        if doc:
+            mask |= doc.get("allergen_mask") or 0
+    return mask
+
+async def requested_allergen_mask(request: Request, exclude_allergens: Optional[str]) -> int:
+    """Allergens to exclude: a comma-separated exclude_allergens if given (empty
+    for none), otherwise the signed-in user's profile allergies and lifestyle disorders"""
+    if exclude_allergens is not None:
+        terms = [term for term in exclude_allergens.split(",") if term.strip()]
+        unknown = [term for term in terms if not allergen_of(term)]
+        if unknown:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Unknown allergens: {', '.join(unknown)}. Known: {', '.join(ALLERGENS)}"
+            )
+        return allergen_mask(terms)
     
-    total_price += product_margin + operations_margin + branding_margin + rest_margins + miscellaneous_margins
+    user = await get_current_user(request)
+    if not user:
+        return 0
+    profile = user.get("profile") or {}
+    return allergen_mask(list(profile.get("allergies") or []) + list(profile.get("lifestyle_disorders") or []))
+
+# Materialized catalog fields
+# Ingredients, recipes (db.meals) and preset meals (db.preset_meals) store their
+# calculated_price, nutrition_profile and allergen_mask so catalog reads are plain fetches.
+# Writes recompute only the documents downstream of what changed:
+# source ingredient -> processed ingredient -> recipe -> preset meal.
+# Only the materialized fields are written, and reference prices by position,
+# guarded on the references read, so a concurrent edit of a recipe's or meal's
+# references is never overwritten (that edit reprices the document itself).
+# The whole catalog is rebuilt once per MATERIALIZED_CATALOG_REVISION, which is
+# bumped whenever the stored fields or the rules computing them change.
+MATERIALIZED_CATALOG_REVISION = 1
+
+def _materialized_update(doc: dict, refs_field: str, id_field: str, fields: dict) -> UpdateOne:
+    """$set fields and the price of each reference, if the references are still the ones priced"""
+    query, update = {"_id": doc["_id"]}, dict(fields)
+    for position, ref in enumerate(doc.get(refs_field) or []):
+        query[f"{refs_field}.{position}.{id_field}"] = ref.get(id_field)
+        if "price" in ref:
+            update[f"{refs_field}.{position}.price"] = ref["price"]
+    return UpdateOne(query, {"$set": update})
+
+async def _load_with_dependents(collection, ids, linked_field: str = None, linked_ids=None) -> list:
+    """Load documents by id plus every document whose linked_field references linked_ids"""
+    docs = await _fetch_by_ids(collection, ids, {"images": 0})
+    if linked_field and linked_ids:
+        async for doc in collection.find({linked_field: {"$in": list(linked_ids)}}, {"images": 0}):
+            docs[str(doc["_id"])] = doc
+    return list(docs.values())
+
+async def materialize_catalog_fields(ingredients: list, recipes: list, meals: list) -> dict:
+    """Recompute and store calculated_price/nutrition_profile/allergen_mask for the given catalog documents"""
+    resolver = await PriceResolver.load(ingredients=ingredients, recipes=recipes, meals=meals)
+    
+    # Nutrition for every affected recipe and meal in one matrix pass
+    nutrition_matrix.upsert_ingredients(resolver.ingredients.values())
+    recipe_profiles = nutrition_matrix.recipe_profiles([recipe.get("ingredients", []) for recipe in recipes])
+    meal_profiles = nutrition_matrix.meal_profiles([meal.get("recipes", []) for meal in meals], resolver.recipes)
+    
+    ingredient_ops = []
+    for ingredient in ingredients:
+        price = resolver.ingredient_price(ingredient)
+        if price is None:
+            # Keep the legacy stored price when the source references are broken
+            fields = {"calculated_price": ingredient.get("price_per_unit", 0)}
+        else:
+            fields = {"calculated_price": price, "price_per_unit": price}
+        ingredient["allergen_mask"] = fields["allergen_mask"] = allergen_mask(ingredient.get("tags"))
+        fields["allergens"] = allergen_names(ingredient["allergen_mask"])
+        ingredient_ops.append(UpdateOne({"_id": ingredient["_id"]}, {"$set": fields}))
+    if ingredient_ops:
+        await db.ingredients.bulk_write(ingredient_ops, ordered=False)
+    
+    recipe_ops = []
+    for index, recipe in enumerate(recipes):
+        # Refresh ingredient prices with latest calculated prices
+        for ingredient_ref in recipe.get("ingredients", []):
+            calculated_price = resolver.ingredient_price_by_id(ingredient_ref.get("ingredient_id"))
+            if calculated_price is not None:
+                ingredient_ref["price"] = calculated_price
+        recipe["calculated_price"] = resolver.recipe_price(recipe)
+        recipe["nutrition_profile"] = recipe_profiles[index]
+        recipe["allergen_mask"] = combined_allergen_mask(recipe.get("ingredients"), "ingredient_id", resolver.ingredients)
+        recipe_ops.append(_materialized_update(recipe, "ingredients", "ingredient_id", {
+            "calculated_price": recipe["calculated_price"],
+            "nutrition_profile": recipe["nutrition_profile"],
+            "allergen_mask": recipe["allergen_mask"],
+            "allergens": allergen_names(recipe["allergen_mask"])
+        }))
+    if recipe_ops:
+        await db.meals.bulk_write(recipe_ops, ordered=False)
+    
+    meal_ops = []
+    for index, meal in enumerate(meals):
+        # Refresh recipe prices with latest calculated prices
+        for recipe_ref in meal.get("recipes", []):
+            calculated_price = resolver.recipe_price_by_id(recipe_ref.get("recipe_id"))
+            if calculated_price is not None:
+                recipe_ref["price"] = calculated_price
+        meal["calculated_price"] = resolver.meal_price(meal)
+        meal["nutrition_profile"] = meal_profiles[index]
+        meal["allergen_mask"] = combined_allergen_mask(meal.get("recipes"), "recipe_id", resolver.recipes)
+        meal_ops.append(_materialized_update(meal, "recipes", "recipe_id", {
+            "calculated_price": meal["calculated_price"],
+            "nutrition_profile": meal["nutrition_profile"],
+            "allergen_mask": meal["allergen_mask"],
+            "allergens": allergen_names(meal["allergen_mask"])
+        }))
+    if meal_ops:
+        await db.preset_meals.bulk_write(meal_ops, ordered=False)
+    
+    return {"ingredients": len(ingredient_ops), "recipes": len(recipe_ops), "meals": len(meal_ops)}
+
+async def propagate_catalog_change(source_ids=(), ingredient_ids=(), recipe_ids=(), meal_ids=()) -> dict:
+    """Recompute stored prices and nutrition downstream of changed catalog items.
+
+    Returns how many documents were recomputed at each level and how long it took,
+    so admin endpoints can report the write-side cost.
+    """
+    started = time.perf_counter()
+    
+    ingredients = await _load_with_dependents(
+        db.ingredients, ingredient_ids,
+        "source_ingredients.source_ingredient_id", [str(source_id) for source_id in source_ids]
+    )
+    recipes = await _load_with_dependents(
+        db.meals, recipe_ids,
+        "ingredients.ingredient_id", {str(ingredient_id) for ingredient_id in ingredient_ids} | {str(ing["_id"]) for ing in ingredients}
+    )
+    meals = await _load_with_dependents(
+        db.preset_meals, meal_ids,
+        "recipes.recipe_id", {str(recipe_id) for recipe_id in recipe_ids} | {str(recipe["_id"]) for recipe in recipes}
+    )
     
-    return total_price
+    # Requested ids that no longer exist were deleted
+    deleted = {}
+    for kind, requested, docs in (
+        ("ingredients", ingredient_ids, ingredients),
+        ("recipes", recipe_ids, recipes),
+        ("meals", meal_ids, meals)
+    ):
+        loaded_ids = {str(doc["_id"]) for doc in docs}
+        deleted[kind] = [str(item_id) for item_id in requested if str(item_id) not in loaded_ids]
+    # Deleted ingredients no longer contribute nutrition
+    nutrition_matrix.remove_ingredients(deleted["ingredients"])
+    
+    propagation = await materialize_catalog_fields(ingredients, recipes, meals)
+    propagation["catalog_version"] = await record_catalog_change(
+        updated={
+            "source_ingredients": list(source_ids),
+            "ingredients": [ingredient["_id"] for ingredient in ingredients],
+            "recipes": [recipe["_id"] for recipe in recipes],
+            "meals": [meal["_id"] for meal in meals]
+        },
+        deleted=deleted
+    )
+    propagation["duration_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    return propagation
 
-async def calculate_recipe_price(recipe_data: dict) -> float:
-    """Calculate total price for recipe from processed ingredients"""
-    total_price = 0.0
+async def rebuild_materialized_catalog() -> Optional[dict]:
+    """Recompute stored prices and nutrition for the whole catalog, once per revision across all workers.
     
-    for ingredient in recipe_data.get("ingredients", []):
-        ingredient_id = ingredient.get("ingredient_id")
-        quantity = ingredient.get("quantity", 0)
-        
-        # Get processed ingredient and calculate its price
+    Returns None if the catalog is already materialized at this revision.
+    """
+    job_id = f"materialized_catalog_{MATERIALIZED_CATALOG_REVISION}"
+    token = await claim_one_shot(job_id)
+    if token is None:
+        return None
+    started = time.perf_counter()
+    ingredients = await db.ingredients.find({}, {"images": 0}).to_list(None)
+    recipes = await db.meals.find({}, {"images": 0}).to_list(None)
+    meals = await db.preset_meals.find({}, {"images": 0}).to_list(None)
+    nutrition_matrix.load(ingredients)
+    propagation = await materialize_catalog_fields(ingredients, recipes, meals)
+    # Every stored value may have changed, so delta clients must resync fully
+    propagation["catalog_version"] = await record_catalog_change(reset=True)
+    propagation["duration_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    await finish_one_shot(job_id, token)
+    return propagation
+
+async def ensure_catalog_indexes():
+    """Indexes backing catalog list reads and dependency propagation"""
+    await db.ingredients.create_index("source_ingredients.source_ingredient_id")
+    await db.purchase_buckets.create_index([("source_id", 1), ("month", 1)], unique=True)
+    await db.meals.create_index("ingredients.ingredient_id")
+    await db.meals.create_index([("is_preset", 1), ("created_by", 1)])
+    await db.preset_meals.create_index("recipes.recipe_id")
+    await db.preset_meals.create_index([("is_preset", 1), ("created_by", 1)])
+    for collection_name in CATALOG_IMAGE_FIELDS:
+        await db[collection_name].create_index("image_refs.id")
+    await db.saved_recipes.create_index([("user_id", 1), ("created_at", 1)])
+    await db.user_meals.create_index([("user_id", 1), ("created_at", 1)])
+    await migrate_catalog_change_log()
+    await db.catalog_changes.create_index("version", unique=True)
+    await db.catalog_changes.create_index("created_at", expireAfterSeconds=CATALOG_CHANGE_RETENTION_SECONDS)
+
+
+# Catalog versioning
+# Every catalog mutation logs the items it touched in db.catalog_changes as one
+# document per version ({version, changes: [{collection, item_id, op}]}). The
+# writer claims the next version by inserting that document under a unique
+# index, so a version exists exactly when its changes are logged and the log has
+# no holes. The version in db.config is then raised to match; it trails the log
+# at most briefly and is what readers go by. Catalog GET endpoints derive a
+# strong ETag from the version and answer If-None-Match with 304;
+# /catalog/changes replays the log for delta sync.
+CATALOG_CHANGE_RETENTION_SECONDS = 30 * 24 * 60 * 60
+async def get_catalog_version() -> int:
+    """Current catalog version (0 before the first mutation)"""
+    config = await db.config.find_one({"type": "catalog_version"})
+    return config.get("version", 0) if config else 0
+
+async def record_catalog_change(updated: dict = None, deleted: dict = None, reset: bool = False) -> int:
+    """Log a catalog change under the next version and return that version.
+
+    updated/deleted map a collection name ("source_ingredients", "ingredients",
+    "recipes", "meals") to item ids. A reset entry tells delta clients that
+    everything may have changed.
+    """
+    now = datetime.now(timezone.utc)
+    changes = [
+        {"collection": collection, "item_id": str(item_id), "op": op}
+        for op, changed in (("upsert", updated or {}), ("delete", deleted or {}))
+        for collection, item_ids in changed.items()
+        for item_id in item_ids
+    ]
+    if reset:
+        changes.append({"collection": None, "item_id": None, "op": "reset"})
+    while True:
+        latest = await db.catalog_changes.find_one({}, {"version": 1}, sort=[("version", -1)])
+        # The config version covers a fully pruned log
+        version = max(await get_catalog_version(), latest["version"] if latest else 0) + 1
         try:
-            processed_ing = await db.ingredients.find_one({"_id": ObjectId(ingredient_id)})
-            if processed_ing:
-                ing_price = await calculate_processed_ingredient_price(processed_ing)
-                if ing_price is not None:
-                    total_price += ing_price * quantity
-        except Exception:
-            # Skip invalid ingredient IDs
+            await db.catalog_changes.insert_one({"version": version, "changes": changes, "created_at": now})
+            break
+        except DuplicateKeyError:
+            # Another writer claimed this version first
             continue
+    await db.config.update_one(
+        {"type": "catalog_version"},
+        {"$max": {"version": version}, "$set": {"updated_at": now}},
+        upsert=True
+    )
+    await catalog_replica.apply_logged_change(version, updated, deleted, reset)
+    return version
+
+def logged_changes(entries: list):
+    """(version, change) pairs of change log documents, in order"""
+    for entry in entries:
+        for change in entry.get("changes", []):
+            yield entry["version"], change
+
+async def migrate_catalog_change_log():
+    """Replace a change log of one document per item with one document per version.
+    
+    The old entries are dropped and a reset is logged, so delta clients resync once.
+    """
+    if not await db.catalog_changes.find_one({"changes": {"$exists": False}}, {"_id": 1}):
+        return
+    await db.catalog_changes.delete_many({"changes": {"$exists": False}})
+    indexes = await db.catalog_changes.index_information()
+    if "version_1" in indexes and not indexes["version_1"].get("unique"):
+        await db.catalog_changes.drop_index("version_1")
+    await record_catalog_change(reset=True)
+
+async def catalog_etag(request: Request, version: int = None, vary: str = "") -> str:
+    """Strong ETag for a catalog response: catalog version + requested path and query,
+    plus `vary` for responses that also depend on the caller"""
+    if version is None:
+        version = await current_catalog_version()
+    variant = hashlib.sha256(f"{request.url.path}?{request.url.query}#{vary}".encode()).hexdigest()[:16]
+    return f'"{version}-{variant}"'
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Whether the request's If-None-Match already covers this ETag"""
+    if_none_match = request.headers.get("If-None-Match")
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    # If-None-Match uses weak comparison
+    return "*" in candidates or etag in [tag[2:] if tag.startswith("W/") else tag for tag in candidates]
+
+def not_modified_response(etag: str, cache_control: str = "no-cache") -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": cache_control})
+
+def catalog_response(content, etag: str) -> JSONResponse:
+    """JSON response carrying the catalog ETag; clients must revalidate before reuse"""
+    return JSONResponse(content=jsonable_encoder(content), headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+
+
+# Catalog replica
+# The catalog (source ingredients, ingredients, recipes in db.meals, meals in
+# db.preset_meals) is small and read-heavy, so each process keeps a full copy.
+# It is loaded at startup and followed through a change stream; on a standalone
+# mongod, where change streams are unavailable, it polls the catalog version
+# and replays db.catalog_changes instead. Catalog writes made by this process
+# are applied as soon as they are logged, so a client reads its own writes.
+CATALOG_REPLICA_COLLECTIONS = ("source_ingredients", "ingredients", "meals", "preset_meals")
+CATALOG_REPLICA_POLL_SECONDS = float(os.environ.get("CATALOG_REPLICA_POLL_SECONDS", "2"))
+# Change log collection names -> Mongo collections
+CATALOG_CHANGE_COLLECTIONS = {"source_ingredients": "source_ingredients", "ingredients": "ingredients", "recipes": "meals", "meals": "preset_meals"}
+
+class CatalogReplica:
+    """Process-local copy of the catalog collections, keyed by str(_id)"""
+    
+    def __init__(self):
+        self.docs = {name: {} for name in CATALOG_REPLICA_COLLECTIONS}
+        self.version = 0
+        self.loaded = False
+        self.mode = "not_started"
+        self.loaded_at = None
+        self.synced_at = None
+        self.last_event_at = None
+        self.events_applied = 0
+        self.full_reloads = 0
+        self.errors = 0
+        self._task = None
+        self._listeners = []
+    
+    def add_listener(self, callback):
+        """Call callback() whenever the replica moves to a new version"""
+        self._listeners.append(callback)
+    
+    def _set_version(self, version: int):
+        if version != self.version:
+            self.version = version
+            for callback in self._listeners:
+                callback()
+    
+    async def load(self):
+        """Replace the replica with a full read of the catalog"""
+        # Read the version first: changes racing the load are replayed afterwards
+        version = await get_catalog_version()
+        docs = {}
+        for name in CATALOG_REPLICA_COLLECTIONS:
+            docs[name] = {str(doc["_id"]): doc for doc in await db[name].find().to_list(None)}
+        self.docs, self.loaded = docs, True
+        self._set_version(version)
+        self.loaded_at = self.synced_at = datetime.now(timezone.utc)
+        self.full_reloads += 1
+    
+    def get(self, collection_name: str, doc_id) -> Optional[dict]:
+        """Shallow copy of one document, None if unknown"""
+        doc = self.docs[collection_name].get(str(doc_id))
+        return dict(doc) if doc is not None else None
+    
+    def find(self, collection_name: str, predicate=None, exclude: tuple = ()) -> list:
+        """Shallow copies of the documents matching predicate, without the excluded fields"""
+        return [
+            {key: value for key, value in doc.items() if key not in exclude}
+            for doc in self.docs[collection_name].values()
+            if predicate is None or predicate(doc)
+        ]
+    
+    def _upsert(self, collection_name: str, doc: dict):
+        self.docs[collection_name][str(doc["_id"])] = doc
+    
+    def _remove(self, collection_name: str, doc_id):
+        self.docs[collection_name].pop(str(doc_id), None)
     
-    return total_price
+    async def refresh(self, changed: dict, version: Optional[int] = None):
+        """Re-read the given documents ({collection_name: ids}) and advance to version, if given"""
+        for collection_name, ids in changed.items():
+            ids = [str(doc_id) for doc_id in ids]
+            fetched = await _fetch_by_ids(db[collection_name], ids)
+            for doc_id in ids:
+                if doc_id in fetched:
+                    self._upsert(collection_name, fetched[doc_id])
+                else:
+                    self._remove(collection_name, doc_id)
+        if version is not None:
+            self._set_version(max(self.version, version))
+        self.synced_at = datetime.now(timezone.utc)
+    
+    async def apply_logged_change(self, version: int, updated: dict, deleted: dict, reset: bool):
+        """Apply a catalog change this process just logged"""
+        if not self.loaded:
+            return
+        if reset:
+            await self.load()
+            return
+        changed = {}
+        for changes in (updated or {}, deleted or {}):
+            for kind, ids in changes.items():
+                changed.setdefault(CATALOG_CHANGE_COLLECTIONS[kind], []).extend(ids)
+        if version == self.version + 1:
+            await self.refresh(changed, version)
+            return
+        # Other processes changed the catalog in between: replay their changes and
+        # ours from the log, so the version never lags the documents
+        await self.sync_from_change_log()
+        if self.version < version:
+            await self.load()
+    
+    async def sync_from_change_log(self):
+        """Catch up with the catalog by replaying db.catalog_changes"""
+        version = await get_catalog_version()
+        # The log may run briefly ahead of the config version, so read it either way
+        entries = await db.catalog_changes.find({"version": {"$gt": self.version}}).sort("version", 1).to_list(None)
+        if not entries:
+            if version > self.version:
+                # Pruned before this replica saw it
+                await self.load()
+            elif version < self.version and not await db.catalog_changes.find_one({"version": self.version}, {"_id": 1}):
+                # The catalog version went backwards (reset or restored database)
+                await self.load()
+            self.synced_at = datetime.now(timezone.utc)
+            return
+        if any(change["op"] == "reset" for _, change in logged_changes(entries)) or entries[0]["version"] != self.version + 1:
+            # Rebuild or pruned log: start over
+            await self.load()
+            return
+        # Versions are claimed by logging them, so the log has no holes
+        changed = {}
+        for _, change in logged_changes(entries):
+            if change["collection"] in CATALOG_CHANGE_COLLECTIONS:
+                changed.setdefault(CATALOG_CHANGE_COLLECTIONS[change["collection"]], set()).add(change["item_id"])
+        await self.refresh(changed, entries[-1]["version"])
+    
+    def _apply_change_event(self, change: dict):
+        collection_name = change["ns"]["coll"]
+        operation = change["operationType"]
+        if collection_name == "config":
+            config = change.get("fullDocument") or {}
+            if config.get("type") == "catalog_version":
+                self._set_version(max(self.version, config.get("version", 0)))
+        elif operation in ("insert", "update", "replace"):
+            if change.get("fullDocument") is not None:
+                self._upsert(collection_name, change["fullDocument"])
+            else:
+                # Deleted before the update could be looked up
+                self._remove(collection_name, change["documentKey"]["_id"])
+        elif operation == "delete":
+            self._remove(collection_name, change["documentKey"]["_id"])
+        else:
+            raise RuntimeError(f"Catalog change stream ended by {operation}")
+        self.events_applied += 1
+        self.last_event_at = self.synced_at = datetime.now(timezone.utc)
+    
+    async def _follow_change_stream(self):
+        pipeline = [{"$match": {"ns.coll": {"$in": list(CATALOG_REPLICA_COLLECTIONS) + ["config"]}}}]
+        async with db.watch(pipeline, full_document="updateLookup") as stream:
+            self.mode = "change_stream"
+            # Cover whatever changed between the load (or a disconnect) and now
+            await self.sync_from_change_log()
+            async for change in stream:
+                self._apply_change_event(change)
+    
+    async def _run(self):
+        while True:
+            try:
+                await self._follow_change_stream()
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                self.errors += 1
+                if self.mode != "change_stream":
+                    logger.info(f"Catalog change streams unavailable ({error}); polling every {CATALOG_REPLICA_POLL_SECONDS}s")
+                    break
+                logger.warning(f"Catalog change stream interrupted ({error}); reconnecting")
+                self.mode = "reconnecting"
+                await asyncio.sleep(1)
+        
+        self.mode = "polling"
+        while True:
+            try:
+                await self.sync_from_change_log()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.errors += 1
+                logger.exception("Catalog replica poll failed")
+            await asyncio.sleep(CATALOG_REPLICA_POLL_SECONDS)
+    
+    async def start(self):
+        """Load the catalog and start following changes in the background"""
+        await self.load()
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+    
+    def status(self) -> dict:
+        """Freshness metrics"""
+        now = datetime.now(timezone.utc)
+        return {
+            "mode": self.mode,
+            "version": self.version,
+            "documents": {name: len(docs) for name, docs in self.docs.items()},
+            "loaded_at": self.loaded_at,
+            "synced_at": self.synced_at,
+            "seconds_since_sync": (now - self.synced_at).total_seconds() if self.synced_at else None,
+            "last_event_at": self.last_event_at,
+            "events_applied": self.events_applied,
+            "full_reloads": self.full_reloads,
+            "errors": self.errors
+        }
 
-async def calculate_meal_price(meal_data: dict) -> float:
-    """Calculate total price for meal from recipes"""
-    total_price = 0.0
+catalog_replica = CatalogReplica()
+
+async def current_catalog_version() -> int:
+    """Catalog version as served: the replica's once loaded, else the database's"""
+    return catalog_replica.version if catalog_replica.loaded else await get_catalog_version()
+
+
+# Price quotes
+# /price-quote prices customized cart items against a snapshot of the catalog
+# replica, rebuilt whenever the replica's version moves. Processed ingredients
+# and recipes share one "priceable" row space (a customization's ingredient_id
+# names either, as the app puts recipe ids there for combos), so a whole cart
+# becomes one weights matrix: prices are a matrix-vector product and nutrition
+# one _combine_nutrients call.
+PRICE_QUOTE_MAX_ITEMS = 200
+
+class PriceQuoteIndex:
+    """Prices and nutrition of every ingredient, recipe and meal at one catalog version"""
     
-    for recipe_ref in meal_data.get("recipes", []):
-        recipe_id = recipe_ref.get("recipe_id")
-        quantity = recipe_ref.get("quantity", 1.0)
+    def __init__(self, version: int, ingredients: list, recipes: list, meals: list):
+        self.version = version
+        matrix = NutritionMatrix()
+        matrix.upsert_ingredients(ingredients)
+        recipe_values, recipe_positions, recipe_units, _ = matrix._recipe_level(
+            [recipe.get("ingredients", []) for recipe in recipes]
+        )
+        n_ingredient_rows = matrix.values.shape[0]
+        self.nutrients = matrix.nutrients
+        self.values = np.vstack([matrix.values, recipe_values])
+        self.positions = np.vstack([matrix.positions, recipe_positions])
+        self.units = np.vstack([matrix.units, recipe_units])
+        
+        self.rows = dict(matrix.rows)
+        for index, recipe in enumerate(recipes):
+            self.rows[str(recipe["_id"])] = n_ingredient_rows + index
+        self.prices = np.zeros(self.values.shape[0])
+        self.names = {}
+        for doc in ingredients + recipes:
+            doc_id = str(doc["_id"])
+            self.prices[self.rows[doc_id]] = doc.get("calculated_price") or 0.0
+            self.names[doc_id] = doc.get("name", "")
+        self.recipe_ids = {str(recipe["_id"]) for recipe in recipes}
+        self.meals = {str(meal["_id"]): meal for meal in meals}
+    
+    @staticmethod
+    def requested_quantity(value) -> float:
+        """A quantity sent by the client; ValueError unless it is a finite number >= 0"""
+        quantity = float(value or 0)
+        if not np.isfinite(quantity) or quantity < 0:
+            raise ValueError(f"Invalid quantity {value!r}")
+        return quantity
+    
+    def item_refs(self, item: dict) -> tuple:
+        """(row, quantity) pairs for one cart item, plus the ids that matched nothing"""
+        customizations = item.get("customizations") or []
+        if customizations:
+            lines = [
+                (str(line.get("ingredient_id")), self.requested_quantity(line.get("quantity", line.get("default_quantity", 1.0))))
+                for line in customizations
+            ]
+        else:
+            meal_id = str(item.get("meal_id"))
+            meal = self.meals.get(meal_id)
+            if meal is not None:
+                lines = [(str(ref.get("recipe_id")), ref.get("quantity", 1.0)) for ref in meal.get("recipes", [])]
+            else:
+                lines = [(meal_id, 1.0)]
+        refs, unknown = [], []
+        for priceable_id, quantity in lines:
+            row = self.rows.get(priceable_id)
+            if row is None:
+                unknown.append(priceable_id)
+            else:
+                refs.append((row, float(quantity or 0)))
+        return refs, unknown
+    
+    def quote(self, items: list) -> dict:
+        """Authoritative unit/total prices and per-unit nutrition for a batch of cart items"""
+        for item in items:
+            self.requested_quantity(item.get("quantity", 1))
+        ref_lists, unknown_lists = zip(*(self.item_refs(item) for item in items)) if items else ((), ())
+        weights = np.zeros((len(items), len(self.prices)))
+        for index, refs in enumerate(ref_lists):
+            for row, quantity in refs:
+                weights[index, row] += quantity
+        unit_prices = weights @ self.prices
+        profiles = _combine_nutrients(self.values, self.positions, self.units, self.nutrients, list(ref_lists))[3]
         
-        # Get recipe and calculate its price
+        quoted = []
+        for index, item in enumerate(items):
+            quantity = item.get("quantity", 1)
+            customizations = []
+            for line in item.get("customizations") or []:
+                priceable_id = str(line.get("ingredient_id"))
+                row = self.rows.get(priceable_id)
+                customizations.append({
+                    "ingredient_id": priceable_id,
+                    "name": self.names.get(priceable_id, line.get("name", "")),
+                    "price": float(self.prices[row]) if row is not None else None,
+                    "default_quantity": line.get("default_quantity", line.get("quantity", 1.0)),
+                    "quantity": line.get("quantity", line.get("default_quantity", 1.0))
+                })
+            quoted.append({
+                "meal_id": item.get("meal_id"),
+                "quantity": quantity,
+                "unit_price": float(unit_prices[index]),
+                "total_price": float(unit_prices[index]) * quantity,
+                "nutrition_profile": profiles[index],
+                "customizations": customizations,
+                "unknown_ids": unknown_lists[index]
+            })
+        return {
+            "catalog_version": self.version,
+            "items": quoted,
+            "total_price": sum(item["total_price"] for item in quoted)
+        }
+
+price_quote_index: Optional[PriceQuoteIndex] = None
+
+def get_price_quote_index() -> PriceQuoteIndex:
+    """Quote index for the catalog replica's version, rebuilt after catalog changes"""
+    global price_quote_index
+    if price_quote_index is None or price_quote_index.version != catalog_replica.version:
+        price_quote_index = PriceQuoteIndex(
+            catalog_replica.version,
+            catalog_replica.find("ingredients"),
+            catalog_replica.find("meals"),
+            catalog_replica.find("preset_meals")
+        )
+    return price_quote_index
+
+
+# Pricing simulation
+# The catalog's price dependencies as sparse edge lists: source -> processed
+# ingredient (source_quantity), ingredient -> recipe (quantity) and recipe ->
+# meal (quantity). Prices follow the same rules as PriceResolver, so with no
+# overrides the simulated prices equal the materialized ones. Cost and margin
+# columns for the current and simulated inputs travel through the graph
+# together, one np.bincount per column and level.
+MARGIN_FIELDS = ("product_margin", "operations_margin", "branding_margin", "rest_margins", "miscellaneous_margins")
+
+def _sparse_product(edges: tuple, x, n_rows: int):
+    """(n_rows x n_cols sparse matrix given as (rows, cols, weights)) @ x for a 2-d x"""
+    rows, cols, weights = edges
+    contributions = weights[:, None] * x[cols]
+    return np.stack([np.bincount(rows, contributions[:, k], minlength=n_rows) for k in range(x.shape[1])], axis=1)
+
+def _edges(rows: list, cols: list, weights: list) -> tuple:
+    return np.array(rows, dtype=int), np.array(cols, dtype=int), np.array(weights, dtype=float)
+
+class PricingGraph:
+    """Dependency graph of the catalog replica at one version"""
+    
+    def __init__(self, version: int, sources: list, ingredients: list, recipes: list, meals: list):
+        self.version = version
+        self.sources, self.ingredients, self.recipes, self.meals = sources, ingredients, recipes, meals
+        self.source_rows = {str(source["_id"]): row for row, source in enumerate(sources)}
+        self.ingredient_rows = {str(ingredient["_id"]): row for row, ingredient in enumerate(ingredients)}
+        recipe_rows = {str(recipe["_id"]): row for row, recipe in enumerate(recipes)}
+        
+        self.source_prices = np.array([source_unit_price(source) or 0.0 for source in sources], dtype=float)
+        self.margins = np.array([[ingredient.get(field, 0) for field in MARGIN_FIELDS] for ingredient in ingredients], dtype=float).reshape(len(ingredients), len(MARGIN_FIELDS))
+        
+        # Ingredients with a malformed source id have no price and are skipped by recipes
+        self.valid_ingredients = np.ones(len(ingredients), dtype=bool)
+        rows, cols, weights = [], [], []
+        for row, ingredient in enumerate(ingredients):
+            for ref in ingredient.get("source_ingredients", []):
+                source_id = ref.get("source_ingredient_id")
+                if source_id is not None and not ObjectId.is_valid(source_id):
+                    self.valid_ingredients[row] = False
+                elif str(source_id) in self.source_rows:
+                    rows.append(row)
+                    cols.append(self.source_rows[str(source_id)])
+                    weights.append(ref.get("source_quantity", 0))
+        self.ingredient_edges = _edges(rows, cols, weights)
+        
+        rows, cols, weights = [], [], []
+        for row, recipe in enumerate(recipes):
+            for ref in recipe.get("ingredients", []):
+                col = self.ingredient_rows.get(str(ref.get("ingredient_id")))
+                if col is not None and self.valid_ingredients[col]:
+                    rows.append(row)
+                    cols.append(col)
+                    weights.append(ref.get("quantity", 0))
+        self.recipe_edges = _edges(rows, cols, weights)
+        
+        rows, cols, weights = [], [], []
+        for row, meal in enumerate(meals):
+            for ref in meal.get("recipes", []):
+                col = recipe_rows.get(str(ref.get("recipe_id")))
+                if col is not None:
+                    rows.append(row)
+                    cols.append(col)
+                    weights.append(ref.get("quantity", 1.0))
+        self.meal_edges = _edges(rows, cols, weights)
+    
+    def simulate(self, source_prices: dict, margins: dict) -> dict:
+        """Current and simulated (cost, margin) columns for every ingredient, recipe and meal.
+        
+        source_prices maps source ids to unit prices; margins maps ingredient ids
+        (or "*" for all ingredients) to {margin field: value}.
+        """
+        simulated_sources = self.source_prices.copy()
+        for source_id, unit_price in source_prices.items():
+            simulated_sources[self.source_rows[source_id]] = unit_price
+        simulated_margins = self.margins.copy()
+        for field, value in margins.get("*", {}).items():
+            simulated_margins[:, MARGIN_FIELDS.index(field)] = value
+        for ingredient_id, overrides in margins.items():
+            if ingredient_id != "*":
+                for field, value in overrides.items():
+                    simulated_margins[self.ingredient_rows[ingredient_id], MARGIN_FIELDS.index(field)] = value
+        
+        # Columns: current cost, simulated cost, current margin, simulated margin
+        costs = _sparse_product(self.ingredient_edges, np.column_stack([self.source_prices, simulated_sources]), len(self.ingredients))
+        ingredient_values = np.column_stack([costs, self.margins.sum(axis=1), simulated_margins.sum(axis=1)])
+        recipe_values = _sparse_product(self.recipe_edges, ingredient_values, len(self.recipes))
+        meal_values = _sparse_product(self.meal_edges, recipe_values, len(self.meals))
+        return {"ingredients": ingredient_values, "recipes": recipe_values, "meals": meal_values}
+
+pricing_graph: Optional[PricingGraph] = None
+
+def get_pricing_graph() -> PricingGraph:
+    """Pricing graph for the catalog replica's version, rebuilt after catalog changes"""
+    global pricing_graph
+    if pricing_graph is None or pricing_graph.version != catalog_replica.version:
+        pricing_graph = PricingGraph(
+            catalog_replica.version,
+            catalog_replica.find("source_ingredients", exclude=("image",)),
+            catalog_replica.find("ingredients", exclude=("images",)),
+            catalog_replica.find("meals", exclude=("images",)),
+            catalog_replica.find("preset_meals", exclude=("images",))
+        )
+    return pricing_graph
+
+
+# Nutrient search
+# /meals/search filters recipes and meals by nutrient ranges using the
+# materialized nutrition_profile of every item, held as an items x nutrients
+# matrix with one pre-sorted copy per nutrient column. Each range becomes a
+# slice of its sorted column via np.searchsorted; the narrowest slice gives
+# the candidates and the remaining ranges are checked on those rows only.
+NUTRIENT_SEARCH_MAX_LIMIT = 100
+
+def nutrient_key(name: str) -> str:
+    """Query parameter stem for a nutrient name: "Vitamin A" -> "vitamin_a" """
+    return re.sub(r"[^a-z0-9]+", "_", str(name).lower()).strip("_")
+
+class NutrientIndex:
+    """Recipes and meals of the catalog replica at one version, indexed by nutrient values"""
+    
+    def __init__(self, version: int, recipes: list, meals: list):
+        self.version = version
+        self.items = [("recipe", recipe) for recipe in recipes] + [("meal", meal) for meal in meals]
+        self.columns = {}  # nutrient key -> column
+        self.units = {}  # nutrient key -> unit of first occurrence
+        self.names = {}  # nutrient key -> display name
+        for _, doc in self.items:
+            for entry in doc.get("nutrition_profile") or []:
+                key = nutrient_key(entry.get("name"))
+                if key and key not in self.columns:
+                    self.columns[key] = len(self.columns)
+                    self.units[key] = entry.get("unit")
+                    self.names[key] = entry.get("name")
+        
+        self.values = np.zeros((len(self.items), len(self.columns)))
+        for row, (_, doc) in enumerate(self.items):
+            for entry in doc.get("nutrition_profile") or []:
+                key = nutrient_key(entry.get("name"))
+                if key:
+                    self.values[row, self.columns[key]] += entry.get("value", 0)
+        self.prices = np.array([doc.get("calculated_price") or 0.0 for _, doc in self.items], dtype=float)
+        self.kinds = np.array([kind for kind, _ in self.items])
+        self.is_preset = np.array([doc.get("is_preset") is True for _, doc in self.items], dtype=bool)
+        self.owners = np.array([doc.get("created_by") for _, doc in self.items], dtype=object)
+        self.allergen_masks = np.array([doc.get("allergen_mask") or 0 for _, doc in self.items], dtype=np.int64)
+        
+        self.order = np.argsort(self.values, axis=0, kind="stable")
+        self.sorted_values = np.take_along_axis(self.values, self.order, axis=0)
+    
+    def _range_rows(self, column: int, low: float, high: float):
+        """Rows whose value in column lies in [low, high], from the sorted column"""
+        sorted_column = self.sorted_values[:, column]
+        start = np.searchsorted(sorted_column, low, side="left")
+        end = np.searchsorted(sorted_column, high, side="right")
+        return self.order[start:end, column]
+    
+    def search(self, ranges: dict, kinds: tuple, user_id: Optional[str], sort: str, descending: bool, excluded_allergens: int = 0) -> np.ndarray:
+        """Rows matching every {nutrient key or "price": (low, high)} range, visible to user_id
+        and free of excluded_allergens, in sort order"""
+        ranges = dict(ranges)
+        price_low, price_high = ranges.pop("price", (-np.inf, np.inf))
+        if ranges:
+            slices = [
+                self._range_rows(self.columns[key], low, high)
+                for key, (low, high) in ranges.items()
+            ]
+            candidates = np.sort(min(slices, key=len))
+            for key, (low, high) in ranges.items():
+                column = self.values[candidates, self.columns[key]]
+                candidates = candidates[(column >= low) & (column <= high)]
+        else:
+            candidates = np.arange(len(self.items))
+        
+        visible = self.is_preset[candidates]
+        if user_id:
+            visible |= ~self.is_preset[candidates] & (self.owners[candidates] == user_id)
+        prices = self.prices[candidates]
+        visible &= (prices >= price_low) & (prices <= price_high)
+        visible &= (self.allergen_masks[candidates] & excluded_allergens) == 0
+        candidates = candidates[visible & np.isin(self.kinds[candidates], kinds)]
+        
+        keys = self.prices[candidates] if sort == "price" else self.values[candidates, self.columns[sort]]
+        ordered = np.argsort(-keys if descending else keys, kind="stable")
+        return candidates[ordered]
+
+nutrient_index: Optional[NutrientIndex] = None
+
+def get_nutrient_index() -> NutrientIndex:
+    """Nutrient index for the catalog replica's version, rebuilt after catalog changes"""
+    global nutrient_index
+    if nutrient_index is None or nutrient_index.version != catalog_replica.version:
+        nutrient_index = NutrientIndex(
+            catalog_replica.version,
+            catalog_replica.find("meals", exclude=("images",)),
+            catalog_replica.find("preset_meals", exclude=("images",))
+        )
+    return nutrient_index
+
+# Catalog filters
+# Tag, category, visibility and allergen filters on /recipes and /meals run on
+# an inverted index of the catalog replica, rebuilt whenever its version moves.
+# Each key maps to a bitmap of item ordinals, held in a Python int, so filters
+# are AND/OR of ints and facet counts are popcounts of their intersections.
+def filter_terms(value: Optional[str]) -> list:
+    """Comma-separated query parameter as normalized tag/category keys"""
+    return [term.strip().lower() for term in (value or "").split(",") if term.strip()]
+
+def _bitmap_union(bitmaps: dict, keys: list) -> int:
+    bits = 0
+    for key in keys:
+        bits |= bitmaps.get(key, 0)
+    return bits
+
+class CatalogFilterIndex:
+    """Bitmaps over the recipes or meals of the catalog replica at one version"""
+    
+    def __init__(self, version: int, docs: list):
+        self.version = version
+        self.docs = docs
+        self.tags = {}
+        self.categories = {}
+        self.preset = 0
+        self.owners = {}  # created_by -> bitmap of that user's non-preset items
+        self.allergens = [0] * len(ALLERGENS)
+        for ordinal, doc in enumerate(docs):
+            bit = 1 << ordinal
+            for field, bitmaps in (("tags", self.tags), ("categories", self.categories)):
+                for key in {str(term).strip().lower() for term in doc.get(field) or []}:
+                    bitmaps[key] = bitmaps.get(key, 0) | bit
+            if doc.get("is_preset") is True:
+                self.preset |= bit
+            elif doc.get("is_preset") is False and doc.get("created_by"):
+                self.owners[doc["created_by"]] = self.owners.get(doc["created_by"], 0) | bit
+            mask = doc.get("allergen_mask") or 0
+            for allergen in range(len(ALLERGENS)):
+                if mask & (1 << allergen):
+                    self.allergens[allergen] |= bit
+    
+    def select(self, user_id: Optional[str] = None, excluded_allergens: int = 0, tags: list = (),
+               any_tags: list = (), categories: list = (), any_categories: list = ()) -> int:
+        """Bitmap of items visible to user_id, free of excluded_allergens, carrying every
+        tag/category in tags/categories and at least one of any_tags/any_categories"""
+        bits = self.preset
+        if user_id:
+            bits |= self.owners.get(user_id, 0)
+        for key in tags:
+            bits &= self.tags.get(key, 0)
+        for key in categories:
+            bits &= self.categories.get(key, 0)
+        if any_tags:
+            bits &= _bitmap_union(self.tags, any_tags)
+        if any_categories:
+            bits &= _bitmap_union(self.categories, any_categories)
+        for allergen, allergen_bits in enumerate(self.allergens):
+            if excluded_allergens & (1 << allergen):
+                bits &= ~allergen_bits
+        return bits
+    
+    def documents(self, bits: int, exclude: tuple = (), limit: int = None) -> list:
+        """Shallow copies of the selected items in catalog order, without the excluded fields"""
+        docs = []
+        while bits and (limit is None or len(docs) < limit):
+            lowest = bits & -bits
+            doc = self.docs[lowest.bit_length() - 1]
+            docs.append({key: value for key, value in doc.items() if key not in exclude})
+            bits ^= lowest
+        return docs
+    
+    def facet_counts(self, bits: int) -> dict:
+        """Number of selected items per tag and category"""
+        facets = {}
+        for name, bitmaps in (("tags", self.tags), ("categories", self.categories)):
+            counts = {key: (key_bits & bits).bit_count() for key, key_bits in bitmaps.items()}
+            facets[name] = {key: count for key, count in sorted(counts.items(), key=lambda item: (-item[1], item[0])) if count}
+        return facets
+
+catalog_filter_indexes = {}  # collection name -> CatalogFilterIndex
+
+def get_catalog_filter_index(collection_name: str) -> CatalogFilterIndex:
+    """Filter index over recipes ("meals") or meals ("preset_meals") at the replica's version"""
+    index = catalog_filter_indexes.get(collection_name)
+    if index is None or index.version != catalog_replica.version:
+        index = catalog_filter_indexes[collection_name] = CatalogFilterIndex(
+            catalog_replica.version, list(catalog_replica.docs[collection_name].values())
+        )
+    return index
+
+# Catalog suggestions
+# /catalog/suggest ranks ingredients, recipes and meals by trigram similarity of
+# the query to their names and tags, and to each word of those, so a misspelt
+# word still finds a long name. Distinct names, tags and words ("terms") are
+# indexed once with a posting set per trigram, so a lookup touches only terms
+# sharing a trigram with the query, and a typo still leaves most trigrams
+# intact. When the replica's version moves, only documents the replica replaced
+# or dropped since the last sync are re-indexed.
+SUGGEST_KINDS = {"ingredients": "ingredient", "meals": "recipe", "preset_meals": "meal"}
+SUGGEST_MIN_SCORE = 0.4
+SUGGEST_TAG_WEIGHT = 0.8
+SUGGEST_MAX_LIMIT = 50
+
+def normalize_suggest_text(text) -> str:
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", str(text).lower()).split())
+
+def trigrams(text: str) -> set:
+    """Trigrams of normalized text, padded so short prefixes still produce some"""
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class SuggestIndex:
+    """Trigram index over the names and tags of catalog replica documents"""
+    
+    def __init__(self):
+        self.version = None
+        self.docs = {}  # (collection, id) -> indexed document
+        self.doc_terms = {}  # (collection, id) -> [(term, is_name)]
+        self.term_grams = {}  # term -> trigram count
+        self.term_docs = {}  # term -> {(collection, id): is_name}
+        self.postings = {}  # trigram -> terms
+    
+    def _add_term(self, term: str, key: tuple, is_name: bool):
+        if term not in self.term_docs:
+            grams = trigrams(term)
+            self.term_grams[term] = len(grams)
+            self.term_docs[term] = {}
+            for gram in grams:
+                self.postings.setdefault(gram, set()).add(term)
+        # A document whose name is also one of its tags ranks by the name
+        self.term_docs[term][key] = self.term_docs[term].get(key, False) or is_name
+    
+    def _remove_term(self, term: str, key: tuple):
+        docs = self.term_docs.get(term)
+        if docs is None:
+            return
+        docs.pop(key, None)
+        if not docs:
+            for gram in trigrams(term):
+                self.postings[gram].discard(term)
+                if not self.postings[gram]:
+                    del self.postings[gram]
+            del self.term_docs[term]
+            del self.term_grams[term]
+    
+    def add(self, key: tuple, doc: dict):
+        self.remove(key)
+        phrases = [(normalize_suggest_text(doc.get("name", "")), True)]
+        phrases += [(normalize_suggest_text(tag), False) for tag in doc.get("tags") or []]
+        terms = []
+        for phrase, is_name in phrases:
+            words = phrase.split()
+            terms += [(term, is_name) for term in ([phrase] + words if len(words) > 1 else words)]
+        for term, is_name in terms:
+            self._add_term(term, key, is_name)
+        self.docs[key] = doc
+        self.doc_terms[key] = terms
+    
+    def remove(self, key: tuple):
+        for term, _ in self.doc_terms.pop(key, []):
+            self._remove_term(term, key)
+        self.docs.pop(key, None)
+    
+    def sync(self, replica: "CatalogReplica") -> int:
+        """Re-index documents the replica added, replaced or dropped; returns how many"""
+        changed = 0
+        current = set()
+        for collection_name in SUGGEST_KINDS:
+            for doc_id, doc in replica.docs[collection_name].items():
+                key = (collection_name, doc_id)
+                current.add(key)
+                # The replica swaps in a new dict whenever a document changes
+                if self.docs.get(key) is not doc:
+                    self.add(key, doc)
+                    changed += 1
+        for key in [key for key in self.docs if key not in current]:
+            self.remove(key)
+            changed += 1
+        self.version = replica.version
+        return changed
+    
+    def suggest(self, query: str, kinds: tuple, user_id: Optional[str] = None, limit: int = 10) -> list:
+        """(score, collection, document, matched term) for the best matches of query"""
+        query = normalize_suggest_text(query)
+        if not query:
+            return []
+        query_grams = trigrams(query)
+        shared = {}
+        for gram in query_grams:
+            for term in self.postings.get(gram, ()):
+                shared[term] = shared.get(term, 0) + 1
+        
+        best = {}  # (collection, id) -> (score, term)
+        for term, count in shared.items():
+            # Dice coefficient of the trigram sets, boosted for prefix matches
+            score = 2 * count / (len(query_grams) + self.term_grams[term])
+            if term.startswith(query):
+                score += 0.5
+            elif f" {query}" in f" {term}":
+                score += 0.25
+            if score < SUGGEST_MIN_SCORE:
+                continue
+            for key, is_name in self.term_docs[term].items():
+                weighted = score if is_name else score * SUGGEST_TAG_WEIGHT
+                if key[0] in kinds and weighted > best.get(key, (0,))[0]:
+                    best[key] = (weighted, term)
+        
+        results = []
+        for key, (score, term) in sorted(best.items(), key=lambda item: (-item[1][0], item[1][1])):
+            doc = self.docs[key]
+            if key[0] != "ingredients" and not _visible_to(doc, user_id):
+                continue
+            results.append((score, key[0], doc, term))
+            if len(results) >= limit:
+                break
+        return results
+
+suggest_index = SuggestIndex()
+
+def get_suggest_index() -> SuggestIndex:
+    """Suggestion index caught up with the catalog replica"""
+    if suggest_index.version != catalog_replica.version:
+        suggest_index.sync(catalog_replica)
+    return suggest_index
+
+# Similar recipes
+# Every recipe is a vector of its materialized nutrients plus price, each
+# feature standardized across the catalog so calories do not drown out
+# micronutrients. Rows are L2-normalized, making cosine similarity a matrix
+# product; it is computed in row blocks against the preset recipes and only
+# the top SIMILAR_RECIPES_COUNT neighbours per recipe are kept, once per
+# catalog version. The table is rebuilt in the threadpool whenever the replica
+# moves to a new version, and get_recipe keeps reading the previous table until
+# the new one is ready, so recipe detail never pays for the rebuild.
+SIMILAR_RECIPES_COUNT = 5
+SIMILAR_RECIPES_BLOCK_ROWS = 512
+
+class SimilarRecipes:
+    """Nearest preset recipes of every recipe in the catalog replica at one version"""
+    
+    def __init__(self, version: int, recipes: list):
+        self.version = version
+        self.neighbours = {}  # recipe id -> [(recipe id, similarity)]
+        columns = {}
+        for recipe in recipes:
+            for entry in recipe.get("nutrition_profile") or []:
+                columns.setdefault(nutrient_key(entry.get("name")), len(columns))
+        
+        features = np.zeros((len(recipes), len(columns) + 1))
+        for row, recipe in enumerate(recipes):
+            for entry in recipe.get("nutrition_profile") or []:
+                features[row, columns[nutrient_key(entry.get("name"))]] += entry.get("value", 0)
+            features[row, -1] = recipe.get("calculated_price") or 0.0
+        if not len(recipes):
+            return
+        spread = features.std(axis=0)
+        features = (features - features.mean(axis=0)) / np.where(spread > 0, spread, 1.0)
+        norms = np.linalg.norm(features, axis=1, keepdims=True)
+        features /= np.where(norms > 0, norms, 1.0)
+        
+        ids = [str(recipe["_id"]) for recipe in recipes]
+        pool = np.array([row for row, recipe in enumerate(recipes) if recipe.get("is_preset") is True], dtype=int)
+        k = min(SIMILAR_RECIPES_COUNT, len(pool))
+        if k < 1:
+            return
+        for start in range(0, len(recipes), SIMILAR_RECIPES_BLOCK_ROWS):
+            block = np.arange(start, min(start + SIMILAR_RECIPES_BLOCK_ROWS, len(recipes)))
+            similarity = features[block] @ features[pool].T
+            # A recipe is not similar to itself
+            similarity[block[:, None] == pool[None, :]] = -np.inf
+            top = np.argpartition(-similarity, k - 1, axis=1)[:, :k]
+            top_similarity = np.take_along_axis(similarity, top, axis=1)
+            order = np.argsort(-top_similarity, axis=1, kind="stable")
+            top, top_similarity = np.take_along_axis(top, order, axis=1), np.take_along_axis(top_similarity, order, axis=1)
+            for offset, row in enumerate(block):
+                self.neighbours[ids[row]] = [
+                    (ids[pool[column]], float(value))
+                    for column, value in zip(top[offset], top_similarity[offset])
+                    if np.isfinite(value) and value > 0
+                ]
+
+similar_recipes = SimilarRecipes(0, [])
+similar_recipes_task = None
+
+async def rebuild_similar_recipes():
+    """Recompute similar recipes off the event loop until they match the replica's version"""
+    global similar_recipes
+    while similar_recipes.version != catalog_replica.version:
+        version = catalog_replica.version
+        recipes = list(catalog_replica.docs["meals"].values())
+        similar_recipes = await run_in_threadpool(SimilarRecipes, version, recipes)
+
+def schedule_similar_recipes():
+    """Start a rebuild unless one is running; a running rebuild picks up newer versions itself"""
+    global similar_recipes_task
+    if similar_recipes_task is None or similar_recipes_task.done():
+        similar_recipes_task = asyncio.create_task(_run_logged(rebuild_similar_recipes(), "Rebuilding similar recipes"))
+
+def get_similar_recipes() -> SimilarRecipes:
+    """Latest similar recipes table; may trail the replica by one rebuild"""
+    return similar_recipes
+
+catalog_replica.add_listener(schedule_similar_recipes)
+
+# Catalog snapshot
+# /catalog/snapshot returns the public priced catalog (ingredients, preset
+# recipes and meals, without images) in one response for app cold start. Each
+# format/encoding variant is serialized and gzipped once per catalog version,
+# off the event loop, and then served from memory. MessagePack is used when the
+# client asks for it, JSON otherwise.
+SNAPSHOT_MEDIA_TYPES = {"msgpack": "application/msgpack", "json": "application/json"}
+SNAPSHOT_MSGPACK_TYPES = ("application/msgpack", "application/x-msgpack", "application/vnd.msgpack")
+
+def accept_qualities(header: Optional[str]) -> dict:
+    """{value: q} from an Accept or Accept-Encoding header"""
+    qualities = {}
+    for part in (header or "").split(","):
+        value, *params = [token.strip() for token in part.split(";")]
+        if not value:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, number = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(number)
+                except ValueError:
+                    q = 0.0
+        qualities[value.lower()] = q
+    return qualities
+
+def negotiate_snapshot_format(accept: Optional[str]) -> Optional[str]:
+    """"msgpack" if asked for (and at least as preferred as JSON), "json", or None if neither is acceptable"""
+    qualities = accept_qualities(accept)
+    msgpack_q = max(qualities.get(media_type, 0.0) for media_type in SNAPSHOT_MSGPACK_TYPES)
+    # Wildcards select JSON, so only clients that name MessagePack get binary
+    json_q = qualities.get("application/json", qualities.get("application/*", qualities.get("*/*", 0.0 if qualities else 1.0)))
+    if msgpack_q > 0 and msgpack_q >= json_q:
+        return "msgpack"
+    return "json" if json_q > 0 else None
+
+class CatalogSnapshot:
+    """Serialized catalog variants for one catalog version"""
+    
+    def __init__(self, version: int, content: dict):
+        self.version = version
+        self.content = content  # replica documents, encoded on first serialization
+        self.encoded = None
+        self.bodies = {}  # (format, gzip) -> bytes
+        self.lock = asyncio.Lock()
+    
+    def _serialize(self, format: str, compressed: bool) -> bytes:
+        if self.encoded is None:
+            # ObjectIds and datetimes become strings, as in the JSON endpoints
+            self.encoded = jsonable_encoder(self.content, custom_encoder={ObjectId: str})
+        if format == "msgpack":
+            body = msgpack.packb(self.encoded, use_bin_type=True)
+        else:
+            body = json.dumps(self.encoded, separators=(",", ":")).encode()
+        return gzip.compress(body, compresslevel=9) if compressed else body
+    
+    async def body(self, format: str, compressed: bool) -> bytes:
+        key = (format, compressed)
+        if key not in self.bodies:
+            async with self.lock:
+                if key not in self.bodies:
+                    self.bodies[key] = await run_in_threadpool(self._serialize, format, compressed)
+        return self.bodies[key]
+
+catalog_snapshot: Optional[CatalogSnapshot] = None
+
+def get_catalog_snapshot() -> CatalogSnapshot:
+    """Snapshot of the public catalog at the replica's version"""
+    global catalog_snapshot
+    if catalog_snapshot is None or catalog_snapshot.version != catalog_replica.version:
+        public = lambda doc: doc.get("is_preset") is True
+        content = {
+            "version": catalog_replica.version,
+            "ingredients": catalog_replica.find("ingredients", exclude=catalog_hidden_fields("ingredients")),
+            "recipes": catalog_replica.find("meals", public, catalog_hidden_fields("meals")),
+            "meals": catalog_replica.find("preset_meals", public, catalog_hidden_fields("preset_meals"))
+        }
+        # Only shallow copies are taken here; encoding runs with serialization in the threadpool
+        catalog_snapshot = CatalogSnapshot(catalog_replica.version, content)
+    return catalog_snapshot
+
+# Saved items
+# Saved recipes (db.saved_recipes) and saved meals (db.user_meals) store their
+# cover images, recipe summaries and current total_price, computed from the
+# catalog replica when saved and stamped with the catalog version. Listing them
+# is one indexed query; entries stamped with an older version are recomputed
+# from the replica for the response and written back by a background task. The
+# write only replaces fields stamped with an older version, so workers whose
+# replicas trail each other never undo one another's refresh.
+SAVED_COVER_IMAGES = 4
+
+def _first_image_url(doc: dict) -> Optional[str]:
+    refs = doc.get("image_refs") or []
+    return refs[0]["url"] if refs else None
+
+def saved_recipe_fields(saved_recipe: dict, version: int) -> dict:
+    """Cover images (first image of up to four ingredients) and current total_price of a saved recipe"""
+    images, total_price, priced = [], 0.0, False
+    for ingredient_ref in saved_recipe.get("ingredients", []):
+        ingredient = catalog_replica.docs["ingredients"].get(str(ingredient_ref.get("ingredient_id")))
+        if not ingredient:
+            continue
+        image = _first_image_url(ingredient)
+        if image and len(images) < SAVED_COVER_IMAGES:
+            images.append(image)
+        # Same default quantity as PriceResolver.recipe_price
+        total_price += (ingredient.get("calculated_price") or 0) * ingredient_ref.get("quantity", 0)
+        priced = True
+    return {
+        "images": images,
+        # Keep the price sent at save time if none of the ingredients exist any more
+        "total_price": total_price if priced else saved_recipe.get("total_price"),
+        "catalog_version": version
+    }
+
+def saved_meal_fields(saved_meal: dict, version: int) -> dict:
+    """Recipe summaries and current total_price of a saved meal"""
+    enriched_recipes, total_price = [], 0.0
+    for recipe_ref in saved_meal.get("recipes", []):
+        recipe_id = recipe_ref.get("recipe_id")
+        recipe = catalog_replica.docs["meals"].get(str(recipe_id))
+        if not recipe:
+            continue
+        image = _first_image_url(recipe)
+        enriched_recipes.append({
+            "recipe_id": recipe_id,
+            "name": recipe.get("name"),
+            "quantity": recipe_ref.get("quantity", 1),
+            "images": [image] if image else []
+        })
+        total_price += (recipe.get("calculated_price") or 0) * recipe_ref.get("quantity", 1)
+    return {
+        "enriched_recipes": enriched_recipes,
+        "total_price": total_price if enriched_recipes else saved_meal.get("total_price"),
+        "catalog_version": version
+    }
+
+async def list_saved_items(collection, user_id: str, compute_fields) -> list:
+    """A user's saved items, refreshing those computed against an older catalog version"""
+    version = await current_catalog_version()
+    items = await collection.find({"user_id": user_id}).sort("created_at", 1).to_list(100)
+    stale_ops = []
+    for item in items:
+        if item.get("catalog_version") is None or item["catalog_version"] < version:
+            fields = compute_fields(item, version)
+            item.update(fields)
+            stale_ops.append(UpdateOne(
+                {"_id": item["_id"], "$or": [{"catalog_version": {"$lt": version}}, {"catalog_version": None}]},
+                {"$set": fields}
+            ))
+        item["_id"] = str(item["_id"])
+    if stale_ops:
+        run_in_background(collection.bulk_write(stale_ops, ordered=False), f"Refreshing saved items of user {user_id}")
+    return items
+
+
+# One-shot jobs
+# Startup work that must happen once across all workers (data migrations,
+# catalog rebuilds) claims a db.config marker with a fixed _id. The claim is an
+# upsert that only matches an expired, unfinished claim, so a live claim makes
+# it collide on _id. Other workers wait until the job is done rather than
+# serving half-migrated data. The claim is renewed as the job progresses and
+# expires after a crash, letting another worker finish the job.
+ONE_SHOT_LEASE = timedelta(minutes=5)
+ONE_SHOT_POLL_SECONDS = 1
+
+async def claim_one_shot(job_id: str) -> Optional[str]:
+    """Claim a one-shot job for this process; the claim token, or None once the job is done"""
+    token = uuid.uuid4().hex
+    while True:
+        now = datetime.now(timezone.utc)
         try:
-            recipe = await db.meals.find_one({"_id": ObjectId(recipe_id)})
-            if recipe:
-                recipe_price = await calculate_recipe_price(recipe)
-                if recipe_price is not None:
-                    total_price += recipe_price * quantity
-        except Exception:
-            # Skip invalid recipe IDs
+            await db.config.update_one(
+                {"_id": job_id, "done": {"$ne": True}, "claimed_at": {"$lt": now - ONE_SHOT_LEASE}},
+                {"$set": {"type": "one_shot", "owner": token, "claimed_at": now}},
+                upsert=True
+            )
+            return token
+        except DuplicateKeyError:
+            marker = await db.config.find_one({"_id": job_id}, {"done": 1})
+            if marker and marker.get("done"):
+                return None
+        await asyncio.sleep(ONE_SHOT_POLL_SECONDS)
+
+async def renew_one_shot(job_id: str, token: str) -> bool:
+    """Extend a claim; False if it expired and another process took the job over"""
+    result = await db.config.update_one({"_id": job_id, "owner": token}, {"$set": {"claimed_at": datetime.now(timezone.utc)}})
+    return result.matched_count > 0
+
+async def finish_one_shot(job_id: str, token: str):
+    await db.config.update_one({"_id": job_id, "owner": token}, {"$set": {"done": True, "finished_at": datetime.now(timezone.utc)}})
+
+
+# Purchase history
+# Purchases live in db.purchase_buckets, one document per source ingredient per
+# month. The source document carries running aggregates (purchase_count,
+# latest_purchase, latest/lowest/highest_unit_price) updated atomically with
+# $set/$min/$max on every purchase and recomputed from the buckets' own
+# count/min/max when a purchase is deleted, so reads never scan the history.
+PURCHASE_AGGREGATE_FIELDS = ("latest_unit_price", "lowest_unit_price", "highest_unit_price", "latest_purchase")
+# Source cost valuation. "latest" prices at the last purchase; "fifo" at the
+# oldest purchase whose quantity is not yet consumed; "weighted_average" at the
+# quantity-weighted average of the stock still on hand. Non-latest modes are
+# evaluated with NumPy whenever purchases, the mode or consumed_quantity change,
+# and cached on the source as valuation_unit_price. Each bucket keeps the total
+# quantity bought that month, so only the newest months that still hold stock
+# are read: consumption always takes the oldest purchases first.
+VALUATION_MODES = ("latest", "weighted_average", "fifo")
+
+def purchase_month(purchase_date: datetime) -> str:
+    return purchase_date.strftime("%Y-%m")
+
+async def record_purchase(source_id: str, purchase: dict) -> bool:
+    """Append a purchase to its month bucket and fold it into the source aggregates.
+    
+    Returns False if the source ingredient does not exist.
+    """
+    unit_price = purchase["unit_price"]
+    if not await db.source_ingredients.find_one({"_id": ObjectId(source_id)}, {"_id": 1}):
+        return False
+    # History first: if we stop in between, the aggregates can be recomputed from it
+    await db.purchase_buckets.update_one(
+        {"source_id": source_id, "month": purchase_month(purchase["purchase_date"])},
+        {
+            "$push": {"purchases": purchase},
+            "$inc": {"count": 1, "quantity": purchase["purchase_quantity"]},
+            "$min": {"min_unit_price": unit_price},
+            "$max": {"max_unit_price": unit_price}
+        },
+        upsert=True
+    )
+    await db.source_ingredients.update_one(
+        {"_id": ObjectId(source_id)},
+        {
+            "$set": {"latest_unit_price": unit_price, "latest_purchase": purchase},
+            "$min": {"lowest_unit_price": unit_price},
+            "$max": {"highest_unit_price": unit_price},
+            "$inc": {"purchase_count": 1}
+        }
+    )
+    await refresh_source_valuation(source_id)
+    return True
+
+def valuate_purchases(quantities, unit_prices, mode: str, consumed_quantity: float = 0.0) -> Optional[float]:
+    """Unit cost of a purchase history (oldest first) under a valuation mode"""
+    quantities = np.asarray(quantities, dtype=float)
+    unit_prices = np.asarray(unit_prices, dtype=float)
+    if not len(unit_prices):
+        return None
+    if mode == "latest":
+        return float(unit_prices[-1])
+    # Quantity of each purchase left after consuming the oldest ones first
+    remaining = np.clip(np.cumsum(quantities) - consumed_quantity, 0, quantities)
+    on_hand = remaining.sum()
+    if on_hand <= 0:
+        # Everything bought is used up; the next units cost what the last ones did
+        return float(unit_prices[-1])
+    if mode == "fifo":
+        return float(unit_prices[np.argmax(remaining > 0)])
+    return float(remaining @ unit_prices / on_hand)
+
+def source_unit_price(source: dict) -> Optional[float]:
+    """Unit cost of a source ingredient for pricing, None before its first purchase"""
+    if source.get("valuation_unit_price") is not None:
+        return source["valuation_unit_price"]
+    return source.get("latest_unit_price")
+
+async def refresh_source_valuation(source_id: str):
+    """Recompute and cache a source's valuation_unit_price for its valuation mode"""
+    source = await db.source_ingredients.find_one(
+        {"_id": ObjectId(source_id)}, {"valuation_mode": 1, "consumed_quantity": 1}
+    )
+    if not source:
+        return
+    mode = source.get("valuation_mode", "latest")
+    if mode == "latest":
+        # latest_unit_price is already maintained by the purchase aggregates
+        await db.source_ingredients.update_one({"_id": source["_id"]}, {"$unset": {"valuation_unit_price": ""}})
+        return
+    summaries = await db.purchase_buckets.find({"source_id": source_id}, {"quantity": 1}).sort("month", -1).to_list(None)
+    if any(summary.get("quantity") is None for summary in summaries):
+        # Buckets from before quantities were tracked: value the whole history
+        purchases, consumed = await load_purchase_history(source_id), source.get("consumed_quantity", 0.0)
+    else:
+        # Stock on hand is the newest on_hand units; read back until it is covered
+        on_hand = sum(summary["quantity"] for summary in summaries) - source.get("consumed_quantity", 0.0)
+        buckets, covered = [], 0.0
+        for summary in summaries:
+            if covered >= on_hand and buckets:
+                break
+            buckets.append(await db.purchase_buckets.find_one({"_id": summary["_id"]}, {"purchases": 1}))
+            covered += summary["quantity"]
+        purchases = [purchase for bucket in reversed(buckets) if bucket for purchase in bucket.get("purchases", [])]
+        consumed = covered - on_hand
+    unit_price = valuate_purchases(
+        [purchase["purchase_quantity"] for purchase in purchases],
+        [purchase["unit_price"] for purchase in purchases],
+        mode,
+        consumed
+    )
+    await db.source_ingredients.update_one({"_id": source["_id"]}, {"$set": {"valuation_unit_price": unit_price}})
+
+async def refresh_purchase_aggregates(source_id: str):
+    """Recompute a source's running aggregates from its bucket summaries"""
+    buckets = await db.purchase_buckets.find(
+        {"source_id": source_id, "count": {"$gt": 0}},
+        {"month": 1, "count": 1, "min_unit_price": 1, "max_unit_price": 1, "purchases": {"$slice": -1}}
+    ).sort("month", 1).to_list(None)
+    if not buckets:
+        await db.source_ingredients.update_one(
+            {"_id": ObjectId(source_id)},
+            {"$set": {"purchase_count": 0}, "$unset": {field: "" for field in PURCHASE_AGGREGATE_FIELDS + ("valuation_unit_price",)}}
+        )
+        return
+    latest_purchase = buckets[-1]["purchases"][-1]
+    await db.source_ingredients.update_one(
+        {"_id": ObjectId(source_id)},
+        {"$set": {
+            "purchase_count": sum(bucket["count"] for bucket in buckets),
+            "latest_unit_price": latest_purchase["unit_price"],
+            "latest_purchase": latest_purchase,
+            "lowest_unit_price": min(bucket["min_unit_price"] for bucket in buckets),
+            "highest_unit_price": max(bucket["max_unit_price"] for bucket in buckets)
+        }}
+    )
+    await refresh_source_valuation(source_id)
+
+async def load_purchase_history(source_id: str) -> list:
+    """All purchases of a source ingredient, oldest first"""
+    buckets = await db.purchase_buckets.find({"source_id": source_id}).sort("month", 1).to_list(None)
+    return [purchase for bucket in buckets for purchase in bucket.get("purchases", [])]
+
+async def remove_purchase(source_id: str, purchase_id: str) -> bool:
+    """Delete a purchase by purchase_id and repair the aggregates.
+    
+    Returns False if the source has no such purchase.
+    """
+    # $pull by id is atomic, so purchases pushed to the same month concurrently survive
+    bucket = await db.purchase_buckets.find_one_and_update(
+        {"source_id": source_id, "purchases.purchase_id": purchase_id},
+        {"$pull": {"purchases": {"purchase_id": purchase_id}}, "$inc": {"count": -1}},
+        return_document=ReturnDocument.AFTER
+    )
+    if not bucket:
+        return False
+    # Recompute the bucket's min/max from the post-update document; the write only
+    # lands if no purchase was added or removed since that read, otherwise re-read
+    while bucket:
+        purchases = bucket.get("purchases", [])
+        if purchases:
+            unit_prices = [purchase["unit_price"] for purchase in purchases]
+            result = await db.purchase_buckets.update_one(
+                {"_id": bucket["_id"], "count": bucket["count"]},
+                {"$set": {
+                    "min_unit_price": min(unit_prices),
+                    "max_unit_price": max(unit_prices),
+                    "quantity": sum(purchase["purchase_quantity"] for purchase in purchases)
+                }}
+            )
+        else:
+            result = await db.purchase_buckets.delete_one({"_id": bucket["_id"], "count": 0})
+        if (result.matched_count if purchases else result.deleted_count):
+            break
+        bucket = await db.purchase_buckets.find_one({"_id": bucket["_id"]})
+    await refresh_purchase_aggregates(source_id)
+    return True
+
+async def purchase_id_at(source_id: str, purchase_index: int) -> Optional[str]:
+    """purchase_id of the purchase at a position in the oldest-first history"""
+    if purchase_index < 0:
+        return None
+    summaries = await db.purchase_buckets.find({"source_id": source_id}, {"count": 1}).sort("month", 1).to_list(None)
+    for summary in summaries:
+        if purchase_index >= summary["count"]:
+            purchase_index -= summary["count"]
             continue
-    
-    return total_price
+        bucket = await db.purchase_buckets.find_one({"_id": summary["_id"]}, {"purchases": {"$slice": [purchase_index, 1]}})
+        purchases = bucket.get("purchases") if bucket else None
+        return purchases[0].get("purchase_id") if purchases else None
+    return None
+
+async def migrate_embedded_purchases() -> int:
+    """Move purchases still embedded in source ingredient documents into month buckets, once across all workers"""
+    token = await claim_one_shot("purchase_migration")
+    if token is None:
+        return 0
+    migrated = 0
+    async for source in db.source_ingredients.find({"purchases": {"$exists": True}}, {"purchases": 1}):
+        # If the claim expired and another process took over, leave the rest to it
+        if not await renew_one_shot("purchase_migration", token):
+            return migrated
+        source_id = str(source["_id"])
+        buckets = {}
+        for purchase in source.get("purchases") or []:
+            purchase.setdefault("purchase_id", uuid.uuid4().hex)
+            buckets.setdefault(purchase_month(purchase["purchase_date"]), []).append(purchase)
+        # Rebuilding all of a source's buckets keeps an interrupted run safe to repeat
+        await db.purchase_buckets.delete_many({"source_id": source_id})
+        if buckets:
+            await db.purchase_buckets.insert_many([
+                {
+                    "source_id": source_id,
+                    "month": month,
+                    "purchases": purchases,
+                    "count": len(purchases),
+                    "quantity": sum(purchase["purchase_quantity"] for purchase in purchases),
+                    "min_unit_price": min(purchase["unit_price"] for purchase in purchases),
+                    "max_unit_price": max(purchase["unit_price"] for purchase in purchases)
+                }
+                for month, purchases in buckets.items()
+            ])
+        await refresh_purchase_aggregates(source_id)
+        await db.source_ingredients.update_one({"_id": source["_id"]}, {"$unset": {"purchases": ""}})
+        migrated += 1
+    await finish_one_shot("purchase_migration", token)
+    return migrated
+
+
+async def backfill_bucket_quantities() -> int:
+    """Store the purchased quantity on buckets written before it was tracked"""
+    backfilled = 0
+    async for summary in db.purchase_buckets.find({"quantity": {"$exists": False}}, {"_id": 1}):
+        # Guarded by count, so a purchase pushed in between makes us re-read the bucket
+        while True:
+            bucket = await db.purchase_buckets.find_one({"_id": summary["_id"]}, {"count": 1, "purchases.purchase_quantity": 1})
+            if not bucket:
+                break
+            result = await db.purchase_buckets.update_one(
+                {"_id": bucket["_id"], "count": bucket["count"]},
+                {"$set": {"quantity": sum(purchase["purchase_quantity"] for purchase in bucket.get("purchases", []))}}
+            )
+            if result.matched_count:
+                backfilled += 1
+                break
+    return backfilled
+
+
+# Blob storage
+# Binary content (post and message images, pictures, catalog images, guide
+# proof documents) lives in a content-addressed blob store rather than inline
+# base64. A blob id is the SHA-256 of its bytes, so identical uploads are stored
+# once, and documents keep a /api/blobs/{blob_id} URL. db.blobs holds one
+# metadata document per blob, written after the bytes so that a metadata hit
+# always means readable content. Stores implement put(blob_id, data), which
+# treats a blob that already exists (e.g. from a concurrent upload of the same
+# bytes) as stored, and read(blob_id, start, length), None for unknown blobs.
+BLOB_URL_PREFIX = "/api/blobs/"
+BLOB_CACHE_CONTROL = "public, max-age=31536000, immutable"
+BLOB_MIGRATION_BATCH_SIZE = 100
+BLOB_ID_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+class LocalBlobStore:
+    """Blobs as files under a root directory, fanned out by id prefix"""
+    
+    def __init__(self, root):
+        self.root = Path(root)
+    
+    def _path(self, blob_id: str) -> Path:
+        return self.root / blob_id[:2] / blob_id[2:4] / blob_id
+    
+    def _write(self, blob_id: str, data: bytes):
+        path = self._path(blob_id)
+        if path.exists():
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write then rename so readers never see a partial file
+        temporary = path.with_name(f"{blob_id}.{uuid.uuid4().hex}.tmp")
+        temporary.write_bytes(data)
+        os.replace(temporary, path)
+    
+    def _read(self, blob_id: str, start: int, length: int) -> bytes:
+        with open(self._path(blob_id), "rb") as handle:
+            handle.seek(start)
+            return handle.read(length)
+    
+    async def put(self, blob_id: str, data: bytes):
+        await run_in_threadpool(self._write, blob_id, data)
+    
+    async def read(self, blob_id: str, start: int = 0, length: int = -1) -> Optional[bytes]:
+        try:
+            return await run_in_threadpool(self._read, blob_id, start, length)
+        except FileNotFoundError:
+            return None
 
-async def calculate_nutrition_profile(ingredients: list, collection_name: str = "ingredients") -> list:
-    """Calculate aggregated nutrition profile from ingredients/recipes"""
-    nutrition_totals = {}
+class GridFSBlobStore:
+    """Blobs as GridFS files whose _id is the blob id"""
     
-    for item in ingredients:
-        item_id = item.get("ingredient_id") or item.get("recipe_id")
-        quantity = item.get("quantity", 1.0)
-        
-        # Get the ingredient/recipe data
+    def __init__(self, database, bucket_name: str = "blob_data"):
+        self.bucket = AsyncIOMotorGridFSBucket(database, bucket_name=bucket_name)
+    
+    async def put(self, blob_id: str, data: bytes):
         try:
-            if collection_name == "ingredients":
-                data = await db.ingredients.find_one({"_id": ObjectId(item_id)})
-            else:
-                data = await db.meals.find_one({"_id": ObjectId(item_id)})
-        except Exception:
-            # Skip invalid IDs
+            await self.bucket.upload_from_stream_with_id(blob_id, blob_id, data)
+        except (FileExists, DuplicateKeyError):
+            # Same id, same bytes: a concurrent upload of this content got there first
+            pass
+    
+    async def read(self, blob_id: str, start: int = 0, length: int = -1) -> Optional[bytes]:
+        try:
+            grid_out = await self.bucket.open_download_stream(blob_id)
+        except NoFile:
+            # Files stored before blob ids were used as _id are found by name
+            try:
+                grid_out = await self.bucket.open_download_stream_by_name(blob_id)
+            except NoFile:
+                return None
+        grid_out.seek(start)
+        return await grid_out.read(length)
+
+def create_blob_store():
+    """Blob store selected by BLOB_STORE ("gridfs" or "local", with BLOB_STORE_PATH)"""
+    backend = os.environ.get("BLOB_STORE", "gridfs")
+    if backend == "local":
+        return LocalBlobStore(os.environ.get("BLOB_STORE_PATH", ROOT_DIR / "blobs"))
+    if backend == "gridfs":
+        return GridFSBlobStore(db)
+    raise ValueError(f"Unknown BLOB_STORE backend: {backend}")
+
+blob_store = create_blob_store()
+
+def blob_url(blob_id: str) -> str:
+    return f"{BLOB_URL_PREFIX}{blob_id}"
+
+def blob_id_from_url(value) -> Optional[str]:
+    """Blob id referenced by a stored /api/blobs URL, None for anything else"""
+    if isinstance(value, str) and value.startswith(BLOB_URL_PREFIX):
+        blob_id = value[len(BLOB_URL_PREFIX):]
+        if BLOB_ID_PATTERN.match(blob_id):
+            return blob_id
+    return None
+
+def sniff_media_type(data: bytes) -> str:
+    """Media type from well-known file signatures"""
+    signatures = (
+        (b"\x89PNG\r\n\x1a\n", "image/png"),
+        (b"\xff\xd8\xff", "image/jpeg"),
+        (b"GIF8", "image/gif"),
+        (b"%PDF-", "application/pdf"),
+    )
+    for signature, media_type in signatures:
+        if data.startswith(signature):
+            return media_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return "application/octet-stream"
+
+def decode_image_data(value) -> Optional[tuple]:
+    """Split a base64 data URI into (bytes, media_type); None for plain URLs or malformed data"""
+    if not isinstance(value, str) or not value.startswith("data:"):
+        return None
+    header, separator, payload = value.partition(",")
+    if not separator or not header.endswith(";base64"):
+        return None
+    try:
+        data = base64.b64decode(payload)
+    except (binascii.Error, ValueError):
+        return None
+    return data, header[5:-7] or "application/octet-stream"
+
+async def store_blob(data: bytes, media_type: str = None) -> str:
+    """Store bytes once per content and return the blob id"""
+    blob_id = hashlib.sha256(data).hexdigest()
+    if await db.blobs.find_one({"_id": blob_id}, {"_id": 1}) is None:
+        await blob_store.put(blob_id, data)
+        await db.blobs.update_one(
+            {"_id": blob_id},
+            {"$setOnInsert": {
+                "media_type": media_type or sniff_media_type(data),
+                "length": len(data),
+                "created_at": datetime.now(timezone.utc)
+            }},
+            upsert=True
+        )
+    return blob_id
+
+async def read_blob(blob_id: str) -> Optional[tuple]:
+    """Whole blob as (bytes, media_type), None if unknown"""
+    meta = await db.blobs.find_one({"_id": blob_id})
+    if not meta:
+        return None
+    data = await blob_store.read(blob_id)
+    return (data, meta["media_type"]) if data is not None else None
+
+async def externalize_blobs(value, raw_base64: bool = False):
+    """Replace inline base64 (a data URI, or bare base64 when raw_base64) in a
+    string or list of strings with blob URLs; everything else passes through"""
+    if isinstance(value, list):
+        return [await externalize_blobs(item, raw_base64) for item in value]
+    if not isinstance(value, str) or not value or blob_id_from_url(value):
+        return value
+    decoded = decode_image_data(value)
+    if decoded is None and raw_base64:
+        try:
+            decoded = (base64.b64decode(value, validate=True), None)
+        except (binascii.Error, ValueError):
+            return value
+    if decoded is None:
+        return value
+    return blob_url(await store_blob(*decoded))
+
+# Fields holding inline base64 before the blob store existed, per collection.
+# guide_onboarding_requests.proof_document is bare base64 rather than a data URI.
+BLOB_FIELDS = {
+    "posts": ["images", "image", "user_picture"],
+    "messages": ["image", "sender_picture"],
+    "conversations": ["user1_picture", "user2_picture"],
+    "users": ["picture", "profile_picture"],
+    "source_ingredients": ["image"],
+    "ingredients": ["images"],
+    "meals": ["images"],
+    "preset_meals": ["images"],
+    "guide_onboarding_requests": ["proof_document"],
+}
+RAW_BASE64_FIELDS = {("guide_onboarding_requests", "proof_document")}
+CATALOG_CHANGE_KINDS = {"source_ingredients": "source_ingredients", "ingredients": "ingredients", "meals": "recipes", "preset_meals": "meals"}
+
+blob_migration_task: Optional[asyncio.Task] = None
+
+def blob_migration_query(collection_name: str, fields: list) -> dict:
+    """Documents with at least one field still holding inline base64"""
+    clauses = []
+    for field in fields:
+        if (collection_name, field) in RAW_BASE64_FIELDS:
+            clauses.append({field: {"$type": "string", "$not": re.compile(r"^(/api/blobs/|$)")}})
+        else:
+            clauses.append({field: re.compile(r"^data:")})
+    return {"$or": clauses}
+
+async def migrate_blob_fields(batch_size: int = BLOB_MIGRATION_BATCH_SIZE) -> dict:
+    """Move inline base64 fields into the blob store, one bulk write per batch.
+    
+    Progress is checkpointed in db.config after every batch (last _id per
+    collection), so an interrupted migration resumes where it stopped.
+    """
+    state = await db.config.find_one({"type": "blob_migration"})
+    if not state or state.get("status") == "completed":
+        state = {"type": "blob_migration", "collections": {}, "started_at": datetime.now(timezone.utc)}
+    state.pop("_id", None)
+    state["status"] = "running"
+    progress = state["collections"]
+    
+    for collection_name, fields in BLOB_FIELDS.items():
+        entry = progress.setdefault(collection_name, {"last_id": None, "migrated": 0, "done": False})
+        collection = db[collection_name]
+        while not entry["done"]:
+            query = blob_migration_query(collection_name, fields)
+            if entry["last_id"] is not None:
+                query["_id"] = {"$gt": entry["last_id"]}
+            docs = await collection.find(query, {field: 1 for field in fields}).sort("_id", 1).limit(batch_size).to_list(batch_size)
+            
+            operations, migrated_ids = [], []
+            for doc in docs:
+                update = {}
+                for field in fields:
+                    if field in doc:
+                        value = await externalize_blobs(doc[field], (collection_name, field) in RAW_BASE64_FIELDS)
+                        if value != doc[field]:
+                            update[field] = value
+                if update:
+                    operations.append(UpdateOne({"_id": doc["_id"]}, {"$set": update}))
+                    migrated_ids.append(doc["_id"])
+            if operations:
+                await collection.bulk_write(operations, ordered=False)
+                if collection_name in CATALOG_CHANGE_KINDS:
+                    # image_refs ids are content hashes and stay valid, but include_images reads change
+                    await record_catalog_change(updated={CATALOG_CHANGE_KINDS[collection_name]: migrated_ids})
+            
+            entry["migrated"] += len(operations)
+            if docs:
+                entry["last_id"] = docs[-1]["_id"]
+            entry["done"] = len(docs) < batch_size
+            state["updated_at"] = datetime.now(timezone.utc)
+            await db.config.update_one({"type": "blob_migration"}, {"$set": state}, upsert=True)
+    
+    state["status"] = "completed"
+    state["completed_at"] = datetime.now(timezone.utc)
+    await db.config.update_one({"type": "blob_migration"}, {"$set": state}, upsert=True)
+    return state
+
+
+# Catalog images
+# Catalog lists leave out the `images`/`image` fields and return the
+# `image_refs` stored next to them on every write: one {id, url} per image, the
+# id being the SHA-256 of the image bytes (its blob id once in the blob store).
+# /images/{image_id} serves the original or a size-bounded thumbnail from an
+# in-process LRU cache; ids are content addresses, so responses can be cached
+# by clients indefinitely.
+CATALOG_IMAGE_FIELDS = {
+    "source_ingredients": "image",
+    "ingredients": "images",
+    "meals": "images",
+    "preset_meals": "images",
+}
+THUMBNAIL_SIZES = (64, 128, 256, 512)
+IMAGE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+image_cache = LRUCache(maxsize=IMAGE_CACHE_MAX_BYTES, getsizeof=lambda entry: len(entry[0]))
+
+def catalog_image_refs(images) -> list:
+    """References listed in place of a catalog document's images"""
+    if not images:
+        return []
+    if isinstance(images, str):
+        images = [images]
+    refs = []
+    for value in images:
+        image_id = blob_id_from_url(value)
+        if image_id is None:
+            decoded = decode_image_data(value)
+            if decoded is not None:
+                image_id = hashlib.sha256(decoded[0]).hexdigest()
+        if image_id is not None:
+            refs.append({"id": image_id, "url": f"/api/images/{image_id}"})
+        elif isinstance(value, str) and value:
+            # Remote URLs are already cheap to list
+            refs.append({"id": None, "url": value})
+    return refs
+
+def with_image_refs(doc: dict, collection_name: str) -> dict:
+    """Set image_refs on a document about to be written, if it carries images"""
+    field = CATALOG_IMAGE_FIELDS[collection_name]
+    if field in doc:
+        doc["image_refs"] = catalog_image_refs(doc[field])
+    return doc
+
+async def store_catalog_images(doc: dict, collection_name: str) -> dict:
+    """Move a catalog document's inline images to the blob store and set image_refs"""
+    field = CATALOG_IMAGE_FIELDS[collection_name]
+    if field in doc:
+        doc[field] = await externalize_blobs(doc[field])
+    return with_image_refs(doc, collection_name)
+
+def catalog_hidden_fields(collection_name: str, include_images: bool = False) -> tuple:
+    """Fields left out of catalog reads; images are only returned when asked for"""
+    return () if include_images else (CATALOG_IMAGE_FIELDS[collection_name],)
+
+def catalog_projection(collection_name: str, include_images: bool = False) -> Optional[dict]:
+    """Mongo projection equivalent of catalog_hidden_fields"""
+    return {field: 0 for field in catalog_hidden_fields(collection_name, include_images)} or None
+
+async def backfill_image_refs() -> int:
+    """Store image_refs on catalog documents written before they existed"""
+    updated = 0
+    for collection_name, field in CATALOG_IMAGE_FIELDS.items():
+        collection = db[collection_name]
+        docs = await collection.find({"image_refs": {"$exists": False}}, {field: 1}).to_list(None)
+        if docs:
+            await collection.bulk_write([
+                UpdateOne({"_id": doc["_id"]}, {"$set": {"image_refs": catalog_image_refs(doc.get(field))}})
+                for doc in docs
+            ], ordered=False)
+            updated += len(docs)
+    return updated
+
+async def load_catalog_image(image_id: str) -> Optional[tuple]:
+    """Find the original bytes and media type for an image id"""
+    stored = await read_blob(image_id)
+    if stored is not None:
+        return stored
+    # Images not yet moved to the blob store are still inline base64
+    for collection_name, field in CATALOG_IMAGE_FIELDS.items():
+        doc = await db[collection_name].find_one({"image_refs.id": image_id}, {field: 1})
+        if not doc:
             continue
+        images = doc.get(field) or []
+        for value in [images] if isinstance(images, str) else images:
+            decoded = decode_image_data(value)
+            if decoded is not None and hashlib.sha256(decoded[0]).hexdigest() == image_id:
+                return decoded
+    return None
+
+def make_thumbnail(data: bytes, media_type: str, size: int) -> tuple:
+    """Downscale an image to fit in size x size; small or undecodable images are returned as is"""
+    try:
+        image = Image.open(io.BytesIO(data))
+        if image.width <= size and image.height <= size:
+            return data, media_type
+        image.thumbnail((size, size))
+        output = io.BytesIO()
+        if image.mode in ("RGBA", "LA", "P"):
+            image.save(output, format="PNG", optimize=True)
+            return output.getvalue(), "image/png"
+        image.convert("RGB").save(output, format="JPEG", quality=85)
+        return output.getvalue(), "image/jpeg"
+    except (UnidentifiedImageError, OSError, ValueError):
+        return data, media_type
+
+
+# Catalog import
+# /admin/catalog/import takes source ingredients, ingredients, recipes and
+# meals in one JSON document ({kind: [items]}) or one CSV with a `kind` column.
+# Items match existing preset catalog items by name (case-insensitive) and
+# update them, otherwise they are created; references name an item of the
+# import or of the catalog, or give its id. Every row is validated before
+# anything is written, then each kind is upserted with bulk_write in batches
+# and one propagate_catalog_change reprices everything touched. A source's
+# purchase columns add a purchase dated today, unless the source's latest
+# purchase is already that one, so importing the same file twice is harmless.
+IMPORT_BATCH_SIZE = 500
+IMPORT_MAX_ITEMS = 5000
+IMPORT_KINDS = ("source_ingredients", "ingredients", "recipes", "meals")
+# CSV `kind` spellings -> import kind
+IMPORT_KIND_NAMES = {
+    "source": "source_ingredients", "source_ingredient": "source_ingredients", "source_ingredients": "source_ingredients",
+    "ingredient": "ingredients", "ingredients": "ingredients",
+    "recipe": "recipes", "recipes": "recipes",
+    "meal": "meals", "meals": "meals"
+}
+# kind -> (reference list field, referenced kind, id field, quantity field)
+IMPORT_REFERENCES = {
+    "ingredients": ("source_ingredients", "source_ingredients", "source_ingredient_id", "source_quantity"),
+    "recipes": ("ingredients", "ingredients", "ingredient_id", "quantity"),
+    "meals": ("recipes", "recipes", "recipe_id", "quantity")
+}
+IMPORT_NUMBER_FIELDS = ("step_size", "purchase_quantity", "purchase_price", "consumed_quantity") + MARGIN_FIELDS
+IMPORT_LIST_FIELDS = ("tags", "categories", "images")
+# Fields an import may set per kind, with the defaults of the matching create endpoint
+IMPORT_DEFAULTS = {
+    "source_ingredients": {"image": None, "purchase_count": 0, "valuation_mode": "latest", "consumed_quantity": 0.0},
+    "ingredients": {
+        "description": None, "images": [], "tags": [], "source_ingredients": [], "step_size": 1.0, "nutrition_profile": [],
+        **{field: 0.0 for field in MARGIN_FIELDS}
+    },
+    "recipes": {"description": "", "images": [], "ingredients": [], "tags": [], "categories": [], "created_by": "admin", "is_preset": True},
+    "meals": {"description": "", "images": [], "recipes": [], "tags": [], "created_by": "admin", "is_preset": True}
+}
+
+class CatalogImportError(ValueError):
+    pass
+
+def parse_import_csv(text: str) -> dict:
+    """CSV rows -> {kind: [items]}.
+    
+    Lists (tags, categories, images) are "|"-separated; `components` lists
+    references as "Name:quantity|Name:quantity" and `nutrition` entries as
+    "Name:value:unit|...".
+    """
+    payload = {kind: [] for kind in IMPORT_KINDS}
+    for row in csv.DictReader(io.StringIO(text)):
+        item = {key.strip(): value.strip() for key, value in row.items() if key and value is not None and value.strip()}
+        raw_kind = item.pop("kind", "")
+        kind = IMPORT_KIND_NAMES.get(raw_kind.lower(), raw_kind or "(blank)")
+        payload.setdefault(kind, [])
+        for field in IMPORT_LIST_FIELDS:
+            if field in item:
+                item[field] = [value.strip() for value in item[field].split("|") if value.strip()]
+        for field in IMPORT_NUMBER_FIELDS:
+            if field in item:
+                try:
+                    item[field] = float(item[field])
+                except ValueError:
+                    pass  # reported by validation
+        if "nutrition" in item:
+            entries = [entry.split(":") for entry in item.pop("nutrition").split("|") if entry.strip()]
+            item["nutrition_profile"] = [
+                {"name": entry[0].strip(), "value": entry[1].strip() if len(entry) > 1 else None, "unit": entry[2].strip() if len(entry) > 2 else ""}
+                for entry in entries
+            ]
+        if "components" in item and kind in IMPORT_REFERENCES:
+            field, _, _, quantity_field = IMPORT_REFERENCES[kind]
+            refs = []
+            for component in item.pop("components").split("|"):
+                name, _, quantity = component.rpartition(":")
+                refs.append({"name": name.strip(), quantity_field: quantity.strip()} if name else {"name": quantity.strip()})
+            item[field] = refs
+        payload[kind].append(item)
+    return payload
+
+async def read_import_payload(request: Request) -> dict:
+    """{kind: [items]} from a JSON body, a CSV body or a multipart `file` upload"""
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("multipart/form-data"):
+        upload = (await request.form()).get("file")
+        if upload is None or isinstance(upload, str):
+            raise HTTPException(status_code=400, detail="Upload the catalog as a `file` field")
+        data = await upload.read()
+        is_csv = (upload.filename or "").lower().endswith(".csv") or "csv" in (upload.content_type or "")
+    else:
+        data = await request.body()
+        is_csv = "csv" in content_type
+    try:
+        text = data.decode("utf-8-sig")
+        if is_csv:
+            return parse_import_csv(text)
+        payload = json.loads(text)
+    except (UnicodeDecodeError, ValueError, csv.Error) as e:
+        raise HTTPException(status_code=400, detail=f"Could not parse import: {e}")
+    if not isinstance(payload, dict):
+        raise HTTPException(status_code=400, detail="JSON import must be an object of {kind: [items]}")
+    return payload
+
+def _import_number(item: dict, field: str, minimum: float = None) -> Optional[float]:
+    value = item.get(field)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            raise CatalogImportError(f"{field} must be a number")
+    if minimum is not None and value < minimum:
+        raise CatalogImportError(f"{field} must be at least {minimum}")
+    return float(value)
+
+class CatalogImport:
+    """Validated import: per kind, the documents to upsert and what they change"""
+    
+    def __init__(self, payload: dict, existing: dict):
+        self.existing = existing  # kind -> {id: doc}
+        self.errors = []
+        self.ids = {kind: {} for kind in IMPORT_KINDS}  # kind -> {lower name: id}
+        self.docs = {kind: {} for kind in IMPORT_KINDS}  # kind -> {id: doc}, existing then imported
+        self.items = {kind: [] for kind in IMPORT_KINDS}  # kind -> [(id, fields to set, action, changed fields)]
+        self.purchases = {}  # source id -> purchase
+        for kind in IMPORT_KINDS:
+            for doc_id, doc in existing[kind].items():
+                self.docs[kind][doc_id] = doc
+                if kind in ("recipes", "meals") and doc.get("is_preset") is not True:
+                    continue
+                self.ids[kind].setdefault(str(doc.get("name", "")).strip().lower(), doc_id)
         
-        if data and data.get("nutrition_profile"):
-            for nutrition in data["nutrition_profile"]:
-                nutrient_name = nutrition.get("name")
-                nutrient_value = nutrition.get("value", 0)
-                nutrient_unit = nutrition.get("unit", "g")
-                
-                # Aggregate nutrition values
-                if nutrient_name in nutrition_totals:
-                    nutrition_totals[nutrient_name]["value"] += nutrient_value * quantity
+        for kind in payload:
+            if kind not in IMPORT_KINDS:
+                self.errors.append({"kind": kind, "row": None, "error": f"Unknown kind '{kind}'; expected one of {', '.join(IMPORT_KINDS)}"})
+        records = {kind: payload.get(kind) or [] for kind in IMPORT_KINDS}
+        if sum(len(items) for items in records.values() if isinstance(items, list)) > IMPORT_MAX_ITEMS:
+            self.errors.append({"kind": None, "row": None, "error": f"At most {IMPORT_MAX_ITEMS} items per import"})
+            return
+        
+        # Names first, so references may point at any imported item
+        imported = {kind: [] for kind in IMPORT_KINDS}
+        for kind in IMPORT_KINDS:
+            if not isinstance(records[kind], list):
+                self.errors.append({"kind": kind, "row": None, "error": "Expected a list of items"})
+                continue
+            seen = set()
+            for row, item in enumerate(records[kind]):
+                name = str(item.get("name", "")).strip() if isinstance(item, dict) else ""
+                if not name:
+                    self.errors.append({"kind": kind, "row": row, "error": "name is required"})
+                    continue
+                if name.lower() in seen:
+                    self.errors.append({"kind": kind, "row": row, "error": f"Duplicate name '{name}' in import"})
+                    continue
+                seen.add(name.lower())
+                doc_id = self.ids[kind].get(name.lower()) or str(ObjectId())
+                self.ids[kind][name.lower()] = doc_id
+                imported[kind].append((row, doc_id, dict(item, name=name)))
+        
+        # Then documents, in dependency order so references see imported fields
+        for kind in IMPORT_KINDS:
+            for row, doc_id, item in imported[kind]:
+                try:
+                    fields = self._fields(kind, doc_id, item)
+                except CatalogImportError as e:
+                    self.errors.append({"kind": kind, "row": row, "name": item["name"], "error": str(e)})
+                    continue
+                current = self.existing[kind].get(doc_id)
+                if current is None:
+                    action, changes = "create", sorted(fields)
                 else:
-                    nutrition_totals[nutrient_name] = {
-                        "name": nutrient_name,
-                        "value": nutrient_value * quantity,
-                        "unit": nutrient_unit
-                    }
+                    changes = sorted(field for field, value in fields.items() if not self._same(kind, field, current, value))
+                    action = "update" if changes or doc_id in self.purchases else "unchanged"
+                self.docs[kind][doc_id] = {**IMPORT_DEFAULTS[kind], **(current or {}), **fields, "_id": doc_id}
+                self.items[kind].append((doc_id, fields, action, changes))
+    
+    def _resolve(self, kind: str, ref: dict) -> dict:
+        field, target_kind, id_field, _ = IMPORT_REFERENCES[kind]
+        target_id = ref.get(id_field)
+        if target_id is not None:
+            if str(target_id) not in self.docs[target_kind]:
+                raise CatalogImportError(f"{field}: unknown {id_field} '{target_id}'")
+            return self.docs[target_kind][str(target_id)]
+        name = str(ref.get("name", "")).strip()
+        target_id = self.ids[target_kind].get(name.lower())
+        if target_id is None or target_id not in self.docs[target_kind]:
+            raise CatalogImportError(f"{field}: unknown {target_kind.replace('_', ' ')[:-1]} '{name}'")
+        return self.docs[target_kind][target_id]
+    
+    def _references(self, kind: str, refs) -> list:
+        field, _, id_field, quantity_field = IMPORT_REFERENCES[kind]
+        if not isinstance(refs, list) or not all(isinstance(ref, dict) for ref in refs):
+            raise CatalogImportError(f"{field} must be a list of references")
+        resolved = []
+        for ref in refs:
+            target = self._resolve(kind, ref)
+            quantity = _import_number(ref, quantity_field, 0)
+            entry = {id_field: str(target["_id"])}
+            if kind == "ingredients":
+                entry["source_quantity"] = quantity if quantity is not None else 0.0
+            else:
+                entry.update({
+                    "name": target.get("name"),
+                    "quantity": quantity if quantity is not None else 1.0,
+                    "step_size": _import_number(ref, "step_size", 0),
+                    "price": 0.0  # set by the recompute
+                })
+                if kind == "recipes":
+                    entry["unit"] = ref.get("unit") or target.get("unit")
+            resolved.append(entry)
+        return resolved
+    
+    def _fields(self, kind: str, doc_id: str, item: dict) -> dict:
+        """Fields of item to set on the document, validated and with references resolved"""
+        fields = {"name": item["name"]}
+        for field in IMPORT_DEFAULTS[kind]:
+            if field in item and field not in ("purchase_count", "is_preset", "created_by"):
+                fields[field] = item[field]
+        for field in IMPORT_NUMBER_FIELDS:
+            if field in fields:
+                fields[field] = _import_number(fields, field, None if field in MARGIN_FIELDS else 0)
+        for field in IMPORT_LIST_FIELDS:
+            if field in fields and not (isinstance(fields[field], list) and all(isinstance(value, str) for value in fields[field])):
+                raise CatalogImportError(f"{field} must be a list of strings")
+        if kind in ("source_ingredients", "ingredients"):
+            unit = item.get("unit") or (self.existing[kind].get(doc_id) or {}).get("unit")
+            if not unit:
+                raise CatalogImportError("unit is required")
+            fields["unit"] = unit
+        
+        if kind == "source_ingredients":
+            if fields.get("valuation_mode", "latest") not in VALUATION_MODES:
+                raise CatalogImportError(f"valuation_mode must be one of: {', '.join(VALUATION_MODES)}")
+            quantity = _import_number(item, "purchase_quantity", 0)
+            price = _import_number(item, "purchase_price", 0)
+            if (quantity is None) != (price is None) or quantity == 0:
+                raise CatalogImportError("purchase_quantity (> 0) and purchase_price go together")
+            if quantity is not None and not self._repeats_latest_purchase(doc_id, quantity, price):
+                self.purchases[doc_id] = {"purchase_quantity": quantity, "purchase_price": price}
+        if kind == "ingredients" and "nutrition_profile" in fields:
+            entries = fields["nutrition_profile"]
+            if not isinstance(entries, list) or not all(isinstance(entry, dict) and entry.get("name") for entry in entries):
+                raise CatalogImportError("nutrition_profile entries need a name")
+            fields["nutrition_profile"] = [
+                {"name": entry["name"], "value": _import_number(entry, "value") or 0.0, "unit": entry.get("unit", "")}
+                for entry in entries
+            ]
+        if kind in IMPORT_REFERENCES:
+            field = IMPORT_REFERENCES[kind][0]
+            if field in item:
+                fields[field] = self._references(kind, item[field])
+            elif doc_id not in self.existing[kind] and kind != "ingredients":
+                raise CatalogImportError(f"{field} is required")
+        return fields
+    
+    def _repeats_latest_purchase(self, source_id: str, quantity: float, price: float) -> bool:
+        """Whether the source's latest purchase was made today with this quantity and price"""
+        latest = (self.existing["source_ingredients"].get(source_id) or {}).get("latest_purchase")
+        if not latest or not isinstance(latest.get("purchase_date"), datetime):
+            return False
+        return (
+            latest.get("purchase_quantity") == quantity
+            and latest.get("purchase_price") == price
+            and latest["purchase_date"].date() == datetime.now(timezone.utc).date()
+        )
     
-    return list(nutrition_totals.values())
+    @staticmethod
+    def _same(kind: str, field: str, current: dict, value) -> bool:
+        """Whether setting field to value leaves the current document as it is"""
+        if field == CATALOG_IMAGE_FIELDS[CATALOG_CHANGE_COLLECTIONS[kind]]:
+            # Images are loaded as their content-addressed refs
+            return catalog_image_refs(value) == current.get("image_refs", [])
+        if kind in IMPORT_REFERENCES and field == IMPORT_REFERENCES[kind][0]:
+            # References compare by target and quantity; prices are derived
+            _, _, id_field, quantity_field = IMPORT_REFERENCES[kind]
+            key = lambda refs: [(str(ref.get(id_field)), ref.get(quantity_field)) for ref in refs or []]
+            return key(current.get(field)) == key(value)
+        return current.get(field) == value
+    
+    def report(self) -> dict:
+        summary, items = {}, {}
+        for kind in IMPORT_KINDS:
+            summary[kind] = {action: 0 for action in ("create", "update", "unchanged")}
+            items[kind] = []
+            for doc_id, fields, action, changes in self.items[kind]:
+                summary[kind][action] += 1
+                items[kind].append({"id": doc_id, "name": fields["name"], "action": action, "changes": changes})
+        return {"summary": summary, "items": items}
+    
+    async def write(self) -> dict:
+        """Upsert every created or updated document, record purchases and reprice once"""
+        changed = {kind: [] for kind in IMPORT_KINDS}
+        now = datetime.now(timezone.utc)
+        for kind in IMPORT_KINDS:
+            collection_name = CATALOG_CHANGE_COLLECTIONS[kind]
+            ops = []
+            for doc_id, fields, action, _ in self.items[kind]:
+                if action == "unchanged":
+                    continue
+                fields = await store_catalog_images(dict(fields), collection_name)
+                defaults = {
+                    field: value for field, value in {**IMPORT_DEFAULTS[kind], "created_at": now}.items()
+                    if field not in fields
+                }
+                if "image_refs" not in fields:
+                    defaults["image_refs"] = []
+                ops.append(UpdateOne({"_id": ObjectId(doc_id)}, {"$set": fields, "$setOnInsert": defaults}, upsert=True))
+                changed[kind].append(doc_id)
+            for start in range(0, len(ops), IMPORT_BATCH_SIZE):
+                await db[collection_name].bulk_write(ops[start:start + IMPORT_BATCH_SIZE], ordered=False)
+        
+        for source_id, purchase in self.purchases.items():
+            await record_purchase(source_id, {
+                "purchase_id": uuid.uuid4().hex,
+                **purchase,
+                "unit_price": purchase["purchase_price"] / purchase["purchase_quantity"],
+                "purchase_date": now
+            })
+        return await propagate_catalog_change(
+            source_ids=changed["source_ingredients"],
+            ingredient_ids=changed["ingredients"],
+            recipe_ids=changed["recipes"],
+            meal_ids=changed["meals"]
+        )
+
+async def load_import_targets() -> dict:
+    """Current catalog documents by kind and id, without images"""
+    existing = {}
+    for kind in IMPORT_KINDS:
+        collection_name = CATALOG_CHANGE_COLLECTIONS[kind]
+        docs = await db[collection_name].find({}, catalog_projection(collection_name)).to_list(None)
+        existing[kind] = {str(doc["_id"]): doc for doc in docs}
+    return existing
 
 
 # Helper functions
@@ -536,10 +3126,8 @@ async def get_star_config() -> dict:
         }
     return config["config"]
 
-async def calculate_star_rating(points: int) -> int:
-    """Calculate star rating based on total points (earned + inherent)"""
-    config = await get_star_config()
-    
+def star_rating_for(points: int, config: dict) -> int:
+    """Star rating for a points total (earned + inherent) under a star configuration"""
     # Check if we have dynamic star levels (star1, star2, etc.) or just 5 fixed levels
     star_levels = sorted([int(k.replace('star', '')) for k in config.keys() if k.startswith('star')])
     
@@ -551,6 +3139,435 @@ async def calculate_star_rating(points: int) -> int:
     
     return 0
 
+def star_ratings_for(points: np.ndarray, config: dict) -> np.ndarray:
+    """Vectorized star_rating_for over an array of points totals"""
+    star_levels = sorted([int(k.replace('star', '')) for k in config.keys() if k.startswith('star')])
+    if not star_levels:
+        return np.zeros(len(points), dtype=np.int64)
+    levels = np.array(star_levels, dtype=np.int64)
+    # A level is reached from the lowest threshold of it or any level above it,
+    # which makes the thresholds non-decreasing even if the config is not
+    thresholds = np.minimum.accumulate(np.array([config[f"star{level}"] for level in star_levels], dtype=np.float64)[::-1])[::-1]
+    reached = np.searchsorted(thresholds, points, side="right")
+    return np.where(reached > 0, levels[np.maximum(reached - 1, 0)], 0)
+
+# Author cards
+# Posts carry their author's star_rating and picture (user_picture) so the feed
+# needs no user lookups. Whenever either changes on the user, a background task
+# copies the current values onto every post of that user that differs.
+AUTHOR_CARD_FIELDS = {"star_rating": "star_rating", "user_picture": "picture"}  # post field -> user field
+background_tasks = set()
+
+async def _run_logged(coro, description: str):
+    try:
+        await coro
+    except Exception:
+        logger.exception(f"{description} failed")
+
+def run_in_background(coro, description: str):
+    """Run a coroutine off the request path, logging rather than raising its errors"""
+    task = asyncio.create_task(_run_logged(coro, description))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+async def sync_author_cards(user_id: str) -> int:
+    """Copy a user's current star_rating and picture onto their posts; returns how many changed"""
+    user = await db.users.find_one({"_id": ObjectId(user_id)}, {user_field: 1 for user_field in AUTHOR_CARD_FIELDS.values()})
+    if not user:
+        return 0
+    card = {post_field: user.get(user_field) for post_field, user_field in AUTHOR_CARD_FIELDS.items()}
+    card["star_rating"] = card["star_rating"] or 0
+    result = await db.posts.update_many(
+        {"user_id": user_id, "$or": [{field: {"$ne": value}} for field, value in card.items()]},
+        {"$set": card}
+    )
+    return result.modified_count
+
+def schedule_author_card_sync(user_id: str):
+    """Sync a user's author cards in the background, off the request path"""
+    run_in_background(sync_author_cards(user_id), f"Syncing author cards of user {user_id}")
+
+async def backfill_author_cards() -> int:
+    """Embed author cards on posts written before posts carried them"""
+    user_ids = await db.posts.distinct("user_id", {"star_rating": {"$exists": False}})
+    for user_id in user_ids:
+        await sync_author_cards(user_id)
+    return len(user_ids)
+
+async def ensure_post_indexes():
+    """Indexes backing the keyset-paginated feed and author card propagation"""
+    await db.posts.create_index([("created_at", -1), ("_id", -1)])
+    await db.posts.create_index("user_id")
+
+def encode_feed_cursor(post: dict) -> str:
+    return f"{post['created_at'].isoformat()},{post['_id']}"
+
+def feed_cursor_query(before: str, id_field: str = "_id") -> dict:
+    """Query for posts strictly older than a `<created_at>,<_id>` cursor"""
+    created_at, _, post_id = before.rpartition(",")
+    try:
+        created_at = datetime.fromisoformat(created_at)
+        post_id = ObjectId(post_id)
+    except (ValueError, InvalidId):
+        raise HTTPException(status_code=400, detail="before must be <created_at>,<post id> of the last post seen")
+    return {"$or": [
+        {"created_at": {"$lt": created_at}},
+        {"created_at": created_at, id_field: {"$lt": post_id}}
+    ]}
+
+async def feed_page(posts: list, response: Response, last: Optional[dict] = None, viewer: Optional[dict] = None) -> list:
+    """Serialize a page of posts and advertise the cursor after `last` (None on the last page).
+    With a viewer, each post says whether they voted for it."""
+    if last:
+        response.headers["X-Next-Cursor"] = encode_feed_cursor(last)
+    for post in posts:
+        post["_id"] = str(post["_id"])
+    if viewer:
+        voted = await voted_post_ids(viewer["_id"], [post["_id"] for post in posts])
+        for post in posts:
+            post["voted"] = post["_id"] in voted
+    for post in posts:
+        # Author star_rating is embedded on the post; only shown when the author is rated
+        if not post.get("star_rating"):
+            post.pop("star_rating", None)
+    return posts
+
+# Points ledger
+# Every change to a user's points is recorded in db.points_events (user_id,
+# source, delta, created_at, ref) by a single insert on the request path.
+# PointsWorker applies pending events in batches: it claims a batch and adds each
+# user's summed delta to their balance in db.points_balances, guarded by the batch
+# id so a batch replayed after a crash is not counted twice. It then copies the
+# balances onto users.points (a plain $set, safe to repeat), marks the events
+# applied and recomputes star_rating/is_guide for the touched users against the
+# star configuration, read once per batch so every worker sees admin changes
+# right away. The replay guard stays out of the user document.
+POINTS_BATCH_SIZE = 500
+POINTS_WORKER_POLL_SECONDS = float(os.environ.get("POINTS_WORKER_POLL_SECONDS", "5"))
+POINTS_BATCH_HISTORY = 20  # recent batch ids kept on each balance for replay protection
+
+async def record_points(user_id: str, delta: int, source: str, ref: Optional[str] = None, **details):
+    """Append a points event for the worker to apply"""
+    await db.points_events.insert_one({
+        "user_id": user_id, "source": source, "delta": delta, "ref": ref, **details,
+        "created_at": datetime.now(timezone.utc), "batch_id": None, "applied_at": None
+    })
+    points_worker.wake()
+
+class PointsWorker:
+    """Background applier of points events"""
+    
+    def __init__(self):
+        self._task = None
+        self._wakeup = asyncio.Event()
+        self.events_applied = 0
+        self.batches = 0
+        self.ratings_changed = 0
+        self.errors = 0
+        self.last_batch_at = None
+    
+    def wake(self):
+        self._wakeup.set()
+    
+    async def _claim_batch(self) -> tuple:
+        # A batch claimed before a crash is finished first, under its original id
+        pending = await db.points_events.find_one({"batch_id": {"$ne": None}, "applied_at": None}, {"batch_id": 1})
+        if pending:
+            batch_id = pending["batch_id"]
+        else:
+            ids = [event["_id"] for event in await db.points_events.find({"batch_id": None}, {"_id": 1}).sort("_id", 1).limit(POINTS_BATCH_SIZE).to_list(POINTS_BATCH_SIZE)]
+            if not ids:
+                return None, []
+            batch_id = ObjectId()
+            await db.points_events.update_many({"_id": {"$in": ids}, "batch_id": None}, {"$set": {"batch_id": batch_id}})
+        events = await db.points_events.find({"batch_id": batch_id}, {"user_id": 1, "delta": 1}).to_list(None)
+        return batch_id, events
+    
+    async def apply_batch(self) -> int:
+        """Apply one batch of pending events; returns how many events it held"""
+        batch_id, events = await self._claim_batch()
+        if not events:
+            return 0
+        deltas = {}
+        for event in events:
+            deltas[event["user_id"]] = deltas.get(event["user_id"], 0) + event["delta"]
+        user_ids = [ObjectId(user_id) for user_id in deltas if ObjectId.is_valid(user_id)]
+        
+        # Balances start from the points a user had before the ledger
+        known = {balance["_id"] for balance in await db.points_balances.find({"_id": {"$in": user_ids}}, {"_id": 1}).to_list(None)}
+        missing = [user_id for user_id in user_ids if user_id not in known]
+        opening = await db.users.find({"_id": {"$in": missing}}, {"points": 1}).to_list(None) if missing else []
+        if opening:
+            await db.points_balances.bulk_write([
+                UpdateOne({"_id": user["_id"]}, {"$setOnInsert": {"points": user.get("points", 0), "batches": []}}, upsert=True)
+                for user in opening
+            ], ordered=False)
+        await db.points_balances.bulk_write([
+            UpdateOne(
+                {"_id": ObjectId(user_id), "batches": {"$ne": batch_id}},
+                {"$inc": {"points": delta}, "$push": {"batches": {"$each": [batch_id], "$slice": -POINTS_BATCH_HISTORY}}}
+            )
+            for user_id, delta in deltas.items() if ObjectId.is_valid(user_id)
+        ], ordered=False)
+        balances = await db.points_balances.find({"_id": {"$in": user_ids}}, {"points": 1}).to_list(None)
+        if balances:
+            await db.users.bulk_write([
+                UpdateOne({"_id": balance["_id"]}, {"$set": {"points": balance["points"]}}) for balance in balances
+            ], ordered=False)
+        await db.points_events.update_many({"batch_id": batch_id}, {"$set": {"applied_at": datetime.now(timezone.utc)}})
+        
+        config = await get_star_config()
+        users = await db.users.find({"_id": {"$in": user_ids}}, {"points": 1, "inherent_points": 1, "star_rating": 1, "is_guide": 1}).to_list(None)
+        rating_ops = []
+        for user in users:
+            rating = star_rating_for(user.get("points", 0) + user.get("inherent_points", 0), config)
+            if rating != user.get("star_rating", 0) or (rating >= 1) != user.get("is_guide", False):
+                rating_ops.append(UpdateOne({"_id": user["_id"]}, {"$set": {"star_rating": rating, "is_guide": rating >= 1}}))
+                if rating != user.get("star_rating", 0):
+                    schedule_author_card_sync(str(user["_id"]))
+        if rating_ops:
+            await db.users.bulk_write(rating_ops, ordered=False)
+        
+        self.events_applied += len(events)
+        self.batches += 1
+        self.ratings_changed += len(rating_ops)
+        self.last_batch_at = datetime.now(timezone.utc)
+        return len(events)
+    
+    async def drain(self):
+        """Apply every pending event"""
+        while await self.apply_batch():
+            pass
+    
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                await self.drain()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.errors += 1
+                logger.exception("Applying points events failed")
+            # Events inserted by other processes are picked up on the next poll
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), POINTS_WORKER_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+    
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+    
+    async def status(self) -> dict:
+        return {
+            "running": self._task is not None,
+            "pending_events": await db.points_events.count_documents({"applied_at": None}),
+            "events_applied": self.events_applied,
+            "batches": self.batches,
+            "ratings_changed": self.ratings_changed,
+            "last_batch_at": self.last_batch_at,
+            "errors": self.errors
+        }
+
+points_worker = PointsWorker()
+
+# Star re-rating
+# Saving the star configuration starts a job that streams every user's points
+# total, rates them all with star_ratings_for and writes only the users whose
+# rating changed, in batches. A write is skipped if the user's points moved in the
+# meantime; the points worker rates those. Progress is kept in db.rating_jobs.
+RERATE_BATCH_SIZE = 5000
+rerate_task = None
+
+async def rerate_users(job_id: ObjectId, config: dict):
+    """Re-rate every user under a star configuration, recording progress on the job"""
+    scanned = changed = 0
+    
+    async def flush(users: list):
+        nonlocal scanned, changed
+        totals = np.array([user.get("points", 0) + user.get("inherent_points", 0) for user in users], dtype=np.float64)
+        ratings = star_ratings_for(totals, config)
+        ops, moved = [], []
+        for user, rating in zip(users, ratings.tolist()):
+            if rating != user.get("star_rating", 0) or (rating >= 1) != user.get("is_guide", False):
+                ops.append(UpdateOne(
+                    {"_id": user["_id"], "points": user.get("points"), "inherent_points": user.get("inherent_points")},
+                    {"$set": {"star_rating": rating, "is_guide": rating >= 1}}
+                ))
+                if rating != user.get("star_rating", 0):
+                    moved.append(str(user["_id"]))
+        if ops:
+            result = await db.users.bulk_write(ops, ordered=False)
+            changed += result.modified_count
+        for user_id in moved:
+            await sync_author_cards(user_id)
+        scanned += len(users)
+        await db.rating_jobs.update_one({"_id": job_id}, {"$set": {"users_scanned": scanned, "users_changed": changed}})
+    
+    try:
+        users = []
+        projection = {"points": 1, "inherent_points": 1, "star_rating": 1, "is_guide": 1}
+        async for user in db.users.find({}, projection).batch_size(RERATE_BATCH_SIZE):
+            users.append(user)
+            if len(users) == RERATE_BATCH_SIZE:
+                await flush(users)
+                users = []
+        if users:
+            await flush(users)
+        await db.rating_jobs.update_one({"_id": job_id}, {"$set": {"state": "done", "finished_at": datetime.now(timezone.utc)}})
+    except asyncio.CancelledError:
+        await db.rating_jobs.update_one({"_id": job_id}, {"$set": {"state": "superseded", "finished_at": datetime.now(timezone.utc)}})
+        raise
+    except Exception as error:
+        logger.exception(f"Star re-rating job {job_id} failed")
+        await db.rating_jobs.update_one({"_id": job_id}, {"$set": {"state": "failed", "error": str(error), "finished_at": datetime.now(timezone.utc)}})
+
+async def start_rerate_job(config: dict) -> str:
+    """Start re-rating all users, superseding a job still running in this process"""
+    global rerate_task
+    if rerate_task and not rerate_task.done():
+        rerate_task.cancel()
+    job = {
+        "state": "running", "config": config, "users_total": await db.users.estimated_document_count(),
+        "users_scanned": 0, "users_changed": 0, "started_at": datetime.now(timezone.utc), "finished_at": None
+    }
+    job_id = (await db.rating_jobs.insert_one(job)).inserted_id
+    rerate_task = asyncio.create_task(rerate_users(job_id, config))
+    return str(job_id)
+
+async def ensure_points_indexes():
+    """Pending-event scans and per-user history"""
+    await db.points_events.create_index([("batch_id", 1), ("applied_at", 1)])
+    await db.points_events.create_index([("user_id", 1), ("created_at", -1)])
+    # Replay guards once kept on users; they broke JSON encoding of user documents
+    await db.users.update_many({"points_batches": {"$exists": True}}, {"$unset": {"points_batches": ""}})
+
+# Home timelines
+# Each user's home feed is materialized in db.timelines as one small entry per
+# post (user_id, post_id, author_id, created_at), written when an idol posts
+# (fan-out on write), so a page is one range read on (user_id, created_at, post_id).
+# Authors with more than TIMELINE_FANOUT_MAX_FANS fans are not fanned out; their
+# posts are read from db.posts when a fan's page is served (fan-out on read) and
+# merged in. Timelines only cover posts of the last TIMELINE_RETENTION_DAYS
+# (older entries expire, and becoming a fan copies in the idol's posts of that
+# window), so pages reaching further back read the older posts from db.posts.
+TIMELINE_FANOUT_MAX_FANS = 5000
+TIMELINE_FANOUT_BATCH = 1000
+TIMELINE_RETENTION_DAYS = 60
+
+def timeline_horizon() -> datetime:
+    """Oldest created_at still covered by timelines"""
+    return datetime.now(timezone.utc) - timedelta(days=TIMELINE_RETENTION_DAYS)
+
+def timeline_entry(user_id: str, post: dict) -> dict:
+    return {"user_id": user_id, "post_id": post["_id"], "author_id": post["user_id"], "created_at": post["created_at"]}
+
+async def write_timeline_entries(entries: list):
+    """Upsert timeline entries in batches; safe to repeat"""
+    for start in range(0, len(entries), TIMELINE_FANOUT_BATCH):
+        await db.timelines.bulk_write([
+            UpdateOne({"user_id": entry["user_id"], "post_id": entry["post_id"]}, {"$setOnInsert": entry}, upsert=True)
+            for entry in entries[start:start + TIMELINE_FANOUT_BATCH]
+        ], ordered=False)
+
+def is_large_account(user: dict) -> bool:
+    return len(user.get("fans", [])) > TIMELINE_FANOUT_MAX_FANS
+
+async def fan_out_post(post: dict):
+    """Write a new post into its author's and their fans' timelines"""
+    author = await db.users.find_one({"_id": ObjectId(post["user_id"])}, {"fans": 1})
+    if not author:
+        return
+    # The author always sees their own posts; fans of large accounts read them at serve time
+    readers = [post["user_id"]] if is_large_account(author) else [post["user_id"], *author.get("fans", [])]
+    await write_timeline_entries([timeline_entry(reader, post) for reader in readers])
+
+async def backfill_timeline(user_id: str, idol_id: str):
+    """Copy an idol's posts within the timeline window into a new fan's timeline"""
+    idol = await db.users.find_one({"_id": ObjectId(idol_id)}, {"fans": 1})
+    if not idol or (idol_id != user_id and is_large_account(idol)):
+        return
+    posts = await db.posts.find(
+        {"user_id": idol_id, "created_at": {"$gte": timeline_horizon()}}, {"user_id": 1, "created_at": 1}
+    ).to_list(None)
+    await write_timeline_entries([timeline_entry(user_id, post) for post in posts])
+
+async def seed_timelines():
+    """Build timelines from existing fan relationships once, resuming after a restart.
+    
+    Progress is kept in db.config as the last user seeded; backfills are upserts,
+    so redoing the user that was in progress is harmless.
+    """
+    progress = await db.config.find_one({"type": "timeline_seed"}) or {}
+    if progress.get("done"):
+        return
+    query = {"_id": {"$gt": progress["after"]}} if progress.get("after") else {}
+    async for user in db.users.find(query, {"idols": 1}).sort("_id", 1):
+        user_id = str(user["_id"])
+        for idol_id in [user_id, *user.get("idols", [])]:
+            await backfill_timeline(user_id, idol_id)
+        await db.config.update_one({"type": "timeline_seed"}, {"$set": {"after": user["_id"]}}, upsert=True)
+    await db.config.update_one({"type": "timeline_seed"}, {"$set": {"done": True}}, upsert=True)
+
+# Post votes
+# One document per (post_id, user_id) in db.post_votes, kept unique by index, with
+# the count denormalized on the post as vote_ups. Toggling deletes the vote or,
+# if there was none, inserts it; only the request whose delete or insert actually
+# succeeds moves vote_ups, so concurrent double-votes cannot skew the count.
+async def toggle_vote(post_id: str, user_id: str) -> Optional[bool]:
+    """Flip a user's vote on a post; returns the new state, or None if a concurrent
+    request already cast the same vote"""
+    if await db.post_votes.find_one_and_delete({"post_id": post_id, "user_id": user_id}):
+        await db.posts.update_one({"_id": ObjectId(post_id)}, {"$inc": {"vote_ups": -1}})
+        return False
+    try:
+        await db.post_votes.insert_one({"post_id": post_id, "user_id": user_id, "created_at": datetime.now(timezone.utc)})
+    except DuplicateKeyError:
+        return None
+    await db.posts.update_one({"_id": ObjectId(post_id)}, {"$inc": {"vote_ups": 1}})
+    return True
+
+async def voted_post_ids(user_id: str, post_ids: list) -> set:
+    """Which of these posts the user has voted for, in one query"""
+    if not post_ids:
+        return set()
+    votes = await db.post_votes.find({"post_id": {"$in": post_ids}, "user_id": user_id}, {"post_id": 1, "_id": 0}).to_list(None)
+    return {vote["post_id"] for vote in votes}
+
+async def migrate_voted_by() -> int:
+    """Move votes from the old per-post voted_by arrays into db.post_votes"""
+    migrated = 0
+    async for post in db.posts.find({"voted_by": {"$exists": True}}, {"voted_by": 1, "created_at": 1}):
+        post_id = str(post["_id"])
+        voters = list(dict.fromkeys(post.get("voted_by") or []))
+        if voters:
+            await db.post_votes.bulk_write([
+                UpdateOne({"post_id": post_id, "user_id": voter},
+                          {"$setOnInsert": {"post_id": post_id, "user_id": voter, "created_at": post.get("created_at")}}, upsert=True)
+                for voter in voters
+            ], ordered=False)
+        vote_ups = await db.post_votes.count_documents({"post_id": post_id})
+        await db.posts.update_one({"_id": post["_id"]}, {"$set": {"vote_ups": vote_ups}, "$unset": {"voted_by": ""}})
+        migrated += 1
+    return migrated
+
+async def ensure_timeline_indexes():
+    """Indexes for timeline range reads, idempotent fan-out and expiry"""
+    await db.timelines.create_index([("user_id", 1), ("created_at", -1), ("post_id", -1)])
+    await db.timelines.create_index([("user_id", 1), ("post_id", 1)], unique=True)
+    await db.timelines.create_index("post_id")
+    await db.timelines.create_index("created_at", expireAfterSeconds=TIMELINE_RETENTION_DAYS * 86400)
+
+async def ensure_vote_indexes():
+    """One vote per user per post; voters of a post newest first"""
+    await db.post_votes.create_index([("post_id", 1), ("user_id", 1)], unique=True)
+    await db.post_votes.create_index([("post_id", 1), ("created_at", -1)])
+
 
 async def get_commission_config() -> dict:
     """Get commission rate configuration from database"""
@@ -697,6 +3714,11 @@ async def get_session_data(request: Request):
         else:
             user_id = str(user["_id"])
             logger.info(f"Existing user found with id: {user_id}")
+            picture = data.get("picture")
+            if picture and picture != user.get("picture"):
+                # Keep the Google picture current, on the user and on their posts
+                await db.users.update_one({"_id": user["_id"]}, {"$set": {"picture": picture}})
+                schedule_author_card_sync(user_id)
         
         # Create session
         session_token = data["session_token"]
@@ -866,9 +3888,8 @@ async def submit_guide_onboarding(
         if len(contents) > 5 * 1024 * 1024:
             raise HTTPException(status_code=400, detail="File size must be less than 5MB")
         
-        # Store as base64 in database (or save to filesystem)
-        import base64
-        proof_doc_path = base64.b64encode(contents).decode('utf-8')
+        # Store in the blob store; the request keeps its URL
+        proof_doc_path = blob_url(await store_blob(contents, proof_document.content_type))
     
     # Create onboarding request
     onboarding_request = {
@@ -943,6 +3964,7 @@ async def become_fan(user_id: str, request: Request):
         {"_id": ObjectId(user_id)},
         {"$addToSet": {"fans": current_user["_id"]}}
     )
+    run_in_background(backfill_timeline(current_user["_id"], user_id), f"Backfilling timeline of user {current_user['_id']}")
     
     # Create notification for the idol
     notification = Notification(
@@ -974,6 +3996,7 @@ async def unfan(user_id: str, request: Request):
         {"_id": ObjectId(user_id)},
         {"$pull": {"fans": current_user["_id"]}}
     )
+    await db.timelines.delete_many({"user_id": current_user["_id"], "author_id": user_id})
     
     return {"message": "Unfanned successfully"}
 
@@ -992,52 +4015,94 @@ async def create_post(post_data: dict, request: Request):
     # Backward compatibility: if single image provided, add to images array
     if single_image and single_image not in images:
         images = [single_image] + images
+    images = await externalize_blobs(images)
     
     post = Post(
         user_id=user["_id"],
         user_name=user["name"],
         user_picture=user.get("picture"),
+        star_rating=user.get("star_rating", 0),
         content=post_data["content"],
         image=images[0] if images else None,  # Keep first image for backward compatibility
         images=images
     )
     
-    result = await db.posts.insert_one(post.dict())
+    post_doc = post.dict()
+    result = await db.posts.insert_one(post_doc)
+    run_in_background(fan_out_post(post_doc), f"Fanning out post {result.inserted_id}")
     
     # Award points for posting
-    await db.users.update_one(
-        {"_id": ObjectId(user["_id"])},
-        {"$inc": {"points": 5}}
-    )
-    
-    # Update star rating
-    updated_user = await db.users.find_one({"_id": ObjectId(user["_id"])})
-    total_points = updated_user.get("points", 0) + updated_user.get("inherent_points", 0)
-    new_rating = await calculate_star_rating(total_points)
-    is_guide = new_rating >= 1
-    
-    await db.users.update_one(
-        {"_id": ObjectId(user["_id"])},
-        {"$set": {"star_rating": new_rating, "is_guide": is_guide}}
-    )
+    await record_points(user["_id"], 5, "post_created", str(result.inserted_id))
     
     return {"message": "Post created", "id": str(result.inserted_id)}
 
 @api_router.get("/posts")
-async def get_posts(page: int = 1, limit: int = 20):
-    """Get all posts with pagination"""
-    skip = (page - 1) * limit
-    posts = await db.posts.find().sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
-    for post in posts:
-        post["_id"] = str(post["_id"])
-        # Fetch user's star rating only if they're a guide with rating > 0
-        user = await db.users.find_one({"_id": ObjectId(post["user_id"])})
-        if user:
-            star_rating = user.get("star_rating", 0)
-            if star_rating and star_rating > 0:
-                post["star_rating"] = star_rating
-            # If star_rating is 0 or None, don't add it to the post
-    return posts
+async def get_posts(request: Request, response: Response, page: int = 1, limit: int = 20, before: str = None):
+    """Get all posts, newest first; signed-in users also get `voted` per post.
+    
+    For the next page pass before=<created_at>,<_id> of the last post seen (also sent
+    as the X-Next-Cursor header); page is kept for older clients and skips posts.
+    """
+    query = feed_cursor_query(before) if before else {}
+    skip = 0 if before else (max(page, 1) - 1) * limit
+    posts = await db.posts.find(query).sort([("created_at", -1), ("_id", -1)]).skip(skip).limit(limit).to_list(limit)
+    return await feed_page(posts, response, posts[-1] if len(posts) == limit else None, await get_current_user(request))
+
+@api_router.get("/feed/home")
+async def get_home_feed(request: Request, response: Response, limit: int = 20, before: str = None):
+    """Get the current user's home feed: their own and their idols' posts, newest first.
+    
+    Paginate with before=<created_at>,<_id> from the X-Next-Cursor header. Users
+    without idols get the global feed.
+    """
+    user = await get_current_user(request)
+    if not user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    limit = max(1, min(limit, 100))
+    idols = user.get("idols", [])
+    if not idols:
+        query = feed_cursor_query(before) if before else {}
+        posts = await db.posts.find(query).sort([("created_at", -1), ("_id", -1)]).limit(limit).to_list(limit)
+        return await feed_page(posts, response, posts[-1] if len(posts) == limit else None, user)
+    
+    horizon = timeline_horizon()
+    entry_query = {"user_id": user["_id"], "created_at": {"$gte": horizon}}
+    if before:
+        entry_query.update(feed_cursor_query(before, "post_id"))
+    entries = await db.timelines.find(entry_query, {"post_id": 1, "created_at": 1}).sort([("created_at", -1), ("post_id", -1)]).limit(limit).to_list(limit)
+    
+    # Past the end of the timeline window, read the user's and idols' older posts directly
+    older = []
+    if len(entries) < limit:
+        older_query = {"user_id": {"$in": [user["_id"], *idols]}, "created_at": {"$lt": horizon}}
+        if before:
+            older_query.update(feed_cursor_query(before))
+        older = await db.posts.find(older_query).sort([("created_at", -1), ("_id", -1)]).limit(limit - len(entries)).to_list(limit)
+    
+    # Fan-out on read for idols too large to fan out on write
+    large_idols = await db.users.find(
+        {"_id": {"$in": [ObjectId(idol) for idol in idols if ObjectId.is_valid(idol)]}, f"fans.{TIMELINE_FANOUT_MAX_FANS}": {"$exists": True}},
+        {"_id": 1}
+    ).to_list(None)
+    pulled = []
+    if large_idols:
+        post_query = {"user_id": {"$in": [str(idol["_id"]) for idol in large_idols]}}
+        if before:
+            post_query.update(feed_cursor_query(before))
+        pulled = await db.posts.find(post_query).sort([("created_at", -1), ("_id", -1)]).limit(limit).to_list(limit)
+    pulled += older
+    
+    keys = {post["_id"]: post["created_at"] for post in pulled}
+    keys.update((entry["post_id"], entry["created_at"]) for entry in entries)
+    page_ids = sorted(keys, key=lambda post_id: (keys[post_id], post_id), reverse=True)[:limit]
+    posts_by_id = {post["_id"]: post for post in pulled}
+    missing = [post_id for post_id in page_ids if post_id not in posts_by_id]
+    if missing:
+        posts_by_id.update((post["_id"], post) for post in await db.posts.find({"_id": {"$in": missing}}).to_list(None))
+    posts = [posts_by_id[post_id] for post_id in page_ids if post_id in posts_by_id]
+    last = {"created_at": keys[page_ids[-1]], "_id": page_ids[-1]} if len(page_ids) == limit else None
+    return await feed_page(posts, response, last, user)
 
 @api_router.post("/posts/{post_id}/vote")
 async def vote_post(post_id: str, request: Request):
@@ -1050,41 +4115,17 @@ async def vote_post(post_id: str, request: Request):
     if not post:
         raise HTTPException(status_code=404, detail="Post not found")
     
-    # Check if already voted
-    if user["_id"] in post.get("voted_by", []):
-        # Remove vote
-        await db.posts.update_one(
-            {"_id": ObjectId(post_id)},
-            {"$pull": {"voted_by": user["_id"]}, "$inc": {"vote_ups": -1}}
-        )
+    voted = await toggle_vote(post_id, user["_id"])
+    if voted is None:
+        # A concurrent request already cast this vote
+        return {"message": "Voted", "voted": True}
+    if not voted:
         # Remove points from post owner
-        await db.users.update_one(
-            {"_id": ObjectId(post["user_id"])},
-            {"$inc": {"points": -2}}
-        )
+        await record_points(post["user_id"], -2, "vote_removed", post_id, from_user=user["_id"])
         return {"message": "Vote removed", "voted": False}
     else:
-        # Add vote
-        await db.posts.update_one(
-            {"_id": ObjectId(post_id)},
-            {"$push": {"voted_by": user["_id"]}, "$inc": {"vote_ups": 1}}
-        )
         # Award points to post owner
-        await db.users.update_one(
-            {"_id": ObjectId(post["user_id"])},
-            {"$inc": {"points": 2}}
-        )
-        
-        # Update star rating
-        post_owner = await db.users.find_one({"_id": ObjectId(post["user_id"])})
-        total_points = post_owner.get("points", 0) + post_owner.get("inherent_points", 0)
-        new_rating = await calculate_star_rating(total_points)
-        is_guide = new_rating >= 1
-        
-        await db.users.update_one(
-            {"_id": ObjectId(post["user_id"])},
-            {"$set": {"star_rating": new_rating, "is_guide": is_guide}}
-        )
+        await record_points(post["user_id"], 2, "vote_received", post_id, from_user=user["_id"])
         
         # Create notification for post owner (if not voting own post)
         if post["user_id"] != user["_id"]:
@@ -1100,6 +4141,24 @@ async def vote_post(post_id: str, request: Request):
         
         return {"message": "Voted", "voted": True}
 
+@api_router.get("/posts/{post_id}/voters")
+async def get_post_voters(post_id: str, limit: int = 100):
+    """Get the users who voted for a post, most recent first"""
+    limit = max(1, min(limit, 500))
+    votes = await db.post_votes.find({"post_id": post_id}, {"user_id": 1}).sort("created_at", -1).limit(limit).to_list(limit)
+    user_ids = [vote["user_id"] for vote in votes]
+    users = await db.users.find(
+        {"_id": {"$in": [ObjectId(user_id) for user_id in user_ids if ObjectId.is_valid(user_id)]}},
+        {"name": 1, "picture": 1, "star_rating": 1}
+    ).to_list(None)
+    by_id = {str(user["_id"]): user for user in users}
+    voters = []
+    for user_id in user_ids:
+        if user_id in by_id:
+            user = by_id[user_id]
+            voters.append({"_id": user_id, "name": user.get("name", ""), "picture": user.get("picture"), "star_rating": user.get("star_rating", 0)})
+    return voters
+
 @api_router.delete("/posts/{post_id}")
 async def delete_post(post_id: str, request: Request):
     """Delete a post (only by owner)"""
@@ -1120,23 +4179,11 @@ async def delete_post(post_id: str, request: Request):
     
     # Delete the post
     await db.posts.delete_one({"_id": ObjectId(post_id)})
+    await db.timelines.delete_many({"post_id": ObjectId(post_id)})
+    await db.post_votes.delete_many({"post_id": post_id})
     
     # Remove points for the deleted post
-    await db.users.update_one(
-        {"_id": ObjectId(user["_id"])},
-        {"$inc": {"points": -5}}
-    )
-    
-    # Update star rating
-    updated_user = await db.users.find_one({"_id": ObjectId(user["_id"])})
-    total_points = updated_user.get("points", 0) + updated_user.get("inherent_points", 0)
-    new_rating = await calculate_star_rating(total_points)
-    is_guide = new_rating >= 1
-    
-    await db.users.update_one(
-        {"_id": ObjectId(user["_id"])},
-        {"$set": {"star_rating": new_rating, "is_guide": is_guide}}
-    )
+    await record_points(user["_id"], -5, "post_deleted", post_id)
     
     return {"message": "Post deleted"}
 
@@ -1162,13 +4209,14 @@ async def update_post(post_id: str, post_data: dict, request: Request):
     
     # Handle both single image and images array
     if "images" in post_data:
-        images = post_data["images"]
+        images = await externalize_blobs(post_data["images"])
         update_data["images"] = images
         update_data["image"] = images[0] if images else None  # Keep first image for backward compatibility
     elif "image" in post_data:
         # Backward compatibility for single image
-        update_data["image"] = post_data["image"]
-        update_data["images"] = [post_data["image"]] if post_data["image"] else []
+        image = await externalize_blobs(post_data["image"])
+        update_data["image"] = image
+        update_data["images"] = [image] if image else []
     
     await db.posts.update_one(
         {"_id": ObjectId(post_id)},
@@ -1444,7 +4492,7 @@ async def send_message(conversation_id: str, message_data: dict, request: Reques
         sender_name=user["name"],
         sender_picture=user.get("picture"),
         content=message_data.get("content", ""),
-        image=message_data.get("image")
+        image=await externalize_blobs(message_data.get("image"))
     )
     
     result = await db.messages.insert_one(message.dict())
@@ -1486,42 +4534,49 @@ async def send_message(conversation_id: str, message_data: dict, request: Reques
 
 # Meal & Ingredient endpoints
 @api_router.get("/ingredients")
-async def get_ingredients():
-    """Get all processed ingredients"""
-    ingredients = await db.ingredients.find().to_list(1000)
+async def get_ingredients(request: Request, include_images: bool = False):
+    """Get all processed ingredients (calculated_price is maintained on catalog writes).
+    
+    Images are listed as image_refs unless include_images is set.
+    """
+    etag = await catalog_etag(request)
+    if etag_matches(request, etag):
+        return not_modified_response(etag)
+    
+    ingredients = catalog_replica.find("ingredients", exclude=catalog_hidden_fields("ingredients", include_images))[:1000]
     for ingredient in ingredients:
         ingredient["_id"] = str(ingredient["_id"])
-        # Calculate price using helper function with error handling
-        try:
-            calculated_price = await calculate_processed_ingredient_price(ingredient)
-            ingredient["calculated_price"] = calculated_price
-            ingredient["price_per_unit"] = calculated_price  # Backward compatibility
-        except Exception as e:
-            # If calculation fails, set to 0 or use existing price_per_unit
-            ingredient["calculated_price"] = ingredient.get("price_per_unit", 0)
-            ingredient["price_per_unit"] = ingredient.get("price_per_unit", 0)
-    return ingredients
+    return catalog_response(ingredients, etag)
 
 # Source Ingredients endpoints
 @api_router.get("/source-ingredients")
-async def get_source_ingredients():
-    """Get all source ingredients with purchase history"""
-    sources = await db.source_ingredients.find().to_list(1000)
+async def get_source_ingredients(request: Request, include_images: bool = False):
+    """Get all source ingredients with purchase history; the image is listed as image_refs unless include_images is set"""
+    etag = await catalog_etag(request)
+    if etag_matches(request, etag):
+        return not_modified_response(etag)
+    
+    sources = catalog_replica.find("source_ingredients", exclude=catalog_hidden_fields("source_ingredients", include_images))[:1000]
     for source in sources:
         source["_id"] = str(source["_id"])
-        # Calculate stats
-        if source.get("purchases"):
-            unit_prices = [p["unit_price"] for p in source["purchases"]]
-            source["latest_unit_price"] = source["purchases"][-1]["unit_price"]
-            source["lowest_unit_price"] = min(unit_prices)
-            source["highest_unit_price"] = max(unit_prices)
-            source["latest_purchase"] = source["purchases"][-1]
-        else:
-            source["latest_unit_price"] = 0
-            source["lowest_unit_price"] = 0
-            source["highest_unit_price"] = 0
-            source["latest_purchase"] = None
-    return sources
+        # Price aggregates are maintained on purchase writes; absent until the first purchase
+        source.setdefault("purchase_count", 0)
+        source.setdefault("latest_unit_price", 0)
+        source.setdefault("lowest_unit_price", 0)
+        source.setdefault("highest_unit_price", 0)
+        source.setdefault("latest_purchase", None)
+        source.setdefault("valuation_mode", "latest")
+        source.setdefault("consumed_quantity", 0.0)
+        source["unit_cost"] = source_unit_price(source) or 0
+    return catalog_response(sources, etag)
+
+def validate_valuation_settings(source_data: dict):
+    if "valuation_mode" in source_data and source_data["valuation_mode"] not in VALUATION_MODES:
+        raise HTTPException(status_code=400, detail=f"valuation_mode must be one of: {', '.join(VALUATION_MODES)}")
+    if "consumed_quantity" in source_data and not (
+        isinstance(source_data["consumed_quantity"], (int, float)) and source_data["consumed_quantity"] >= 0
+    ):
+        raise HTTPException(status_code=400, detail="consumed_quantity must be a non-negative number")
 
 @api_router.post("/source-ingredients")
 async def create_source_ingredient(source_data: dict):
@@ -1530,9 +4585,14 @@ async def create_source_ingredient(source_data: dict):
         "name": source_data["name"],
         "image": source_data.get("image"),
         "unit": source_data["unit"],
-        "purchases": []
+        "purchase_count": 0,
+        "valuation_mode": source_data.get("valuation_mode", "latest"),
+        "consumed_quantity": source_data.get("consumed_quantity", 0.0)
     }
+    validate_valuation_settings(source)
+    await store_catalog_images(source, "source_ingredients")
     result = await db.source_ingredients.insert_one(source)
+    await record_catalog_change(updated={"source_ingredients": [result.inserted_id]})
     return {"message": "Source ingredient created", "id": str(result.inserted_id)}
 
 @api_router.post("/source-ingredients/{source_id}/purchase")
@@ -1541,48 +4601,61 @@ async def add_purchase(source_id: str, purchase_data: dict):
     unit_price = purchase_data["purchase_price"] / purchase_data["purchase_quantity"]
     
     purchase = {
+        "purchase_id": uuid.uuid4().hex,
         "purchase_quantity": purchase_data["purchase_quantity"],
         "purchase_price": purchase_data["purchase_price"],
         "unit_price": unit_price,
         "purchase_date": datetime.now(timezone.utc)
     }
     
-    await db.source_ingredients.update_one(
-        {"_id": ObjectId(source_id)},
-        {"$push": {"purchases": purchase}}
-    )
+    if not await record_purchase(source_id, purchase):
+        raise HTTPException(status_code=404, detail="Source ingredient not found")
     
-    # Update all processed ingredients linked to this source
-    processed_ingredients = await db.ingredients.find({"source_ingredient_id": source_id}).to_list(1000)
-    for ing in processed_ingredients:
-        if ing.get("source_quantity"):
-            new_price = ing["source_quantity"] * unit_price
-            await db.ingredients.update_one(
-                {"_id": ing["_id"]},
-                {"$set": {"price_per_unit": new_price}}
-            )
+    # Update all processed ingredients, recipes and meals priced from this source
+    propagation = await propagate_catalog_change(source_ids=[source_id])
     
-    return {"message": "Purchase added", "unit_price": unit_price}
+    return {"message": "Purchase added", "unit_price": unit_price, "propagation": propagation}
 
-@api_router.delete("/source-ingredients/{source_id}/purchase/{purchase_index}")
-async def delete_purchase(source_id: str, purchase_index: int):
-    """Delete a purchase entry from source ingredient history"""
-    source = await db.source_ingredients.find_one({"_id": ObjectId(source_id)})
+@api_router.get("/source-ingredients/{source_id}/purchases")
+async def get_purchase_history(source_id: str):
+    """Get a source ingredient's purchase history, oldest first"""
+    source = await db.source_ingredients.find_one({"_id": ObjectId(source_id)}, {"_id": 1})
     if not source:
         raise HTTPException(status_code=404, detail="Source ingredient not found")
+    return await load_purchase_history(source_id)
+
+@api_router.post("/source-ingredients/{source_id}/consumption")
+async def add_consumption(source_id: str, consumption_data: dict):
+    """Record quantity used up from a source ingredient's stock (FIFO / weighted average valuation)"""
+    quantity = consumption_data.get("quantity")
+    if not isinstance(quantity, (int, float)) or quantity <= 0:
+        raise HTTPException(status_code=400, detail="quantity must be a positive number")
     
-    purchases = source.get("purchases", [])
-    if purchase_index < 0 or purchase_index >= len(purchases):
-        raise HTTPException(status_code=400, detail="Invalid purchase index")
+    result = await db.source_ingredients.update_one({"_id": ObjectId(source_id)}, {"$inc": {"consumed_quantity": quantity}})
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Source ingredient not found")
+    await refresh_source_valuation(source_id)
     
-    purchases.pop(purchase_index)
+    propagation = await propagate_catalog_change(source_ids=[source_id])
     
-    await db.source_ingredients.update_one(
-        {"_id": ObjectId(source_id)},
-        {"$set": {"purchases": purchases}}
-    )
+    return {"message": "Consumption recorded", "propagation": propagation}
+
+@api_router.delete("/source-ingredients/{source_id}/purchase/{purchase_id}")
+async def delete_purchase(source_id: str, purchase_id: str):
+    """Delete a purchase entry from source ingredient history by purchase_id
+    (a number is still accepted as a position in the oldest-first history)"""
+    source = await db.source_ingredients.find_one({"_id": ObjectId(source_id)}, {"_id": 1})
+    if not source:
+        raise HTTPException(status_code=404, detail="Source ingredient not found")
+    
+    if purchase_id.isdigit():
+        purchase_id = await purchase_id_at(source_id, int(purchase_id))
+    if not purchase_id or not await remove_purchase(source_id, purchase_id):
+        raise HTTPException(status_code=400, detail="Invalid purchase")
     
-    return {"message": "Purchase deleted"}
+    propagation = await propagate_catalog_change(source_ids=[source_id])
+    
+    return {"message": "Purchase deleted", "propagation": propagation}
 
 @api_router.put("/source-ingredients/{source_id}")
 async def update_source_ingredient(source_id: str, source_data: dict):
@@ -1594,11 +4667,22 @@ async def update_source_ingredient(source_id: str, source_data: dict):
         update_data["image"] = source_data["image"]
     if "unit" in source_data:
         update_data["unit"] = source_data["unit"]
+    for field in ("valuation_mode", "consumed_quantity"):
+        if field in source_data:
+            update_data[field] = source_data[field]
+    validate_valuation_settings(update_data)
+    await store_catalog_images(update_data, "source_ingredients")
     
     await db.source_ingredients.update_one(
         {"_id": ObjectId(source_id)},
         {"$set": update_data}
     )
+    if "valuation_mode" in update_data or "consumed_quantity" in update_data:
+        # The unit cost may have moved: reprice everything made from this source
+        await refresh_source_valuation(source_id)
+        propagation = await propagate_catalog_change(source_ids=[source_id])
+        return {"message": "Source ingredient updated", "propagation": propagation}
+    await record_catalog_change(updated={"source_ingredients": [source_id]})
     
     return {"message": "Source ingredient updated"}
 
@@ -1613,134 +4697,174 @@ async def delete_source_ingredient(source_id: str):
     result = await db.source_ingredients.delete_one({"_id": ObjectId(source_id)})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Source ingredient not found")
+    await db.purchase_buckets.delete_many({"source_id": source_id})
+    await record_catalog_change(deleted={"source_ingredients": [source_id]})
     
     return {"message": "Source ingredient deleted"}
 
 @api_router.get("/recipes")
-async def get_recipes(user_id: str = None):
-    """Get all recipes with calculated prices. If user_id provided, includes user's non-preset recipes."""
-    if user_id:
-        # Return both preset recipes AND user's non-preset recipes
-        recipes = await db.meals.find({
-            "$or": [
-                {"is_preset": True},
-                {"created_by": user_id, "is_preset": False}
-            ]
-        }).to_list(100)
-    else:
-        # Only preset recipes
-        recipes = await db.meals.find({"is_preset": True}).to_list(100)
+async def get_recipes(
+    request: Request,
+    user_id: str = None,
+    include_images: bool = False,
+    exclude_allergens: str = None,
+    tags: str = None,
+    any_tags: str = None,
+    categories: str = None,
+    any_categories: str = None,
+    facets: bool = False
+):
+    """Get all recipes with calculated prices. If user_id provided, includes user's non-preset recipes.
+    
+    Images are listed as image_refs unless include_images is set. Recipes containing
+    exclude_allergens (comma-separated, default: the signed-in user's allergies) are left out.
+    tags/categories keep recipes having all of the comma-separated values, any_tags/any_categories
+    those having at least one. With facets, returns {items, total, facets} with per-tag and
+    per-category counts over the filtered recipes.
+    """
+    excluded = await requested_allergen_mask(request, exclude_allergens)
+    etag = await catalog_etag(request, vary=str(excluded))
+    if etag_matches(request, etag):
+        return not_modified_response(etag)
+    
+    # Preset recipes, plus the user's non-preset recipes if user_id provided, without excluded allergens
+    index = get_catalog_filter_index("meals")
+    selected = index.select(
+        user_id, excluded, filter_terms(tags), filter_terms(any_tags), filter_terms(categories), filter_terms(any_categories)
+    )
+    recipes = index.documents(selected, catalog_hidden_fields("meals", include_images), limit=100)
     
+    # calculated_price and nutrition_profile are maintained on catalog writes
     for recipe in recipes:
         recipe["_id"] = str(recipe["_id"])
-        # Calculate price from ingredients
-        recipe["calculated_price"] = await calculate_recipe_price(recipe)
-        # Calculate nutrition profile
-        recipe["nutrition_profile"] = await calculate_nutrition_profile(
-            recipe.get("ingredients", []), "ingredients"
-        )
-    return recipes
+    if facets:
+        return catalog_response({"items": recipes, "total": selected.bit_count(), "facets": index.facet_counts(selected)}, etag)
+    return catalog_response(recipes, etag)
 
 @api_router.get("/recipes/{recipe_id}")
 async def get_recipe(recipe_id: str):
     """Get recipe by ID with calculated price and nutrition"""
-    try:
-        recipe = await db.meals.find_one({"_id": ObjectId(recipe_id)})
-    except Exception:
-        raise HTTPException(status_code=404, detail="Recipe not found")
+    recipe = catalog_replica.get("meals", recipe_id)
     if not recipe:
         raise HTTPException(status_code=404, detail="Recipe not found")
     recipe["_id"] = str(recipe["_id"])
-    
-    # Refresh ingredient prices with latest calculated prices
-    for ingredient_ref in recipe.get("ingredients", []):
-        ingredient_id = ingredient_ref.get("ingredient_id")
-        if ingredient_id:
-            try:
-                ingredient = await db.ingredients.find_one({"_id": ObjectId(ingredient_id)})
-                if ingredient:
-                    # Recalculate price from source ingredients
-                    calculated_price = await calculate_processed_ingredient_price(ingredient)
-                    ingredient_ref["price"] = calculated_price
-            except Exception:
-                pass
-    
-    # Calculate total price from refreshed ingredients
-    recipe["calculated_price"] = await calculate_recipe_price(recipe)
-    # Calculate nutrition profile
-    recipe["nutrition_profile"] = await calculate_nutrition_profile(
-        recipe.get("ingredients", []), "ingredients"
-    )
+    # Ingredient prices, calculated_price and nutrition_profile are maintained on catalog writes
+    
+    # Closest preset recipes by nutrition and price, precomputed in the background
+    recipe["similar"] = []
+    for similar_id, similarity in get_similar_recipes().neighbours.get(recipe["_id"], []):
+        similar = catalog_replica.docs["meals"].get(similar_id)
+        # The table may predate the latest change to this recipe
+        if similar and similar.get("is_preset") is True:
+            recipe["similar"].append({
+                "_id": similar_id,
+                "name": similar.get("name"),
+                "calculated_price": similar.get("calculated_price"),
+                "image_refs": similar.get("image_refs", []),
+                "similarity": round(similarity, 4)
+            })
     return recipe
 
 # New Meals endpoints (meals are combinations of recipes)
 @api_router.get("/meals")
-async def get_meals(user_id: str = None):
-    """Get all meals (combinations of recipes) with calculated prices. If user_id provided, includes user's non-preset meals."""
-    if user_id:
-        # Return both preset meals AND user's non-preset meals
-        meals = await db.preset_meals.find({
-            "$or": [
-                {"is_preset": True},
-                {"created_by": user_id, "is_preset": False}
-            ]
-        }).to_list(100)
-    else:
-        # Only preset meals
-        meals = await db.preset_meals.find({"is_preset": True}).to_list(100)
-    
+async def get_meals(
+    request: Request,
+    user_id: str = None,
+    include_images: bool = False,
+    exclude_allergens: str = None,
+    tags: str = None,
+    any_tags: str = None,
+    facets: bool = False
+):
+    """Get all meals (combinations of recipes) with calculated prices. If user_id provided, includes user's non-preset meals.
+    
+    Images are listed as image_refs unless include_images is set. Meals containing
+    exclude_allergens (comma-separated, default: the signed-in user's allergies) are left out.
+    tags keeps meals having all of the comma-separated tags, any_tags those having at least
+    one. With facets, returns {items, total, facets} with per-tag counts over the filtered meals.
+    """
+    excluded = await requested_allergen_mask(request, exclude_allergens)
+    etag = await catalog_etag(request, vary=str(excluded))
+    if etag_matches(request, etag):
+        return not_modified_response(etag)
+    
+    # Preset meals, plus the user's non-preset meals if user_id provided, without excluded allergens
+    index = get_catalog_filter_index("preset_meals")
+    selected = index.select(user_id, excluded, filter_terms(tags), filter_terms(any_tags))
+    meals = index.documents(selected, catalog_hidden_fields("preset_meals", include_images), limit=100)
+    
+    # Recipe prices, calculated_price and nutrition_profile are maintained on catalog writes
     for meal in meals:
         meal["_id"] = str(meal["_id"])
-        # Refresh recipe prices with latest calculated prices
-        for recipe_ref in meal.get("recipes", []):
-            recipe_id = recipe_ref.get("recipe_id")
-            if recipe_id:
-                try:
-                    recipe = await db.meals.find_one({"_id": ObjectId(recipe_id)})
-                    if recipe:
-                        # Recalculate recipe price from its ingredients
-                        calculated_price = await calculate_recipe_price(recipe)
-                        recipe_ref["price"] = calculated_price
-                except Exception:
-                    pass
-        # Calculate price from recipes
-        meal["calculated_price"] = await calculate_meal_price(meal)
-        # Calculate nutrition profile from recipes
-        meal["nutrition_profile"] = await calculate_nutrition_profile(
-            meal.get("recipes", []), "meals"
-        )
-    return meals
+    if facets:
+        return catalog_response({"items": meals, "total": selected.bit_count(), "facets": index.facet_counts(selected)}, etag)
+    return catalog_response(meals, etag)
+
+@api_router.get("/meals/search")
+async def search_meals(
+    request: Request,
+    type: str = "all",
+    user_id: str = None,
+    sort: str = "price",
+    order: str = "asc",
+    limit: int = 20,
+    skip: int = 0,
+    exclude_allergens: str = None
+):
+    """Search recipes and meals by nutrient ranges, e.g. ?protein_min=30&calories_max=600.
+    
+    Any nutrient works as <nutrient>_min / <nutrient>_max, with its name lower-cased
+    and non-alphanumerics replaced by "_" ("Vitamin A" -> vitamin_a_min). type is
+    recipe, meal or all; price_min / price_max bound calculated_price; sort is price
+    or a nutrient; user_id adds that user's own items. exclude_allergens works as on /meals.
+    """
+    index = get_nutrient_index()
+    
+    ranges = {}
+    for param, raw_value in request.query_params.items():
+        key, separator, bound = param.rpartition("_")
+        if not separator or bound not in ("min", "max"):
+            continue
+        if key != "price" and key not in index.columns:
+            raise HTTPException(status_code=400, detail=f"Unknown nutrient '{key}'. Available: {', '.join(index.columns)}")
+        try:
+            value = float(raw_value)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"{param} must be a number")
+        low, high = ranges.get(key, (-np.inf, np.inf))
+        ranges[key] = (value, high) if bound == "min" else (low, value)
+    
+    kinds = {"all": ("recipe", "meal"), "recipe": ("recipe",), "meal": ("meal",)}.get(type)
+    if kinds is None:
+        raise HTTPException(status_code=400, detail="type must be recipe, meal or all")
+    if sort != "price" and sort not in index.columns:
+        raise HTTPException(status_code=400, detail="sort must be price or a nutrient")
+    limit = max(1, min(limit, NUTRIENT_SEARCH_MAX_LIMIT))
+    
+    excluded = await requested_allergen_mask(request, exclude_allergens)
+    rows = index.search(ranges, kinds, user_id, sort, order == "desc", excluded)
+    items = []
+    for row in rows[max(skip, 0):max(skip, 0) + limit]:
+        kind, doc = index.items[row]
+        item = dict(doc)
+        item["_id"] = str(item["_id"])
+        item["type"] = kind
+        items.append(item)
+    
+    return {
+        "total": int(len(rows)),
+        "items": items,
+        "nutrients": [{"key": key, "name": index.names[key], "unit": index.units[key]} for key in index.columns]
+    }
 
 @api_router.get("/meals/{meal_id}")
 async def get_meal(meal_id: str):
     """Get meal by ID with calculated price and nutrition"""
-    try:
-        meal = await db.preset_meals.find_one({"_id": ObjectId(meal_id)})
-    except Exception:
-        raise HTTPException(status_code=404, detail="Meal not found")
+    meal = catalog_replica.get("preset_meals", meal_id)
     if not meal:
         raise HTTPException(status_code=404, detail="Meal not found")
     meal["_id"] = str(meal["_id"])
-    
-    # Refresh recipe prices with latest calculated prices
-    for recipe_ref in meal.get("recipes", []):
-        recipe_id = recipe_ref.get("recipe_id")
-        if recipe_id:
-            try:
-                recipe = await db.meals.find_one({"_id": ObjectId(recipe_id)})
-                if recipe:
-                    # Recalculate recipe price from its ingredients
-                    calculated_price = await calculate_recipe_price(recipe)
-                    recipe_ref["price"] = calculated_price
-            except Exception:
-                pass
-    
-    # Calculate total price from refreshed recipes
-    meal["calculated_price"] = await calculate_meal_price(meal)
-    # Calculate nutrition profile from recipes
-    meal["nutrition_profile"] = await calculate_nutrition_profile(
-        meal.get("recipes", []), "meals"
-    )
+    # Recipe prices, calculated_price and nutrition_profile are maintained on catalog writes
     return meal
 
 # CRUD endpoints for Recipes (admin)
@@ -1758,9 +4882,11 @@ async def create_recipe(recipe_data: dict):
         "is_preset": recipe_data.get("is_preset", True),
         "created_at": datetime.now(timezone.utc)
     }
+    await store_catalog_images(recipe_doc, "meals")
     
     result = await db.meals.insert_one(recipe_doc)
-    return {"message": "Recipe created", "id": str(result.inserted_id)}
+    propagation = await propagate_catalog_change(recipe_ids=[result.inserted_id])
+    return {"message": "Recipe created", "id": str(result.inserted_id), "propagation": propagation}
 
 @api_router.put("/recipes/{recipe_id}")
 async def update_recipe(recipe_id: str, recipe_data: dict):
@@ -1775,6 +4901,7 @@ async def update_recipe(recipe_id: str, recipe_data: dict):
         "created_by": recipe_data.get("created_by", "admin"),
         "updated_at": datetime.now(timezone.utc)
     }
+    await store_catalog_images(update_data, "meals")
     
     try:
         result = await db.meals.update_one(
@@ -1787,7 +4914,9 @@ async def update_recipe(recipe_id: str, recipe_data: dict):
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Recipe not found")
     
-    return {"message": "Recipe updated"}
+    propagation = await propagate_catalog_change(recipe_ids=[recipe_id])
+    
+    return {"message": "Recipe updated", "propagation": propagation}
 
 @api_router.delete("/recipes/{recipe_id}")
 async def delete_recipe(recipe_id: str):
@@ -1800,7 +4929,10 @@ async def delete_recipe(recipe_id: str):
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Recipe not found")
     
-    return {"message": "Recipe deleted"}
+    # Reprice meals that used this recipe
+    propagation = await propagate_catalog_change(recipe_ids=[recipe_id])
+    
+    return {"message": "Recipe deleted", "propagation": propagation}
 
 # CRUD endpoints for Meals (admin)
 @api_router.post("/meals")
@@ -1816,9 +4948,11 @@ async def create_meal(meal_data: dict):
         "created_by": meal_data.get("created_by", "admin"),
         "created_at": datetime.now(timezone.utc)
     }
+    await store_catalog_images(meal_doc, "preset_meals")
     
     result = await db.preset_meals.insert_one(meal_doc)
-    return {"message": "Meal created", "id": str(result.inserted_id)}
+    propagation = await propagate_catalog_change(meal_ids=[result.inserted_id])
+    return {"message": "Meal created", "id": str(result.inserted_id), "propagation": propagation}
 
 @api_router.put("/meals/{meal_id}")
 async def update_meal(meal_id: str, meal_data: dict):
@@ -1833,6 +4967,7 @@ async def update_meal(meal_id: str, meal_data: dict):
         "created_by": meal_data.get("created_by", "admin"),
         "updated_at": datetime.now(timezone.utc)
     }
+    await store_catalog_images(update_data, "preset_meals")
     
     try:
         result = await db.preset_meals.update_one(
@@ -1845,7 +4980,9 @@ async def update_meal(meal_id: str, meal_data: dict):
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Meal not found")
     
-    return {"message": "Meal updated"}
+    propagation = await propagate_catalog_change(meal_ids=[meal_id])
+    
+    return {"message": "Meal updated", "propagation": propagation}
 
 @api_router.delete("/meals/{meal_id}")
 async def delete_meal(meal_id: str):
@@ -1858,8 +4995,361 @@ async def delete_meal(meal_id: str):
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Meal not found")
     
-    return {"message": "Meal deleted"}
+    propagation = await propagate_catalog_change(meal_ids=[meal_id])
+    
+    return {"message": "Meal deleted", "propagation": propagation}
+
+
 
+# Catalog sync endpoints
+def catalog_visibility_query(user_id: Optional[str]) -> dict:
+    """Recipes/meals a client sees: presets plus, with user_id, that user's own items"""
+    if user_id:
+        return {"$or": [{"is_preset": True}, {"created_by": user_id, "is_preset": False}]}
+    return {"is_preset": True}
+
+def _visible_to(doc: dict, user_id: Optional[str]) -> bool:
+    if doc.get("is_preset") is True:
+        return True
+    return bool(user_id) and doc.get("created_by") == user_id and doc.get("is_preset") is False
+
+@api_router.get("/catalog/changes")
+async def get_catalog_changes(request: Request, since: int = 0, user_id: str = None):
+    """Get ingredients, recipes and meals created, updated or deleted after catalog version `since`.
+    
+    Returns full_resync with the complete catalog when the change log no longer
+    covers `since` (first sync, pruned log or a full rebuild since then).
+    """
+    version = await get_catalog_version()
+    etag = await catalog_etag(request, version)
+    if etag_matches(request, etag):
+        return not_modified_response(etag)
+    
+    entries = await db.catalog_changes.find({"version": {"$gt": since}}).sort("version", 1).to_list(None)
+    oldest = await db.catalog_changes.find_one({}, {"version": 1}, sort=[("version", 1)])
+    # The log can run briefly ahead of the config version, never behind it
+    latest = max([version] + [entry["version"] for entry in entries[-1:]])
+    full_resync = (
+        since <= 0
+        or since > latest
+        or any(change["op"] == "reset" for _, change in logged_changes(entries))
+        # Only resync when the log no longer reaches back to since
+        or (oldest["version"] > since + 1 if oldest else latest > since)
+    )
+    if not full_resync:
+        # Versions are logged without holes; with nothing logged yet the client stays at since
+        version = entries[-1]["version"] if entries else since
+    
+    response = {
+        "version": version,
+        "since": since,
+        "full_resync": bool(full_resync),
+        "ingredients": [],
+        "recipes": [],
+        "meals": [],
+        "deleted": {"ingredients": [], "recipes": [], "meals": []}
+    }
+    collections = {"ingredients": "ingredients", "recipes": "meals", "meals": "preset_meals"}
+    
+    if full_resync:
+        response["ingredients"] = await db.ingredients.find({}, catalog_projection("ingredients")).to_list(1000)
+        response["recipes"] = await db.meals.find(
+            catalog_visibility_query(user_id), catalog_projection("meals")
+        ).to_list(1000)
+        response["meals"] = await db.preset_meals.find(
+            catalog_visibility_query(user_id), catalog_projection("preset_meals")
+        ).to_list(1000)
+    else:
+        # Latest operation per item wins
+        latest_ops = {kind: {} for kind in collections}
+        for _, change in logged_changes(entries):
+            if change["collection"] in latest_ops:
+                latest_ops[change["collection"]][change["item_id"]] = change["op"]
+        
+        for kind, ops in latest_ops.items():
+            upserted = [item_id for item_id, op in ops.items() if op == "upsert"]
+            collection_name = collections[kind]
+            docs = await _fetch_by_ids(db[collection_name], upserted, catalog_projection(collection_name))
+            for item_id, op in ops.items():
+                doc = docs.get(item_id)
+                if op == "delete" or doc is None or (kind != "ingredients" and not _visible_to(doc, user_id)):
+                    response["deleted"][kind].append(item_id)
+                else:
+                    response[kind].append(doc)
+    
+    for kind in collections:
+        for doc in response[kind]:
+            doc["_id"] = str(doc["_id"])
+    
+    return catalog_response(response, etag)
+
+
+@api_router.get("/catalog/suggest")
+async def suggest_catalog(q: str = "", types: str = None, user_id: str = None, limit: int = 10):
+    """Typeahead over ingredient, recipe and meal names and tags, tolerant of typos.
+    
+    types is a comma-separated subset of ingredient, recipe and meal (default all);
+    user_id adds that user's own recipes and meals. Results carry no images, only image_refs.
+    """
+    kinds = tuple(SUGGEST_KINDS)
+    if types:
+        requested = set(filter_terms(types))
+        kinds = tuple(collection for collection, kind in SUGGEST_KINDS.items() if kind in requested)
+        if not kinds:
+            raise HTTPException(status_code=400, detail="types must name ingredient, recipe or meal")
+    limit = max(1, min(limit, SUGGEST_MAX_LIMIT))
+    
+    results = []
+    for score, collection_name, doc, term in get_suggest_index().suggest(q, kinds, user_id, limit):
+        results.append({
+            "_id": str(doc["_id"]),
+            "type": SUGGEST_KINDS[collection_name],
+            "name": doc.get("name"),
+            "matched": term,
+            "score": round(score, 3),
+            "calculated_price": doc.get("calculated_price"),
+            "image_refs": doc.get("image_refs", [])
+        })
+    return {"query": q, "results": results}
+
+@api_router.get("/catalog/snapshot")
+async def get_catalog_snapshot_endpoint(request: Request):
+    """The whole public catalog (ingredients, recipes, meals; prices, nutrition and image_refs) in one response.
+    
+    Send Accept: application/msgpack for MessagePack, otherwise JSON is returned;
+    gzip is used when accepted. Revalidate with If-None-Match.
+    """
+    format = negotiate_snapshot_format(request.headers.get("Accept"))
+    if format is None:
+        raise HTTPException(status_code=406, detail=f"Snapshot is available as {', '.join(SNAPSHOT_MEDIA_TYPES.values())}")
+    compressed = accept_qualities(request.headers.get("Accept-Encoding")).get("gzip", 0) > 0
+    
+    snapshot = get_catalog_snapshot()
+    etag = f'"{snapshot.version}-{format}{"-gzip" if compressed else ""}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept, Accept-Encoding"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    if compressed:
+        headers["Content-Encoding"] = "gzip"
+    return Response(content=await snapshot.body(format, compressed), media_type=SNAPSHOT_MEDIA_TYPES[format], headers=headers)
+
+@api_router.get("/admin/catalog/replica")
+async def get_catalog_replica_status():
+    """Get the in-memory catalog replica's sync mode and staleness"""
+    status = catalog_replica.status()
+    status["database_version"] = await get_catalog_version()
+    status["versions_behind"] = max(status["database_version"] - status["version"], 0)
+    return status
+
+
+@api_router.post("/admin/catalog/import")
+async def import_catalog(request: Request, dry_run: bool = False):
+    """Create or update source ingredients, ingredients, recipes and meals in bulk.
+    
+    Body: JSON {"source_ingredients": [...], "ingredients": [...], "recipes": [...],
+    "meals": [...]} or CSV with a `kind` column (as a text/csv body or a multipart `file`).
+    Items match existing catalog items by name; references give an `id` field
+    (source_ingredient_id, ingredient_id, recipe_id) or a `name`. purchase_quantity and
+    purchase_price on a source ingredient record a new purchase. Nothing is written
+    if any row is invalid. With dry_run, reports what would be created or updated.
+    """
+    payload = await read_import_payload(request)
+    catalog_import = CatalogImport(payload, await load_import_targets())
+    if catalog_import.errors:
+        raise HTTPException(status_code=400, detail={"message": "Import rejected", "errors": catalog_import.errors})
+    
+    result = catalog_import.report()
+    result["dry_run"] = dry_run
+    if not dry_run:
+        result["propagation"] = await catalog_import.write()
+    return result
+
+# Price quote endpoints
+@api_router.post("/price-quote")
+async def get_price_quote(quote_data: dict):
+    """Price a batch of cart items (meals/recipes with optional customizations) from the catalog.
+    
+    Items use the CartItem shape: meal_id, quantity and customizations of
+    {ingredient_id, quantity}. Without customizations the item is priced as the
+    catalog recipe or meal with that id.
+    """
+    items = quote_data.get("items")
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail="items must be a list")
+    if len(items) > PRICE_QUOTE_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {PRICE_QUOTE_MAX_ITEMS} items can be quoted at once")
+    if not all(isinstance(item, dict) for item in items):
+        raise HTTPException(status_code=400, detail="Each item must be an object")
+    
+    started = time.perf_counter()
+    index = get_price_quote_index()
+    try:
+        quote = index.quote(items)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Quantities must be finite numbers of at least 0")
+    quote["duration_ms"] = round((time.perf_counter() - started) * 1000, 3)
+    return quote
+
+@api_router.post("/admin/pricing/simulate")
+async def simulate_pricing(simulation_data: dict):
+    """Simulate catalog prices under hypothetical source unit prices and margin overrides.
+    
+    Body: {"source_prices": {source_id: unit_price}, "margins": {ingredient_id or "*":
+    {margin field: value}}, "changed_only": bool}. Returns current and simulated
+    price and margin for every ingredient, recipe and meal.
+    """
+    source_prices = simulation_data.get("source_prices") or {}
+    margins = simulation_data.get("margins") or {}
+    if not isinstance(source_prices, dict) or not isinstance(margins, dict):
+        raise HTTPException(status_code=400, detail="source_prices and margins must be objects")
+    
+    started = time.perf_counter()
+    graph = get_pricing_graph()
+    unknown_sources = [source_id for source_id in source_prices if source_id not in graph.source_rows]
+    unknown_ingredients = [ingredient_id for ingredient_id in margins if ingredient_id != "*" and ingredient_id not in graph.ingredient_rows]
+    if unknown_sources or unknown_ingredients:
+        raise HTTPException(status_code=400, detail=f"Unknown source ingredients {unknown_sources} or ingredients {unknown_ingredients}")
+    for overrides in margins.values():
+        if not isinstance(overrides, dict) or any(field not in MARGIN_FIELDS for field in overrides):
+            raise HTTPException(status_code=400, detail=f"Margin overrides may only set {', '.join(MARGIN_FIELDS)}")
+    values = list(source_prices.values()) + [value for overrides in margins.values() for value in overrides.values()]
+    if not all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in values):
+        raise HTTPException(status_code=400, detail="Prices and margins must be numbers")
+    
+    results = graph.simulate(source_prices, margins)
+    changed_only = bool(simulation_data.get("changed_only", False))
+    response = {"catalog_version": graph.version}
+    summary = {}
+    for kind, docs in (("ingredients", graph.ingredients), ("recipes", graph.recipes), ("meals", graph.meals)):
+        columns = results[kind]
+        prices = columns[:, [0, 1]] + columns[:, [2, 3]]
+        deltas = prices[:, 1] - prices[:, 0]
+        changed = ~np.isclose(deltas, 0.0)
+        if kind == "ingredients":
+            changed &= graph.valid_ingredients
+        summary[f"{kind}_changed"] = int(changed.sum())
+        items = []
+        for row in (np.flatnonzero(changed) if changed_only else range(len(docs))):
+            if kind == "ingredients" and not graph.valid_ingredients[row]:
+                items.append({"id": str(docs[row]["_id"]), "name": docs[row].get("name", ""), "price": None, "simulated_price": None})
+                continue
+            items.append({
+                "id": str(docs[row]["_id"]),
+                "name": docs[row].get("name", ""),
+                "price": float(prices[row, 0]),
+                "simulated_price": float(prices[row, 1]),
+                "delta": float(deltas[row]),
+                "delta_percent": float(deltas[row] / prices[row, 0] * 100) if prices[row, 0] else None,
+                "margin": float(columns[row, 2]),
+                "simulated_margin": float(columns[row, 3])
+            })
+        response[kind] = items
+    summary["duration_ms"] = round((time.perf_counter() - started) * 1000, 3)
+    response["summary"] = summary
+    return response
+
+
+# Catalog image endpoints
+@api_router.get("/images/{image_id}")
+async def get_image(image_id: str, request: Request, size: Optional[int] = None):
+    """Get a catalog image by id, or a thumbnail bounded to `size` pixels (rounded up to a supported size)"""
+    if size is not None:
+        size = next((bound for bound in THUMBNAIL_SIZES if bound >= size), THUMBNAIL_SIZES[-1])
+    etag = f'"{image_id}-{size or "full"}"'
+    if etag_matches(request, etag):
+        return not_modified_response(etag, IMAGE_CACHE_CONTROL)
+    
+    entry = image_cache.get((image_id, size))
+    if entry is None:
+        original = image_cache.get((image_id, None))
+        if original is None:
+            original = await load_catalog_image(image_id)
+            if original is None:
+                raise HTTPException(status_code=404, detail="Image not found")
+            image_cache[(image_id, None)] = original
+        entry = original
+        if size is not None:
+            entry = await run_in_threadpool(make_thumbnail, original[0], original[1], size)
+            image_cache[(image_id, size)] = entry
+    
+    return Response(content=entry[0], media_type=entry[1], headers={"ETag": etag, "Cache-Control": IMAGE_CACHE_CONTROL})
+
+
+# Blob endpoints
+def parse_byte_range(range_header: Optional[str], length: int) -> Optional[tuple]:
+    """(start, end) inclusive for a single "bytes=" range; None to serve the whole blob"""
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    first, separator, last = range_header[6:].strip().partition("-")
+    try:
+        if not separator or (not first and not last):
+            return None
+        if not first:
+            # Suffix range: the final N bytes
+            start, end = max(length - int(last), 0), length - 1
+        else:
+            start = int(first)
+            end = min(int(last), length - 1) if last else length - 1
+    except ValueError:
+        return None
+    if start >= length or start > end:
+        raise HTTPException(status_code=416, detail="Requested range not satisfiable", headers={"Content-Range": f"bytes */{length}"})
+    return start, end
+
+@api_router.get("/blobs/{blob_id}")
+async def get_blob(blob_id: str, request: Request):
+    """Get blob content by id; supports single byte ranges and may be cached indefinitely"""
+    meta = await db.blobs.find_one({"_id": blob_id})
+    if not meta:
+        raise HTTPException(status_code=404, detail="Blob not found")
+    
+    etag = f'"{blob_id}"'
+    if etag_matches(request, etag):
+        return not_modified_response(etag, BLOB_CACHE_CONTROL)
+    headers = {"ETag": etag, "Cache-Control": BLOB_CACHE_CONTROL, "Accept-Ranges": "bytes"}
+    
+    byte_range = parse_byte_range(request.headers.get("Range"), meta["length"])
+    if byte_range is None:
+        data = await blob_store.read(blob_id)
+        status_code = 200
+    else:
+        start, end = byte_range
+        data = await blob_store.read(blob_id, start, end - start + 1)
+        headers["Content-Range"] = f"bytes {start}-{end}/{meta['length']}"
+        status_code = 206
+    if data is None:
+        raise HTTPException(status_code=404, detail="Blob not found")
+    
+    return Response(content=data, status_code=status_code, media_type=meta["media_type"], headers=headers)
+
+@api_router.post("/admin/blobs/migrate")
+async def start_blob_migration(batch_size: int = BLOB_MIGRATION_BATCH_SIZE):
+    """Start (or resume) moving inline base64 fields into the blob store in the background"""
+    global blob_migration_task
+    if blob_migration_task and not blob_migration_task.done():
+        return {"message": "Blob migration already running"}
+    
+    async def run():
+        try:
+            state = await migrate_blob_fields(batch_size)
+            logger.info(f"Blob migration completed: {state['collections']}")
+        except Exception:
+            logger.exception("Blob migration failed; it resumes from the last checkpoint when restarted")
+            await db.config.update_one({"type": "blob_migration"}, {"$set": {"status": "failed"}})
+    
+    blob_migration_task = asyncio.create_task(run())
+    return {"message": "Blob migration started"}
+
+@api_router.get("/admin/blobs/migrate")
+async def get_blob_migration_status():
+    """Get blob migration progress"""
+    state = await db.config.find_one({"type": "blob_migration"}, {"_id": 0})
+    if not state:
+        return {"status": "not_started", "collections": {}}
+    for entry in state.get("collections", {}).values():
+        entry["last_id"] = str(entry["last_id"]) if entry.get("last_id") is not None else None
+    state["running"] = bool(blob_migration_task and not blob_migration_task.done())
+    return state
 
 
 # Saved Recipes endpoints (for all users) - renamed from saved-meals
@@ -1877,37 +5367,20 @@ async def save_recipe(recipe_data: dict, request: Request):
         "total_price": recipe_data["total_price"],
         "created_at": datetime.now(timezone.utc)
     }
+    saved_recipe.update(saved_recipe_fields(saved_recipe, await current_catalog_version()))
     
     result = await db.saved_recipes.insert_one(saved_recipe)
     return {"message": "Recipe saved", "id": str(result.inserted_id)}
 
 @api_router.get("/saved-recipes")
 async def get_saved_recipes(request: Request):
-    """Get user's saved recipes with generated images from ingredients"""
+    """Get user's saved recipes with cover images from their ingredients and current total_price"""
     user = await get_current_user(request)
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    recipes = await db.saved_recipes.find({"user_id": user["_id"]}).to_list(100)
-    
-    # Enrich each recipe with images from ingredients
-    for recipe in recipes:
-        recipe["_id"] = str(recipe["_id"])
-        
-        # Generate images array from ingredient images
-        images = []
-        for ingredient in recipe.get("ingredients", []):
-            ing_id = ingredient.get("ingredient_id")
-            if ing_id:
-                ing_data = await db.ingredients.find_one({"_id": ObjectId(ing_id)})
-                if ing_data and ing_data.get("images"):
-                    images.extend(ing_data["images"][:1])  # Take first image from each ingredient
-                    if len(images) >= 4:  # Limit to 4 images
-                        break
-        
-        recipe["images"] = images if images else []
-    
-    return recipes
+    # images and total_price are stored at save time and refreshed after catalog changes
+    return await list_saved_items(db.saved_recipes, user["_id"], saved_recipe_fields)
 
 # New Saved Meals endpoints (user-created meals from recipes)
 @api_router.post("/saved-meals")
@@ -1924,39 +5397,20 @@ async def save_meal(meal_data: dict, request: Request):
         "total_price": meal_data.get("total_price"),
         "created_at": datetime.now(timezone.utc)
     }
+    saved_meal.update(saved_meal_fields(saved_meal, await current_catalog_version()))
     
     result = await db.user_meals.insert_one(saved_meal)
     return {"message": "Meal saved", "id": str(result.inserted_id)}
 
 @api_router.get("/saved-meals")
 async def get_saved_meals(request: Request):
-    """Get user's saved meals (combinations of recipes)"""
+    """Get user's saved meals (combinations of recipes) with recipe summaries and current total_price"""
     user = await get_current_user(request)
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    meals = await db.user_meals.find({"user_id": user["_id"]}).to_list(100)
-    
-    for meal in meals:
-        meal["_id"] = str(meal["_id"])
-        
-        # Enrich with recipe data
-        enriched_recipes = []
-        for recipe_ref in meal.get("recipes", []):
-            recipe_id = recipe_ref.get("recipe_id")
-            if recipe_id:
-                recipe_data = await db.meals.find_one({"_id": ObjectId(recipe_id)})
-                if recipe_data:
-                    enriched_recipes.append({
-                        "recipe_id": recipe_id,
-                        "name": recipe_data.get("name"),
-                        "quantity": recipe_ref.get("quantity", 1),
-                        "images": recipe_data.get("images", [])
-                    })
-        
-        meal["enriched_recipes"] = enriched_recipes
-    
-    return meals
+    # enriched_recipes and total_price are stored at save time and refreshed after catalog changes
+    return await list_saved_items(db.user_meals, user["_id"], saved_meal_fields)
 
 @api_router.delete("/saved-recipes/{recipe_id}")
 async def delete_saved_recipe(recipe_id: str, request: Request):
@@ -3237,19 +6691,21 @@ async def cancel_order(order_id: str, request: Request):
 @api_router.post("/admin/ingredients")
 async def create_ingredient(ingredient: Ingredient, request: Request):
     """Create ingredient (admin only)"""
-    result = await db.ingredients.insert_one(ingredient.dict())
-    return {"message": "Ingredient created", "id": str(result.inserted_id)}
+    result = await db.ingredients.insert_one(await store_catalog_images(ingredient.dict(), "ingredients"))
+    propagation = await propagate_catalog_change(ingredient_ids=[result.inserted_id])
+    return {"message": "Ingredient created", "id": str(result.inserted_id), "propagation": propagation}
 
 @api_router.put("/admin/ingredients/{ingredient_id}")
 async def update_ingredient(ingredient_id: str, ingredient: Ingredient, request: Request):
     """Update ingredient (admin only)"""
     result = await db.ingredients.update_one(
         {"_id": ObjectId(ingredient_id)},
-        {"$set": ingredient.dict()}
+        {"$set": await store_catalog_images(ingredient.dict(), "ingredients")}
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Ingredient not found")
-    return {"message": "Ingredient updated"}
+    propagation = await propagate_catalog_change(ingredient_ids=[ingredient_id])
+    return {"message": "Ingredient updated", "propagation": propagation}
 
 @api_router.delete("/admin/ingredients/{ingredient_id}")
 async def delete_ingredient(ingredient_id: str, request: Request):
@@ -3257,24 +6713,28 @@ async def delete_ingredient(ingredient_id: str, request: Request):
     result = await db.ingredients.delete_one({"_id": ObjectId(ingredient_id)})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Ingredient not found")
-    return {"message": "Ingredient deleted"}
+    # Reprice recipes and meals that used this ingredient
+    propagation = await propagate_catalog_change(ingredient_ids=[ingredient_id])
+    return {"message": "Ingredient deleted", "propagation": propagation}
 
 @api_router.post("/admin/meals")
 async def create_meal(meal: Meal, request: Request):
     """Create meal (admin only)"""
-    result = await db.meals.insert_one(meal.dict())
-    return {"message": "Meal created", "id": str(result.inserted_id)}
+    result = await db.meals.insert_one(await store_catalog_images(meal.dict(), "meals"))
+    propagation = await propagate_catalog_change(recipe_ids=[result.inserted_id])
+    return {"message": "Meal created", "id": str(result.inserted_id), "propagation": propagation}
 
 @api_router.put("/admin/meals/{meal_id}")
 async def update_meal(meal_id: str, meal: Meal, request: Request):
     """Update meal (admin only)"""
     result = await db.meals.update_one(
         {"_id": ObjectId(meal_id)},
-        {"$set": meal.dict()}
+        {"$set": await store_catalog_images(meal.dict(), "meals")}
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Meal not found")
-    return {"message": "Meal updated"}
+    propagation = await propagate_catalog_change(recipe_ids=[meal_id])
+    return {"message": "Meal updated", "propagation": propagation}
 
 @api_router.delete("/admin/meals/{meal_id}")
 async def delete_meal(meal_id: str, request: Request):
@@ -3282,7 +6742,8 @@ async def delete_meal(meal_id: str, request: Request):
     result = await db.meals.delete_one({"_id": ObjectId(meal_id)})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Meal not found")
-    return {"message": "Meal deleted"}
+    propagation = await propagate_catalog_change(recipe_ids=[meal_id])
+    return {"message": "Meal deleted", "propagation": propagation}
 
 @api_router.get("/admin/orders")
 async def get_all_orders(request: Request):
@@ -3501,19 +6962,25 @@ async def update_user_points(user_id: str, points_data: dict, request: Request):
         {"$set": {"inherent_points": points_data["inherent_points"]}}
     )
     
-    # Recalculate total points and star rating
-    user = await db.users.find_one({"_id": ObjectId(user_id)})
-    total_points = user["points"] + user["inherent_points"]
-    new_rating = await calculate_star_rating(total_points)
-    is_guide = new_rating >= 1
-    
-    await db.users.update_one(
-        {"_id": ObjectId(user_id)},
-        {"$set": {"star_rating": new_rating, "is_guide": is_guide}}
-    )
+    # Star rating is recalculated by the points worker
+    await record_points(user_id, 0, "inherent_points_set", inherent_points=points_data["inherent_points"])
     
     return {"message": "User points updated"}
 
+@api_router.get("/admin/users/{user_id}/points-history")
+async def get_points_history(user_id: str, limit: int = 100):
+    """Get a user's points events, newest first"""
+    limit = max(1, min(limit, 1000))
+    events = await db.points_events.find({"user_id": user_id}, {"batch_id": 0}).sort("created_at", -1).limit(limit).to_list(limit)
+    for event in events:
+        event["_id"] = str(event["_id"])
+    return events
+
+@api_router.get("/admin/points-worker")
+async def get_points_worker_status():
+    """Get points worker progress"""
+    return await points_worker.status()
+
 @api_router.get("/admin/star-config")
 async def get_star_rating_config():
     """Get star rating configuration"""
@@ -3529,8 +6996,23 @@ async def save_star_rating_config(config_data: dict, request: Request):
         {"$set": {"type": "star_rating", "config": config_data}},
         upsert=True
     )
+    job_id = await start_rerate_job(config_data)
     
-    return {"message": "Star rating configuration saved"}
+    return {"message": "Star rating configuration saved", "rerate_job_id": job_id}
+
+@api_router.get("/admin/star-config/jobs/{job_id}")
+async def get_rerate_job(job_id: str):
+    """Get progress of a star re-rating job ("latest" for the most recent)"""
+    if job_id == "latest":
+        job = await db.rating_jobs.find_one({}, sort=[("started_at", -1)])
+    else:
+        if not ObjectId.is_valid(job_id):
+            raise HTTPException(status_code=404, detail="Job not found")
+        job = await db.rating_jobs.find_one({"_id": ObjectId(job_id)})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    job["_id"] = str(job["_id"])
+    return job
 
 @api_router.get("/admin/points-config")
 async def get_points_config():
@@ -3905,6 +7387,8 @@ app.add_middleware(
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    # Feed cursors (/posts, /feed/home) travel in this header
+    expose_headers=["X-Next-Cursor"],
 )
 
 logging.basicConfig(
@@ -3915,9 +7399,40 @@ logger = logging.getLogger(__name__)
 
 @app.on_event("startup")
 async def startup_event():
-    """Initialize admin credentials on startup"""
+    """Initialize admin credentials, materialized catalog fields and the catalog replica on startup"""
     await initialize_admin_credentials()
+    await ensure_catalog_indexes()
+    await ensure_post_indexes()
+    await ensure_timeline_indexes()
+    await ensure_vote_indexes()
+    await ensure_points_indexes()
+    points_worker.start()
+    migrated = await migrate_voted_by()
+    if migrated:
+        logger.info(f"Moved voted_by arrays of {migrated} posts into post_votes")
+    run_in_background(seed_timelines(), "Seeding home timelines")
+    backfilled = await backfill_author_cards()
+    if backfilled:
+        logger.info(f"Embedded author cards on posts of {backfilled} users")
+    migrated = await migrate_embedded_purchases()
+    if migrated:
+        logger.info(f"Moved purchase history of {migrated} source ingredients into monthly buckets")
+    backfilled = await backfill_bucket_quantities()
+    if backfilled:
+        logger.info(f"Stored purchased quantities on {backfilled} purchase buckets")
+    backfilled = await backfill_image_refs()
+    if backfilled:
+        logger.info(f"Stored image references on {backfilled} catalog documents")
+    propagation = await rebuild_materialized_catalog()
+    if propagation:
+        logger.info(f"Materialized catalog prices and nutrition: {propagation}")
+    await catalog_replica.start()
+    logger.info(f"Catalog replica loaded: {catalog_replica.status()['documents']}")
+    # Serve recipe detail with neighbours from the first request on
+    await rebuild_similar_recipes()
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await catalog_replica.stop()
+    await points_worker.stop()
     client.close()
@@ -17,6 +17,7 @@ import axios from 'axios';
 import { useCart } from '../../src/context/CartContext';
 import { useAuth } from '../../src/context/AuthContext';
 import { storage } from '../../src/utils/storage';
+import { catalogImageUri } from '../../src/utils/images';
 import { SafeAreaView } from 'react-native-safe-area-context';
 import Modal from 'react-native-modal';
 
@@ -30,6 +31,7 @@ interface Ingredient {
   unit: string;
   description?: string;
   images?: string[];
+  image_refs?: Array<{ id: string | null; url: string }>;
   tags?: string[];
   step_size?: number;
 }
@@ -39,6 +41,7 @@ interface Recipe {
   name: string;
   description?: string;
   images?: string[];
+  image_refs?: Array<{ id: string | null; url: string }>;
   calculated_price?: number;
   tags?: string[];
   ingredients: Array<{
@@ -535,8 +538,9 @@ export default function DIYScreen() {
       const images: string[] = [];
       selectedIngredients.forEach((qty, id) => {
         const ingredient = ingredients.find(i => i._id === id);
-        if (ingredient?.images?.[0]) {
-          images.push(ingredient.images[0]);
+        const uri = catalogImageUri(ingredient);
+        if (uri) {
+          images.push(uri);
         }
       });
       return images.slice(0, 4);
@@ -547,8 +551,9 @@ export default function DIYScreen() {
         if (!recipe) {
           recipe = myMeals.find(r => r._id === id);
         }
-        if (recipe?.images?.[0]) {
-          images.push(recipe.images[0]);
+        const uri = catalogImageUri(recipe);
+        if (uri) {
+          images.push(uri);
         }
       });
       return images.slice(0, 4);
@@ -772,8 +777,8 @@ export default function DIYScreen() {
     
     return (
       <View style={styles.listItemCard}>
-        {item.images?.[0] ? (
-          <Image source={{ uri: item.images[0] }} style={styles.listItemImage} />
+        {catalogImageUri(item) ? (
+          <Image source={{ uri: catalogImageUri(item) }} style={styles.listItemImage} />
         ) : (
           <View style={[styles.listItemImage, styles.placeholderImage]}>
             <Ionicons name="nutrition" size={24} color="#ccc" />
@@ -821,8 +826,8 @@ export default function DIYScreen() {
             style={styles.myDiyItemContent}
             onPress={() => handleEditMyDiyItem(item)}
           >
-            {item.images?.[0] ? (
-              <Image source={{ uri: item.images[0] }} style={styles.listItemImage} />
+            {catalogImageUri(item) ? (
+              <Image source={{ uri: catalogImageUri(item) }} style={styles.listItemImage} />
             ) : (
               <View style={[styles.listItemImage, styles.placeholderImage]}>
                 <Ionicons name="restaurant" size={24} color="#ccc" />
@@ -850,8 +855,8 @@ export default function DIYScreen() {
     // For DIY Combos tab, normal behavior with quantity controls
     return (
       <View style={styles.listItemCard}>
-        {item.images?.[0] ? (
-          <Image source={{ uri: item.images[0] }} style={styles.listItemImage} />
+        {catalogImageUri(item) ? (
+          <Image source={{ uri: catalogImageUri(item) }} style={styles.listItemImage} />
         ) : (
           <View style={[styles.listItemImage, styles.placeholderImage]}>
             <Ionicons name="restaurant" size={24} color="#ccc" />
@@ -20,6 +20,7 @@ import axios from 'axios';
 import { useRouter } from 'expo-router';
 import { SafeAreaView } from 'react-native-safe-area-context';
 import { storage } from '../../src/utils/storage';
+import { resolveImageUri } from '../../src/utils/images';
 import { useAuth } from '../../src/context/AuthContext';
 import { useCart } from '../../src/context/CartContext';
 import DateTimePicker from '@react-native-community/datetimepicker';
@@ -884,7 +885,7 @@ export default function GuidanceScreen() {
         onPress={() => router.push(`/chat/${item._id}`)}
       >
         {otherUser.picture ? (
-          <Image source={{ uri: otherUser.picture }} style={styles.avatar} />
+          <Image source={{ uri: resolveImageUri(otherUser.picture) }} style={styles.avatar} />
         ) : (
           <View style={[styles.avatar, styles.avatarPlaceholder]}>
             <Text style={styles.avatarText}>
@@ -19,6 +19,7 @@ import { useState, useEffect } from 'react';
 import { Ionicons } from '@expo/vector-icons';
 import axios from 'axios';
 import { storage } from '../../src/utils/storage';
+import { resolveImageUri } from '../../src/utils/images';
 import { useAuth } from '../../src/context/AuthContext';
 import { SafeAreaView } from 'react-native-safe-area-context';
 import * as ImagePicker from 'expo-image-picker';
@@ -36,7 +37,7 @@ interface Post {
   content: string;
   images?: string[];
   vote_ups: number;
-  voted_by: string[];
+  voted?: boolean;
   created_at: string;
 }
 
@@ -67,7 +68,7 @@ export default function HomeScreen() {
   const [loading, setLoading] = useState(true);
   const [refreshing, setRefreshing] = useState(false);
   const [loadingMore, setLoadingMore] = useState(false);
-  const [page, setPage] = useState(1);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
   const [hasMore, setHasMore] = useState(true);
   const POSTS_PER_PAGE = 10;
   
@@ -116,12 +117,16 @@ export default function HomeScreen() {
     fetchUnreadMessagesCount();
   }, []);
 
-  const fetchPosts = async (pageNum: number = 1, append: boolean = false) => {
+  const fetchPosts = async (before: string | null = null, append: boolean = false) => {
     try {
       if (!append) {
         setLoading(true);
       }
-      const response = await axios.get(`${API_URL}/posts?page=${pageNum}&limit=${POSTS_PER_PAGE}`);
+      const token = await storage.getItemAsync('session_token');
+      const response = await axios.get(`${API_URL}/posts`, {
+        params: { limit: POSTS_PER_PAGE, ...(before ? { before } : {}) },
+        headers: token ? { Authorization: `Bearer ${token}` } : undefined,
+      });
       
       if (append) {
         setPosts(prev => [...prev, ...response.data]);
@@ -129,8 +134,10 @@ export default function HomeScreen() {
         setPosts(response.data);
       }
       
-      // Check if there are more posts
-      setHasMore(response.data.length === POSTS_PER_PAGE);
+      // The server sends a cursor for the next page only when there may be more posts
+      const cursor = response.headers['x-next-cursor'] || null;
+      setNextCursor(cursor);
+      setHasMore(Boolean(cursor));
     } catch (error) {
       console.error('Error fetching posts:', error);
     } finally {
@@ -141,19 +148,16 @@ export default function HomeScreen() {
   };
 
   const loadMorePosts = () => {
-    if (!loadingMore && hasMore) {
+    if (!loadingMore && hasMore && nextCursor) {
       setLoadingMore(true);
-      const nextPage = page + 1;
-      setPage(nextPage);
-      fetchPosts(nextPage, true);
+      fetchPosts(nextCursor, true);
     }
   };
 
   const onRefresh = () => {
     setRefreshing(true);
-    setPage(1);
     setHasMore(true);
-    fetchPosts(1, false);
+    fetchPosts(null, false);
   };
 
   const fetchNotifications = async () => {
@@ -331,8 +335,8 @@ export default function HomeScreen() {
     }
   };
 
-  const showLikersList = async (postId: string, voters: string[]) => {
-    if (voters.length === 0) {
+  const showLikersList = async (postId: string, voteCount: number) => {
+    if (voteCount === 0) {
       Alert.alert('No likes', 'This post has no likes yet');
       return;
     }
@@ -342,18 +346,8 @@ export default function HomeScreen() {
     setLikers([]);
     
     try {
-      // Fetch user details for voters
-      const likersData = await Promise.all(
-        voters.map(async (userId) => {
-          try {
-            const response = await axios.get(`${API_URL}/users/${userId}`);
-            return response.data;
-          } catch {
-            return null;
-          }
-        })
-      );
-      setLikers(likersData.filter(Boolean));
+      const response = await axios.get(`${API_URL}/posts/${postId}/voters`);
+      setLikers(response.data);
     } catch (error) {
       console.error('Error fetching likers:', error);
       Alert.alert('Error', 'Failed to load likers');
@@ -445,7 +439,7 @@ export default function HomeScreen() {
   };
 
   const renderPost = ({ item }: { item: Post }) => {
-    const isVoted = user && item.voted_by?.includes(user._id);
+    const isVoted = user && item.voted;
     const isOwner = user && item.user_id === user._id;
 
     return (
@@ -456,7 +450,7 @@ export default function HomeScreen() {
             onPress={() => router.push(`/user/${item.user_id}`)}
           >
             {item.user_picture ? (
-              <Image source={{ uri: item.user_picture }} style={styles.avatar} />
+              <Image source={{ uri: resolveImageUri(item.user_picture) }} style={styles.avatar} />
             ) : (
               <View style={[styles.avatar, styles.avatarPlaceholder]}>
                 <Text style={styles.avatarText}>
@@ -508,7 +502,7 @@ export default function HomeScreen() {
             style={styles.imagesCarousel}
           >
             {item.images.map((image, index) => (
-              <Image key={index} source={{ uri: image }} style={styles.postImage} />
+              <Image key={index} source={{ uri: resolveImageUri(image) }} style={styles.postImage} />
             ))}
           </ScrollView>
         )}
@@ -525,7 +519,7 @@ export default function HomeScreen() {
             />
           </TouchableOpacity>
           
-          <TouchableOpacity onPress={() => showLikersList(item._id, item.voted_by || [])}>
+          <TouchableOpacity onPress={() => showLikersList(item._id, item.vote_ups)}>
             <Text style={styles.voteCount}>{item.vote_ups} likes</Text>
           </TouchableOpacity>
 
@@ -576,7 +570,7 @@ export default function HomeScreen() {
             onPress={() => setShowSidebar(true)}
           >
             {user?.picture ? (
-              <Image source={{ uri: user.picture }} style={styles.profileAvatar} />
+              <Image source={{ uri: resolveImageUri(user.picture) }} style={styles.profileAvatar} />
             ) : (
               <View style={styles.profileAvatarPlaceholder}>
                 <Text style={styles.profileAvatarText}>
@@ -657,7 +651,7 @@ export default function HomeScreen() {
                 >
                   {selectedImages.map((img, index) => (
                     <View key={index} style={styles.imagePreview}>
-                      <Image source={{ uri: img }} style={styles.previewImage} />
+                      <Image source={{ uri: resolveImageUri(img) }} style={styles.previewImage} />
                       <TouchableOpacity
                         style={styles.removeImageButton}
                         onPress={() => removeImage(index)}
@@ -792,7 +786,7 @@ export default function HomeScreen() {
                     }}
                   >
                     {liker.picture ? (
-                      <Image source={{ uri: liker.picture }} style={styles.likerAvatar} />
+                      <Image source={{ uri: resolveImageUri(liker.picture) }} style={styles.likerAvatar} />
                     ) : (
                       <View style={[styles.likerAvatar, styles.avatarPlaceholder]}>
                         <Text style={styles.avatarText}>{liker.name?.charAt(0)}</Text>
@@ -885,7 +879,7 @@ export default function HomeScreen() {
                       >
                         {comment.user_picture ? (
                           <Image 
-                            source={{ uri: comment.user_picture }} 
+                            source={{ uri: resolveImageUri(comment.user_picture) }} 
                             style={styles.commentAvatar} 
                           />
                         ) : (
@@ -954,7 +948,7 @@ export default function HomeScreen() {
                 >
                   {editImages.map((img, index) => (
                     <View key={index} style={styles.imagePreview}>
-                      <Image source={{ uri: img }} style={styles.previewImage} />
+                      <Image source={{ uri: resolveImageUri(img) }} style={styles.previewImage} />
                       <TouchableOpacity
                         style={styles.removeImageButton}
                         onPress={() => setEditImages(editImages.filter((_, i) => i !== index))}
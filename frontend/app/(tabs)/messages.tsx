@@ -14,6 +14,7 @@ import axios from 'axios';
 import { useRouter } from 'expo-router';
 import { SafeAreaView } from 'react-native-safe-area-context';
 import { storage } from '../../src/utils/storage';
+import { resolveImageUri } from '../../src/utils/images';
 import { useAuth } from '../../src/context/AuthContext';
 
 const API_URL = process.env.EXPO_PUBLIC_BACKEND_URL + '/api';
@@ -90,7 +91,7 @@ export default function MessagesScreen() {
         onPress={() => router.push(`/chat/${item._id}`)}
       >
         {otherUser.picture ? (
-          <Image source={{ uri: otherUser.picture }} style={styles.avatar} />
+          <Image source={{ uri: resolveImageUri(otherUser.picture) }} style={styles.avatar} />
         ) : (
           <View style={[styles.avatar, styles.avatarPlaceholder]}>
             <Text style={styles.avatarText}>
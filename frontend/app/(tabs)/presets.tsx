@@ -18,6 +18,7 @@ import axios from 'axios';
 import { useCart } from '../../src/context/CartContext';
 import { useAuth } from '../../src/context/AuthContext';
 import { storage } from '../../src/utils/storage';
+import { catalogImageUri } from '../../src/utils/images';
 import { SafeAreaView } from 'react-native-safe-area-context';
 import Modal from 'react-native-modal';
 
@@ -30,6 +31,7 @@ interface Meal {
   meal_name?: string;
   description?: string;
   images?: string[];
+  image_refs?: Array<{ id: string | null; url: string }>;
   base_price?: number;
   calculated_price?: number;
   total_price?: number;
@@ -363,7 +365,7 @@ export default function PresetsScreen() {
   const renderMeal = ({ item }: { item: Meal }) => {
     const mealName = item.name || item.meal_name || 'Unnamed Item';
     const mealPrice = item.calculated_price || item.base_price || item.total_price || 0;
-    const mealImage = item.images?.[0];
+    const mealImage = catalogImageUri(item);
 
     return (
       <TouchableOpacity style={styles.mealCard} onPress={() => handleMealPress(item)}>
@@ -17,6 +17,7 @@ import { useState, useEffect } from 'react';
 import { Ionicons } from '@expo/vector-icons';
 import { useAuth } from '../../src/context/AuthContext';
 import { storage } from '../../src/utils/storage';
+import { resolveImageUri } from '../../src/utils/images';
 import { useRouter, useFocusEffect } from 'expo-router';
 import { SafeAreaView } from 'react-native-safe-area-context';
 import axios from 'axios';
@@ -629,7 +630,7 @@ export default function ProfileScreen() {
                 {item.images && item.images.length > 0 && (
                   <ScrollView horizontal showsHorizontalScrollIndicator={false} style={styles.postImagesScroll}>
                     {item.images.map((img: string, idx: number) => (
-                      <Image key={idx} source={{ uri: img }} style={styles.postImage} />
+                      <Image key={idx} source={{ uri: resolveImageUri(img) }} style={styles.postImage} />
                     ))}
                   </ScrollView>
                 )}
@@ -657,7 +658,7 @@ export default function ProfileScreen() {
                 onPress={() => router.push(`/user/${item._id}`)}
               >
                 {item.picture ? (
-                  <Image source={{ uri: item.picture }} style={styles.userAvatar} />
+                  <Image source={{ uri: resolveImageUri(item.picture) }} style={styles.userAvatar} />
                 ) : (
                   <View style={[styles.userAvatar, styles.avatarPlaceholder]}>
                     <Text style={styles.avatarText}>{item.name?.charAt(0)}</Text>
@@ -685,7 +686,7 @@ export default function ProfileScreen() {
                 onPress={() => router.push(`/user/${item._id}`)}
               >
                 {item.picture ? (
-                  <Image source={{ uri: item.picture }} style={styles.userAvatar} />
+                  <Image source={{ uri: resolveImageUri(item.picture) }} style={styles.userAvatar} />
                 ) : (
                   <View style={[styles.userAvatar, styles.avatarPlaceholder]}>
                     <Text style={styles.avatarText}>{item.name?.charAt(0)}</Text>
@@ -722,7 +723,7 @@ export default function ProfileScreen() {
         <View style={styles.header}>
           <View style={styles.profileSection}>
             {user.picture ? (
-              <Image source={{ uri: user.picture }} style={styles.profilePicture} />
+              <Image source={{ uri: resolveImageUri(user.picture) }} style={styles.profilePicture} />
             ) : (
               <View style={[styles.profilePicture, styles.avatarPlaceholder]}>
                 <Text style={styles.avatarText}>{user.name?.charAt(0)}</Text>
@@ -16,6 +16,7 @@ import axios from 'axios';
 import { useLocalSearchParams, useRouter } from 'expo-router';
 import { SafeAreaView } from 'react-native-safe-area-context';
 import { storage } from '../../src/utils/storage';
+import { resolveImageUri } from '../../src/utils/images';
 import { useAuth } from '../../src/context/AuthContext';
 import { useMessages } from '../../src/context/MessagesContext';
 import * as ImagePicker from 'expo-image-picker';
@@ -169,7 +170,7 @@ export default function ChatScreen() {
           ]}
         >
           {item.image && (
-            <Image source={{ uri: item.image }} style={styles.messageImage} />
+            <Image source={{ uri: resolveImageUri(item.image) }} style={styles.messageImage} />
           )}
           {item.content ? (
             <Text
@@ -16,6 +16,7 @@ import axios from 'axios';
 import { useLocalSearchParams, useRouter } from 'expo-router';
 import { SafeAreaView } from 'react-native-safe-area-context';
 import { storage } from '../../src/utils/storage';
+import { resolveImageUri } from '../../src/utils/images';
 import { useAuth } from '../../src/context/AuthContext';
 
 const API_URL = process.env.EXPO_PUBLIC_BACKEND_URL + '/api';
@@ -108,7 +109,7 @@ export default function ConversationScreen() {
         {!isMyMessage && (
           <View style={styles.messageWithAvatar}>
             {item.sender_picture ? (
-              <Image source={{ uri: item.sender_picture }} style={styles.messageAvatar} />
+              <Image source={{ uri: resolveImageUri(item.sender_picture) }} style={styles.messageAvatar} />
             ) : (
               <View style={[styles.messageAvatar, styles.avatarPlaceholder]}>
                 <Text style={styles.avatarText}>
@@ -14,6 +14,7 @@ import axios from 'axios';
 import { useLocalSearchParams, useRouter } from 'expo-router';
 import { SafeAreaView } from 'react-native-safe-area-context';
 import { storage } from '../../src/utils/storage';
+import { resolveImageUri } from '../../src/utils/images';
 import { useAuth } from '../../src/context/AuthContext';
 import * as ImagePicker from 'expo-image-picker';
 
@@ -199,7 +200,7 @@ export default function UserProfileScreen() {
       <ScrollView style={styles.content}>
         <View style={styles.profileSection}>
           {userData.picture ? (
-            <Image source={{ uri: userData.picture }} style={styles.profileImage} />
+            <Image source={{ uri: resolveImageUri(userData.picture) }} style={styles.profileImage} />
           ) : (
             <View style={[styles.profileImage, styles.profileImagePlaceholder]}>
               <Text style={styles.profileImageText}>
@@ -349,7 +350,7 @@ export default function UserProfileScreen() {
                           {post.content}
                         </Text>
                         {post.image && (
-                          <Image source={{ uri: post.image }} style={styles.postImage} />
+                          <Image source={{ uri: resolveImageUri(post.image) }} style={styles.postImage} />
                         )}
                         <View style={styles.postFooter}>
                           <Ionicons name="heart" size={14} color="#F44336" />
@@ -0,0 +1,28 @@
+const BACKEND_URL = process.env.EXPO_PUBLIC_BACKEND_URL;
+
+interface ImageRef {
+  id: string | null;
+  url: string;
+}
+
+// Uploaded images are stored in the backend blob store and referenced by a
+// relative /api/blobs/... URL; remote and data URIs are used as is.
+export function resolveImageUri(uri: string | null | undefined): string | undefined {
+  if (!uri) {
+    return undefined;
+  }
+  return uri.startsWith('/api/') ? `${BACKEND_URL}${uri}` : uri;
+}
+
+// Catalog lists return image_refs instead of base64 images; full documents
+// (e.g. GET /recipes/:id) still carry `images`.
+export function catalogImageUri(
+  item: { image_refs?: ImageRef[]; images?: string[] } | undefined | null,
+  size = 256
+): string | undefined {
+  const ref = item?.image_refs?.[0];
+  if (ref) {
+    return ref.id ? `${BACKEND_URL}${ref.url}?size=${size}` : ref.url;
+  }
+  return resolveImageUri(item?.images?.[0]);
+}
@@ -0,0 +1,91 @@
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+from bson import ObjectId
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def log_change(db, version: int, collection: str, item_id, op: str = "update"):
+    """Log a change the way another process's record_catalog_change would"""
+    await db.catalog_changes.insert_one({
+        "version": version,
+        "changes": [{"collection": collection, "item_id": str(item_id), "op": op}],
+        "created_at": datetime.now(timezone.utc)
+    })
+
+
+async def set_config_version(db, version: int):
+    await db.config.update_one({"type": "catalog_version"}, {"$set": {"version": version}}, upsert=True)
+
+
+@pytest.fixture
+async def replica(db):
+    await server.ensure_catalog_indexes()
+    result = await db.ingredients.insert_one({"name": "Oats", "unit": "g"})
+    await server.record_catalog_change(updated={"ingredients": [result.inserted_id]})
+    await server.catalog_replica.load()
+    return server.catalog_replica, result.inserted_id
+
+
+async def test_replays_changes_logged_ahead_of_the_config_version(db, replica):
+    replica, ingredient_id = replica
+    start = replica.version
+    # A writer logged two versions but stopped before raising the config version
+    await db.ingredients.update_one({"_id": ingredient_id}, {"$set": {"name": "Rolled oats"}})
+    await log_change(db, start + 1, "ingredients", ingredient_id)
+    await log_change(db, start + 2, "ingredients", ingredient_id)
+
+    reloads = replica.full_reloads
+    await replica.sync_from_change_log()
+
+    assert replica.version == start + 2
+    assert replica.get("ingredients", ingredient_id)["name"] == "Rolled oats"
+    assert replica.full_reloads == reloads
+
+
+async def test_reloads_when_the_log_has_a_gap(db, replica):
+    replica, ingredient_id = replica
+    start = replica.version
+    # start + 1 was pruned before this replica saw it
+    await db.ingredients.update_one({"_id": ingredient_id}, {"$set": {"name": "Steel-cut oats"}})
+    await log_change(db, start + 2, "ingredients", ingredient_id)
+    await set_config_version(db, start + 2)
+
+    reloads = replica.full_reloads
+    await replica.sync_from_change_log()
+
+    assert replica.full_reloads == reloads + 1
+    assert replica.version == start + 2
+    assert replica.get("ingredients", ingredient_id)["name"] == "Steel-cut oats"
+
+
+async def test_own_change_after_another_process_replays_both(db, replica):
+    replica, ingredient_id = replica
+    start = replica.version
+    other = await db.ingredients.insert_one({"name": "Barley", "unit": "g"})
+    await log_change(db, start + 1, "ingredients", other.inserted_id)
+    await set_config_version(db, start + 1)
+
+    await db.ingredients.update_one({"_id": ingredient_id}, {"$set": {"name": "Oat flakes"}})
+    version = await server.record_catalog_change(updated={"ingredients": [ingredient_id]})
+
+    assert version == start + 2
+    assert replica.version == version
+    assert replica.get("ingredients", other.inserted_id)["name"] == "Barley"
+    assert replica.get("ingredients", ingredient_id)["name"] == "Oat flakes"
+
+
+async def test_concurrent_writers_claim_consecutive_versions(db, replica):
+    replica, _ = replica
+    start = replica.version
+    ids = [ObjectId() for _ in range(5)]
+
+    versions = await asyncio.gather(*(server.record_catalog_change(updated={"ingredients": [item_id]}) for item_id in ids))
+
+    logged = [entry["version"] for entry in await db.catalog_changes.find({"version": {"$gt": start}}).sort("version", 1).to_list(None)]
+    assert sorted(versions) == logged == list(range(start + 1, start + 6))
+    assert await server.get_catalog_version() == start + 5
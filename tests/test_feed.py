@@ -0,0 +1,47 @@
+from datetime import datetime, timedelta
+
+import pytest
+from bson import ObjectId
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def posts(db):
+    start = datetime(2025, 3, 1, 12, 0)
+    # Three posts share a timestamp, so the cursor has to break ties on _id
+    created = [start, start + timedelta(minutes=1), start + timedelta(minutes=1), start + timedelta(minutes=1),
+               start + timedelta(minutes=2), start + timedelta(minutes=5), start + timedelta(minutes=9)]
+    docs = [{"_id": ObjectId(), "user_id": "author", "content": f"post {index}", "created_at": created_at}
+            for index, created_at in enumerate(created)]
+    await db.posts.insert_many(docs)
+    return sorted(docs, key=lambda doc: (doc["created_at"], doc["_id"]), reverse=True)
+
+
+async def test_cursor_walks_every_post_once_newest_first(client, posts):
+    seen, pages, before = [], 0, None
+    while True:
+        response = await client.get("/api/posts", params={"limit": 3, **({"before": before} if before else {})})
+        assert response.status_code == 200
+        seen += [post["_id"] for post in response.json()]
+        pages += 1
+        before = response.headers.get("X-Next-Cursor")
+        if not before:
+            break
+
+    assert seen == [str(post["_id"]) for post in posts]
+    assert pages == 3
+
+
+async def test_full_last_page_ends_with_an_empty_page(client, posts):
+    first = await client.get("/api/posts", params={"limit": len(posts)})
+    assert len(first.json()) == len(posts)
+
+    rest = await client.get("/api/posts", params={"limit": len(posts), "before": first.headers["X-Next-Cursor"]})
+    assert rest.json() == []
+    assert "X-Next-Cursor" not in rest.headers
+
+
+async def test_malformed_cursor_is_rejected(client, posts):
+    response = await client.get("/api/posts", params={"before": "yesterday"})
+    assert response.status_code == 400
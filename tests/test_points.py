@@ -0,0 +1,52 @@
+import pytest
+from bson import ObjectId
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def user_id(db):
+    await server.ensure_points_indexes()
+    # Points earned before the ledger existed
+    result = await db.users.insert_one({"name": "Asha", "points": 10, "inherent_points": 0, "star_rating": 0})
+    return str(result.inserted_id)
+
+
+async def points_of(db, user_id: str) -> int:
+    return (await db.users.find_one({"_id": ObjectId(user_id)}))["points"]
+
+
+async def test_batch_adds_events_to_the_opening_balance(db, user_id):
+    await server.record_points(user_id, 5, "post_created", "post-1")
+    await server.record_points(user_id, 2, "vote_received", "post-1")
+
+    assert await server.points_worker.apply_batch() == 2
+    assert await points_of(db, user_id) == 17
+    assert await db.points_events.count_documents({"applied_at": None}) == 0
+
+
+async def test_replayed_batch_is_not_counted_twice(db, user_id):
+    await server.record_points(user_id, 5, "post_created", "post-1")
+    await server.points_worker.apply_batch()
+    # Crash after the balances were updated but before the events were marked applied
+    await db.points_events.update_many({}, {"$set": {"applied_at": None}})
+
+    assert await server.points_worker.apply_batch() == 1
+    assert await points_of(db, user_id) == 15
+    assert (await db.points_balances.find_one({"_id": ObjectId(user_id)}))["points"] == 15
+
+    await server.record_points(user_id, 5, "post_created", "post-2")
+    await server.points_worker.apply_batch()
+    assert await points_of(db, user_id) == 20
+
+
+async def test_crossing_a_threshold_updates_the_rating(db, user_id):
+    await db.config.insert_one({"type": "star_rating", "config": {"star1": 12, "star2": 100}})
+    await server.record_points(user_id, 5, "post_created", "post-1")
+    await server.points_worker.apply_batch()
+
+    user = await db.users.find_one({"_id": ObjectId(user_id)})
+    assert (user["star_rating"], user["is_guide"]) == (1, True)
+    assert "points_batches" not in user
@@ -0,0 +1,44 @@
+import asyncio
+
+import pytest
+from bson import ObjectId
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def post_id(db):
+    await server.ensure_vote_indexes()
+    result = await db.posts.insert_one({"user_id": str(ObjectId()), "content": "Lentil soup", "vote_ups": 0})
+    return str(result.inserted_id)
+
+
+async def test_toggle_casts_then_removes_a_vote(db, post_id):
+    assert await server.toggle_vote(post_id, "fan") is True
+    assert await server.toggle_vote(post_id, "fan") is False
+    assert await db.post_votes.count_documents({"post_id": post_id}) == 0
+    assert (await db.posts.find_one({"_id": ObjectId(post_id)}))["vote_ups"] == 0
+
+
+async def test_concurrent_votes_count_once(db, post_id, monkeypatch):
+    # Hold both requests after their lookup, so both miss the vote and both insert
+    collection_type = type(db.post_votes)
+    find_one_and_delete = collection_type.find_one_and_delete
+    arrived, both_looked_up = [], asyncio.Event()
+
+    async def racing_find_one_and_delete(self, *args, **kwargs):
+        result = await find_one_and_delete(self, *args, **kwargs)
+        arrived.append(result)
+        if len(arrived) == 2:
+            both_looked_up.set()
+        await both_looked_up.wait()
+        return result
+
+    monkeypatch.setattr(collection_type, "find_one_and_delete", racing_find_one_and_delete)
+    results = await asyncio.gather(server.toggle_vote(post_id, "fan"), server.toggle_vote(post_id, "fan"))
+
+    assert sorted(results, key=str) == [None, True]
+    assert await db.post_votes.count_documents({"post_id": post_id, "user_id": "fan"}) == 1
+    assert (await db.posts.find_one({"_id": ObjectId(post_id)}))["vote_ups"] == 1
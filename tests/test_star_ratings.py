@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+
+import server
+
+CONFIGS = [
+    {"star1": 25, "star2": 100, "star3": 250, "star4": 500, "star5": 1000},
+    # Levels need not be contiguous or thresholds increasing
+    {"star1": 50, "star3": 40, "star4": 300},
+    {"star2": 0, "star5": 10},
+    {},
+]
+
+
+@pytest.mark.parametrize("config", CONFIGS)
+def test_vectorized_ratings_match_the_scalar_rule(config):
+    rng = np.random.default_rng(7)
+    points = np.concatenate([
+        rng.integers(-10, 1200, size=500),
+        [value for threshold in config.values() for value in (threshold - 1, threshold, threshold + 1)]
+    ])
+
+    expected = [server.star_rating_for(int(value), config) for value in points]
+
+    assert server.star_ratings_for(points, config).tolist() == expected